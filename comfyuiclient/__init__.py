@@ -1,6 +1,20 @@
 """ComfyUI Client - A Python client for ComfyUI API"""
 
-from .client import ComfyUIClient, ComfyUIClientAsync, convert_workflow_to_api
+from .client import (
+    ComfyUIClient,
+    ComfyUIClientAsync,
+    ExecutionError,
+    PromptCancelled,
+    PromptValidationError,
+    convert_workflow_to_api,
+)
 
 __version__ = "0.1.0"
-__all__ = ["ComfyUIClient", "ComfyUIClientAsync", "convert_workflow_to_api"]
+__all__ = [
+    "ComfyUIClient",
+    "ComfyUIClientAsync",
+    "ExecutionError",
+    "PromptCancelled",
+    "PromptValidationError",
+    "convert_workflow_to_api",
+]
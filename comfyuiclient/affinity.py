@@ -0,0 +1,51 @@
+"""
+Model-affinity ordering of batch rows.
+
+Rows that load different checkpoints or LoRAs make ComfyUI swap multi-GB
+models between prompts. model_key_func() finds the loader fields (ckpt_name,
+lora_name, ...) that a batch's rows can change, and group_rows() groups rows
+by the models they select, keeping each group in input order. The
+BatchScheduler then hands a backend rows of the group it ran last, so each
+model configuration is loaded once per backend. Row indices are kept, so
+outputs still map to the original rows.
+"""
+from collections import OrderedDict, deque
+
+from .validation import injected_value
+
+
+def is_model_field(class_type, field):
+    """Loader inputs that pick a model file: CheckpointLoaderSimple.ckpt_name, LoraLoader.lora_name, ..."""
+    return "Loader" in class_type and field.endswith("_name")
+
+
+def model_key_func(workflow):
+    """
+    Return key(inputs) -> tuple of the model files a row loads, or None when
+    the workflow has no loader fields (nothing to group by).
+    """
+    fields = []
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            continue
+        for field in (node.get("inputs") or {}):
+            if is_model_field(node["class_type"], field):
+                fields.append((node_id, field))
+    if not fields:
+        return None
+
+    def key(inputs):
+        return tuple(
+            str(injected_value(workflow[node_id]["inputs"][field], inputs, f"{node_id}.{field}"))
+            for node_id, field in fields
+        )
+
+    return key
+
+
+def group_rows(rows, key):
+    """Group (index, inputs) pairs by key(inputs): OrderedDict key -> deque, in order of first appearance"""
+    groups = OrderedDict()
+    for index, inputs in rows:
+        groups.setdefault(key(inputs), deque()).append((index, inputs))
+    return groups
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from .outputs import IMAGE_EXTENSIONS, image_extension, write_bytes_atomic
+from .preprocess import spec_for
+from .workflow_manager import WorkflowManager
+
+logger = logging.getLogger(__name__)
+
+
+def safe_workflow_name(workflow_name):
+    """Sanitize a workflow name for use in output filenames"""
+    name = "".join(c for c in (workflow_name or "") if c.isalnum() or c in ('-', '_')).strip()
+    return name or "workflow"
+
+
+def error_row(idx, inputs, error, attempts):
+    """Row record for a row that failed for good; the rest of the batch keeps running"""
+    return {
+        "index": idx,
+        "inputs": inputs,
+        "status": "error",
+        "error": str(error),
+        "error_type": type(error).__name__,
+        "attempts": attempts,
+        "outputs": []
+    }
+
+
+async def upload_inputs(client, inputs, preprocessor=None, preprocess=None, on_upload=None):
+    """
+    Upload local image files among the row's inputs; returns inputs with ComfyUI file names.
+    on_upload(name) is called with each name created in ComfyUI's input folder.
+    """
+    processed_inputs = {}
+    for key, value in inputs.items():
+        if isinstance(value, str) and os.path.isfile(value):
+            # Local file exists, upload to ComfyUI
+            ext = os.path.splitext(value)[1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                original_name = os.path.basename(value)
+                spec = spec_for(preprocess, key)
+                if preprocessor is not None and spec:
+                    upload_path, source_size, upload_size = await preprocessor.process(value, spec)
+                else:
+                    upload_path = value
+                    source_size = upload_size = os.path.getsize(value)
+                if upload_path != value:
+                    logger.debug("Preprocessed %s: %d -> %d bytes", original_name, source_size, upload_size)
+                logger.debug("Uploading %s (%d bytes)...", original_name, upload_size)
+
+                # Generate safe ASCII filename to avoid encoding issues
+                ext = os.path.splitext(upload_path)[1].lower()
+                safe_name = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
+
+                with open(upload_path, 'rb') as f:
+                    uploaded_path = await client.upload_image_file(f, filename=safe_name)
+                # ComfyUI LoadImage expects just the filename, not subfolder/filename
+                if '/' in uploaded_path:
+                    uploaded_path = uploaded_path.split('/')[-1]
+                processed_inputs[key] = uploaded_path
+                if on_upload is not None:
+                    on_upload(uploaded_path)
+                logger.debug("%s uploaded as: %s", original_name, uploaded_path)
+            else:
+                processed_inputs[key] = value
+        else:
+            processed_inputs[key] = value
+    return processed_inputs
+
+
+async def run_batch_row(client, workflow, idx, inputs, job_id, job_output_dir, workflow_label,
+                        preprocessor=None, preprocess=None, on_upload=None):
+    """
+    Run one batch row on `client`: upload its files, inject the inputs, generate,
+    and save outputs into job_output_dir. Returns the row record for rows.jsonl.
+    Shared by the server's in-process scheduler and `run.py worker`.
+    on_upload is passed on to upload_inputs().
+    """
+    logger.debug("Running batch row %d on %s...", idx, client.SERVER_ADDRESS)
+    row_started = time.time()
+
+    processed_inputs = await upload_inputs(client, inputs, preprocessor, preprocess, on_upload)
+
+    # Inject variables
+    final_workflow = WorkflowManager.inject_variables(workflow, processed_inputs)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        # Debug dump of the injected values and the nodes they changed
+        logger.debug("Injected inputs: %s", processed_inputs)
+        for node_id in sorted({k.split('.', 1)[0] for k in processed_inputs if '.' in k}):
+            if node_id in final_workflow:
+                logger.debug("Node %s after injection: %s", node_id, json.dumps(final_workflow[node_id]))
+
+    # Run
+    upload_done = time.time()
+    client.comfyui_prompt = final_workflow
+    # Raw bytes per output node: outputs are only written to disk, so there is nothing to decode
+    images, text = await client.get_images(final_workflow)
+    generate_done = time.time()
+
+    # Extract source image name from inputs for filename
+    source_image_name = None
+    for key, value in inputs.items():
+        if isinstance(value, str):
+            # Check if it's a file path
+            if os.path.isfile(value) or '/' in value or '\\' in value:
+                basename = os.path.basename(value)
+                name_without_ext = os.path.splitext(basename)[0]
+                source_image_name = name_without_ext
+                break
+
+    if not source_image_name:
+        source_image_name = f"run_{idx}"
+
+    job_results = {"index": idx, "inputs": inputs, "status": "ok", "outputs": [], "server": client.SERVER_ADDRESS}
+
+    os.makedirs(job_output_dir, exist_ok=True)
+    for node_id, node_images in images.items():
+        for i, data in enumerate(node_images):
+            # Save as downloaded: {original_image}_{workflow}_{row}_{node}_{image}.png, unique
+            # per sweep combination (row index), output node and image of a batch
+            filename = f"{source_image_name}_{workflow_label}_{idx:05d}_{node_id}_{i}{image_extension(data)}"
+            filepath = os.path.join(job_output_dir, filename)
+            await asyncio.to_thread(write_bytes_atomic, filepath, data)
+
+            # Return URL instead of base64 (much smaller response)
+            job_results["outputs"].append({
+                "node_id": node_id,
+                "type": "image",
+                "filename": filename,
+                "url": f"/api/outputs/{job_id}/{filename}"
+            })
+    for node_id, data in text.items():
+        job_results["outputs"].append({
+            "node_id": node_id,
+            "type": "text",
+            "data": str(data)
+        })
+
+    job_results["timings"] = {
+        "started": row_started,
+        "upload": upload_done - row_started,
+        "generate": generate_done - upload_done,
+        "total": time.time() - row_started,
+    }
+    job_results["timeline"] = client.last_timeline.to_dict()
+    return job_results
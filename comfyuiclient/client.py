@@ -1,5 +1,7 @@
+import asyncio
 import io
 import json
+import logging
 import random
 import sys
 import time
@@ -9,6 +11,57 @@ import aiohttp
 import requests
 from PIL import Image
 
+from .connection import connections
+from .timeline import EXECUTION_EVENTS, ExecutionTimeline
+from .tracing import configure_logging, span
+
+logger = logging.getLogger(__name__)
+
+# How long removing an abandoned prompt (after a timeout) may take before giving up
+ABANDON_TIMEOUT = 10.0
+
+
+class PromptValidationError(ValueError):
+    """ComfyUI rejected the prompt (HTTP 400), e.g. an invalid input value. Retrying won't help."""
+
+
+class ExecutionError(RuntimeError):
+    """ComfyUI reported an execution_error for the prompt"""
+
+    def __init__(self, prompt_id, details):
+        self.prompt_id = prompt_id
+        self.details = details or {}
+        super().__init__(
+            f"Prompt {prompt_id} failed in node {self.details.get('node_id')} "
+            f"({self.details.get('node_type')}): {self.details.get('message')}"
+        )
+
+
+class PromptCancelled(RuntimeError):
+    """The prompt was deleted from the ComfyUI queue or interrupted before it finished"""
+
+
+def decode_image(image_data):
+    """
+    Decode downloaded image bytes into a fully loaded PIL image.
+    A module-level function so it can also run in a ProcessPoolExecutor.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return image
+
+
+def output_node_ids(prompt):
+    """IDs of the nodes of an API prompt that no other node reads from (SaveImage, PreviewImage, ...)"""
+    linked = set()
+    for node in prompt.values():
+        if not isinstance(node, dict):
+            continue
+        for value in (node.get("inputs") or {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                linked.add(value[0])
+    return {node_id for node_id, node in prompt.items() if isinstance(node, dict) and node_id not in linked}
+
 
 def convert_workflow_to_api(workflow_json):
     """
@@ -98,13 +151,25 @@ def convert_workflow_to_api(workflow_json):
 
 class ComfyUIClientAsync:
 
-    def __init__(self, server, prompt_file, debug=False):
+    def __init__(self, server, prompt_file, debug=False, executor=None):
+        """
+        executor is the concurrent.futures pool generate() decodes images in;
+        None uses the event loop's default thread pool.
+        Clients of the same server share one websocket and HTTP session (see connection.py).
+        """
         self.PROMPT_FILE = prompt_file
         self.SERVER_ADDRESS = server
         self.CLIENT_ID = str(uuid.uuid4())
-        self.ws = None
+        self.connection = None
         self.session = None
         self.debug = debug
+        self.executor = executor
+        if debug:
+            configure_logging("DEBUG")
+        self.event_listeners = []
+        self.last_timeline = None
+        self.pending_prompts = set()  # prompt_ids queued by execute() and not finished yet
+        self.cancelling = False  # set by cancel_prompts(); prompts queued afterwards are cancelled at once
 
         self.reload()
 
@@ -120,39 +185,59 @@ class ComfyUIClientAsync:
             else:
                 self.comfyui_prompt = data
 
-            if self.debug:
-                print(f"Loaded workflow from {self.PROMPT_FILE}")
+            logger.debug("Loaded workflow from %s", self.PROMPT_FILE)
         except FileNotFoundError:
-            print(f"Prompt file not found: {self.PROMPT_FILE}")
+            logger.debug("Prompt file not found: %s", self.PROMPT_FILE)
         except json.JSONDecodeError:
-            print(f"Failed to parse prompt file: {self.PROMPT_FILE}")
+            logger.error("Failed to parse prompt file: %s", self.PROMPT_FILE)
         except Exception as e:
-            print(f"Error: {e} while reading prompt file: {self.PROMPT_FILE}")
+            logger.error("Error: %s while reading prompt file: %s", e, self.PROMPT_FILE)
 
-    async def connect(self):
+    def add_event_listener(self, callback):
+        """
+        Register callback(event) for websocket events.
+        event is a dict: {"type", "prompt_id", "time", "data"}.
+        """
+        self.event_listeners.append(callback)
+
+    def remove_event_listener(self, callback):
+        if callback in self.event_listeners:
+            self.event_listeners.remove(callback)
+
+    async def events(self):
+        """
+        Async iterator over websocket events received while prompts run on this client.
+        Iterate from a separate task while calling generate()/get_images().
+        """
+        queue = asyncio.Queue()
+        self.add_event_listener(queue.put_nowait)
         try:
-            self.session = aiohttp.ClientSession()
-            self.ws = await self.session.ws_connect(
-                f"ws://{self.SERVER_ADDRESS}/ws?clientId={self.CLIENT_ID}"
-            )
-        except aiohttp.ClientError as e:
-            if self.session:
-                await self.session.close()
-            raise ConnectionError(f"Failed to connect to ComfyUI server: {e}")
+            while True:
+                yield await queue.get()
+        finally:
+            self.remove_event_listener(queue.put_nowait)
+
+    def _emit_event(self, event):
+        for callback in list(self.event_listeners):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.debug("Event listener error: %s", e)
+
+    async def connect(self):
+        """Attach to the server's shared connection; raises ConnectionError if it is unreachable"""
+        if self.connection is not None:
+            return
+        self.connection = await connections.acquire(self.SERVER_ADDRESS)
+        self.session = self.connection.session
+        # Prompts must be queued under the connection's client_id for their events to reach it
+        self.CLIENT_ID = self.connection.client_id
 
     async def close(self):
-        try:
-            if self.ws:
-                await self.ws.close()
-        except Exception as e:
-            if self.debug:
-                print(f"Error closing WebSocket: {e}")
-        try:
-            if self.session:
-                await self.session.close()
-        except Exception as e:
-            if self.debug:
-                print(f"Error closing session: {e}")
+        if self.connection is not None:
+            connections.release(self.connection)
+            self.connection = None
+            self.session = None
 
     async def queue_prompt(self, prompt):
         try:
@@ -162,6 +247,8 @@ class ComfyUIClientAsync:
             ) as response:
                 if response.status != 200:
                     error_text = await response.text()
+                    if response.status == 400:
+                        raise PromptValidationError(f"Failed to queue prompt: {response.status} - {error_text}")
                     raise ConnectionError(f"Failed to queue prompt: {response.status} - {error_text}")
                 result = await response.json()
                 if "prompt_id" not in result:
@@ -195,36 +282,176 @@ class ComfyUIClientAsync:
         except json.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON response from server: {e}")
 
-    async def get_images(self, prompt):
-        prompt_id = (await self.queue_prompt(prompt))["prompt_id"]
+    async def get_images(self, prompt, timeout=None):
+        """
+        Queue a prompt and wait for its outputs.
+        Each node's images are downloaded as soon as its `executed` event arrives,
+        overlapping with the rest of the graph. /history is read only when events
+        may be missing: after a websocket reconnect, or when an output node (one
+        no other node reads from) ran but reported nothing, e.g. a cached one on
+        older ComfyUI versions.
+        Raises TimeoutError if it does not finish within `timeout` seconds,
+        ConnectionError if the server stays unreachable, and ExecutionError if
+        ComfyUI reports an execution_error for it.
+        """
+        downloads = {}  # (filename, subfolder, type) -> download task
+        reported = {}  # node_id -> output from its executed event
+
+        def download(image):
+            key = (image["filename"], image.get("subfolder", ""), image.get("type", "output"))
+            if key not in downloads:
+                downloads[key] = asyncio.ensure_future(self.get_image(*key))
+            return downloads[key]
+
+        def on_output(node_id, output):
+            reported[node_id] = output
+            for image in output.get("images") or []:
+                download(image)
+
         output_images = {}
         output_text = {}
+        try:
+            timeline = await self.execute(prompt, timeout, on_output=on_output)
+            prompt_id = timeline.prompt_id
+
+            with span("download", server=self.SERVER_ADDRESS, prompt_id=prompt_id) as attrs:
+                outputs = reported
+                ran = set(timeline.nodes) | set(timeline.cached_nodes)
+                if timeline.events_missed or (output_node_ids(prompt) & ran) - set(reported):
+                    attrs["history"] = True
+                    outputs = (await self.get_history(prompt_id))[prompt_id]["outputs"]
+                for node_id, node_output in outputs.items():
+                    if "images" in node_output:
+                        output_images[node_id] = [await download(image) for image in node_output["images"]]
+                    if "text" in node_output:
+                        output_text[node_id] = node_output["text"]
+        finally:
+            # Downloads that are no longer needed (the prompt failed, or /history disagreed)
+            for task in downloads.values():
+                task.cancel()
+            await asyncio.gather(*downloads.values(), return_exceptions=True)
 
+        return output_images, output_text
+
+    async def execute(self, prompt, timeout=None, on_output=None):
+        """
+        Queue a prompt and wait until it has run, without fetching its outputs.
+        on_output(node_id, output) is called for each `executed` event with the node's
+        UI output ({"images": [...], ...}), as in /history.
+        Returns its ExecutionTimeline (also kept as last_timeline); raises like get_images().
+        """
+        generation = self.connection.generation
+        with span("queue_prompt", server=self.SERVER_ADDRESS) as attrs:
+            prompt_id = (await self.queue_prompt(prompt))["prompt_id"]
+            attrs["prompt_id"] = prompt_id
+        timeline = ExecutionTimeline(prompt_id)
+        self.last_timeline = timeline
+        deadline = None if timeout is None else time.time() + timeout
+
+        watch = self.connection.watch(prompt_id, since=generation)
+        self.pending_prompts.add(prompt_id)
+        try:
+            if self.cancelling:
+                # Cancelled while this prompt was being queued
+                await self.cancel_prompts([prompt_id])
+            with span("execute", server=self.SERVER_ADDRESS, prompt_id=prompt_id):
+                await self._wait_for_prompt(watch, timeline, deadline, on_output)
+        except (TimeoutError, asyncio.CancelledError):
+            # Nobody waits for the prompt any more; a retry would queue a second copy,
+            # so take it off the server. Shielded so a cancellation can't cut it short.
+            await asyncio.shield(self._abandon_prompt(prompt_id))
+            raise
+        finally:
+            self.pending_prompts.discard(prompt_id)
+            self.connection.unwatch(watch)
+            timeline.events_missed = watch.missed
+        return timeline
+
+    async def _wait_for_prompt(self, watch, timeline, deadline, on_output=None):
+        """Consume the prompt's events until it finishes, feeding timeline, on_output and listeners"""
+        prompt_id = watch.prompt_id
         while True:
-            message = await self.ws.receive()
-            if message.type == aiohttp.WSMsgType.TEXT:
-                data = json.loads(message.data)
-                if (
-                    data["type"] == "executing"
-                    and data["data"]["node"] is None
-                    and data["data"]["prompt_id"] == prompt_id
-                ):
-                    break
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.time())
+                msg_type, msg_data, now = await watch.get(remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Timeout waiting for prompt {prompt_id} to complete")
+            if msg_type in EXECUTION_EVENTS:
+                timeline.handle(msg_type, msg_data, now)
+            if msg_type == "executed" and on_output is not None and msg_data.get("output"):
+                on_output(str(msg_data.get("node")), msg_data["output"])
+            if self.event_listeners:
+                self._emit_event({
+                    "type": msg_type,
+                    "prompt_id": msg_data.get("prompt_id"),
+                    "time": now,
+                    "data": msg_data,
+                })
+            if msg_type == "execution_error":
+                raise ExecutionError(prompt_id, timeline.error)
+            if msg_type == "execution_interrupted":
+                raise PromptCancelled(f"Prompt {prompt_id} was interrupted")
+            if msg_type == "executing" and msg_data.get("node") is None:
+                return
+
+    async def get_queue(self):
+        """ComfyUI's queue: {"queue_running": [...], "queue_pending": [...]}, entries are [number, prompt_id, ...]"""
+        try:
+            async with self.session.get(f"http://{self.SERVER_ADDRESS}/queue") as response:
+                response.raise_for_status()
+                return await response.json()
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"Failed to get queue: {e}")
 
-        history = (await self.get_history(prompt_id))[prompt_id]
-        for node_id, node_output in history["outputs"].items():
-            images_output = []
-            if "images" in node_output:
-                for image in node_output["images"]:
-                    image_data = await self.get_image(
-                        image["filename"], image["subfolder"], image["type"]
-                    )
-                    images_output.append(image_data)
-                output_images[node_id] = images_output
-            if "text" in node_output:
-                output_text[node_id] = node_output["text"]
+    async def _post(self, path, payload):
+        try:
+            async with self.session.post(f"http://{self.SERVER_ADDRESS}{path}", json=payload) as response:
+                response.raise_for_status()
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"Failed to post {path}: {e}")
 
-        return output_images, output_text
+    async def cancel_prompts(self, prompt_ids):
+        """
+        Cancel prompts queued through this server's connection without touching anyone
+        else's: delete the ones still waiting in the ComfyUI queue and interrupt the
+        backend only if the prompt it is running is one of them. Their waiting
+        execute() calls raise PromptCancelled, and so do prompts this client queues
+        later (until `cancelling` is reset).
+        Returns {"deleted": [prompt_ids], "interrupted": prompt_id or None}.
+        """
+        self.cancelling = True
+        return await self._remove_prompts(prompt_ids)
+
+    async def _abandon_prompt(self, prompt_id):
+        """Remove a prompt whose caller gave up on it; failures are only logged"""
+        try:
+            await asyncio.wait_for(self._remove_prompts([prompt_id]), ABANDON_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to remove abandoned prompt %s from %s: %s", prompt_id, self.SERVER_ADDRESS, e)
+
+    async def _remove_prompts(self, prompt_ids):
+        """Delete prompt_ids from the ComfyUI queue, interrupting the backend if it runs one of them"""
+        prompt_ids = set(prompt_ids)
+        if not prompt_ids:
+            return {"deleted": [], "interrupted": None}
+        queue = await self.get_queue()
+        pending = prompt_ids & {item[1] for item in queue.get("queue_pending", [])}
+        if pending:
+            await self._post("/queue", {"delete": sorted(pending)})
+            queue = await self.get_queue()
+        running = prompt_ids & {item[1] for item in queue.get("queue_running", [])}
+        interrupted = None
+        for prompt_id in running:
+            # Newer ComfyUI versions also check the prompt_id themselves, closing the
+            # window in which the running prompt could change after /queue was read
+            await self._post("/interrupt", {"prompt_id": prompt_id})
+            interrupted = prompt_id
+        deleted = sorted(pending - running)
+        for prompt_id in deleted:
+            self.connection.cancel(prompt_id, PromptCancelled(f"Prompt {prompt_id} was removed from the queue"))
+        logger.info("Cancelled %d queued prompt(s) on %s%s", len(deleted), self.SERVER_ADDRESS,
+                    f", interrupted {interrupted}" if interrupted else "")
+        return {"deleted": deleted, "interrupted": interrupted}
 
     async def set_data(
         self,
@@ -286,8 +513,7 @@ class ComfyUIClientAsync:
             except Exception as e:
                 raise RuntimeError(f"Error processing image upload: {e}")
 
-        if self.debug:
-            print(f"Set data for {key} (id: {key_id}): {self.comfyui_prompt[key_id]}")
+        logger.debug("Set data for %s (id: %s): %s", key, key_id, self.comfyui_prompt[key_id])
 
     async def upload_image(self, image: Image.Image, filename="temp.png", subfolder="input") -> str:
         """
@@ -307,6 +533,16 @@ class ComfyUIClientAsync:
         """
         Upload raw image bytes to ComfyUI server.
         """
+        return await self._upload_image(image_data, f"{len(image_data)} bytes", filename, subfolder)
+
+    async def upload_image_file(self, fileobj, filename="temp.png", subfolder="") -> str:
+        """
+        Upload an image from a binary file object (opened file, SpooledTemporaryFile, ...).
+        The content is streamed to ComfyUI in chunks instead of being read into memory first.
+        """
+        return await self._upload_image(fileobj, "streamed", filename, subfolder)
+
+    async def _upload_image(self, image_data, size_desc, filename, subfolder) -> str:
         # Determine content-type based on extension
         ext = filename.lower().split('.')[-1] if '.' in filename else 'png'
         content_types = {
@@ -319,7 +555,7 @@ class ComfyUIClientAsync:
         }
         content_type = content_types.get(ext, 'image/png')
         
-        print(f"    Uploading to ComfyUI: {filename} ({len(image_data)} bytes, {content_type})")
+        logger.debug("Uploading to ComfyUI: %s (%s, %s)", filename, size_desc, content_type)
         
         data = aiohttp.FormData()
         data.add_field("image", image_data, filename=filename, content_type=content_type)
@@ -327,39 +563,42 @@ class ComfyUIClientAsync:
             data.add_field("subfolder", subfolder)
         data.add_field("overwrite", "true")
 
-        async with self.session.post(
-            f"http://{self.SERVER_ADDRESS}/upload/image", data=data
-        ) as response:
-            try:
-                 response.raise_for_status()
-                 resp_json = await response.json()
-            except Exception as e:
-                 # Try to read body for error details
-                 text = await response.text()
-                 raise RuntimeError(f"Upload failed: {response.status} {text} - {e}")
+        with span("upload", server=self.SERVER_ADDRESS, filename=filename):
+            async with self.session.post(
+                f"http://{self.SERVER_ADDRESS}/upload/image", data=data
+            ) as response:
+                try:
+                     response.raise_for_status()
+                     resp_json = await response.json()
+                except Exception as e:
+                     # Try to read body for error details
+                     text = await response.text()
+                     raise RuntimeError(f"Upload failed: {response.status} {text} - {e}")
+
+        logger.debug("ComfyUI upload response: %s", resp_json)
+        
+        if "name" not in resp_json or "subfolder" not in resp_json:
+            raise ValueError(
+                "Invalid upload response: missing required fields"
+            )
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            # Debugging aid only: fetch the file back to check it arrived intact
+            await self._verify_upload(resp_json.get("name"), resp_json.get("subfolder"))
+        
+        return resp_json.get("subfolder") + "/" + resp_json.get("name")
 
-            print(f"    ComfyUI upload response: {resp_json}")
-            
-            if "name" not in resp_json or "subfolder" not in resp_json:
-                raise ValueError(
-                    "Invalid upload response: missing required fields"
-                )
-            
-            # Verify the file exists by trying to fetch it
-            uploaded_name = resp_json.get("name")
-            uploaded_subfolder = resp_json.get("subfolder")
-            try:
-                verify_params = {"filename": uploaded_name, "subfolder": uploaded_subfolder, "type": "input"}
-                async with self.session.get(f"http://{self.SERVER_ADDRESS}/view", params=verify_params) as verify_resp:
-                    if verify_resp.status == 200:
-                        verify_data = await verify_resp.read()
-                        print(f"    Verified file on ComfyUI: {len(verify_data)} bytes")
-                    else:
-                        print(f"    WARNING: Could not verify file on ComfyUI: {verify_resp.status}")
-            except Exception as e:
-                print(f"    WARNING: Failed to verify file: {e}")
-            
-            return resp_json.get("subfolder") + "/" + resp_json.get("name")
+    async def _verify_upload(self, uploaded_name, uploaded_subfolder):
+        try:
+            verify_params = {"filename": uploaded_name, "subfolder": uploaded_subfolder, "type": "input"}
+            async with self.session.get(f"http://{self.SERVER_ADDRESS}/view", params=verify_params) as verify_resp:
+                if verify_resp.status == 200:
+                    verify_data = await verify_resp.read()
+                    logger.debug("Verified file on ComfyUI: %d bytes", len(verify_data))
+                else:
+                    logger.warning("Could not verify file on ComfyUI: %s", verify_resp.status)
+        except Exception as e:
+            logger.warning("Failed to verify file: %s", e)
 
     def find_key_by_title(self, target_title):
         target_title = target_title.strip()
@@ -372,15 +611,23 @@ class ComfyUIClientAsync:
             title = value.get("_meta", {}).get("title", "").strip()
             if title == target_title:
                 return key
-        if self.debug:
-            print(f"Key not found: {target_title}")
+        logger.debug("Key not found: %s", target_title)
         return None
 
-    async def generate(self, node_names=None) -> dict:
+    async def decode_image(self, image_data):
+        """Decode image bytes in self.executor, keeping the event loop free"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, decode_image, image_data)
+
+    async def generate(self, node_names=None, timeout=None, decode=True) -> dict:
         """
         Generate images from the workflow.
         If node_names is specified, only return results from those nodes.
         If node_names is None, return ALL output images/text from the workflow.
+        timeout is passed to get_images().
+        Images are returned as PIL images decoded in self.executor, or as the
+        raw downloaded bytes with decode=False (cheapest when they are only
+        written to disk).
         """
         node_ids = {}
         filter_by_name = node_names is not None
@@ -391,7 +638,7 @@ class ComfyUIClientAsync:
                 if node_id is not None:
                     node_ids[node_id] = node_name
 
-        images, text = await self.get_images(self.comfyui_prompt)
+        images, text = await self.get_images(self.comfyui_prompt, timeout=timeout)
         results = {}
         
         for node_id, node_images in images.items():
@@ -402,9 +649,13 @@ class ComfyUIClientAsync:
             
             result_key = node_ids.get(node_id, node_id)  # Use node name if available, else node_id
             for image_data in node_images:
-                image = Image.open(io.BytesIO(image_data))
-                results[result_key] = image
-                
+                results[result_key] = image_data
+
+        if decode:
+            keys = [k for k, v in results.items() if isinstance(v, bytes)]
+            images = await asyncio.gather(*(self.decode_image(results[k]) for k in keys))
+            results.update(zip(keys, images))
+
         for node_id, node_text in text.items():
             if filter_by_name and node_id not in node_ids:
                 continue
@@ -422,6 +673,8 @@ class ComfyUIClient:
         self.CLIENT_ID = str(uuid.uuid4())
         self.session = None
         self.debug = debug
+        if debug:
+            configure_logging("DEBUG")
 
         self.reload()
 
@@ -437,14 +690,13 @@ class ComfyUIClient:
             else:
                 self.comfyui_prompt = data
 
-            if self.debug:
-                print(f"Loaded workflow from {self.PROMPT_FILE}")
+            logger.debug("Loaded workflow from %s", self.PROMPT_FILE)
         except FileNotFoundError:
-            print(f"Prompt file not found: {self.PROMPT_FILE}")
+            logger.debug("Prompt file not found: %s", self.PROMPT_FILE)
         except json.JSONDecodeError:
-            print(f"Failed to parse prompt file: {self.PROMPT_FILE}")
+            logger.error("Failed to parse prompt file: %s", self.PROMPT_FILE)
         except Exception as e:
-            print(f"Error: {e} while reading prompt file: {self.PROMPT_FILE}")
+            logger.error("Error: %s while reading prompt file: %s", e, self.PROMPT_FILE)
 
     def connect(self):
         self.session = requests.Session()
@@ -512,8 +764,7 @@ class ComfyUIClient:
                 time.sleep(1)
                 retry_count += 1
             except Exception as e:
-                if self.debug:
-                    print(f"Error getting history (retry {retry_count}): {e}")
+                logger.debug("Error getting history (retry %d): %s", retry_count, e)
                 if retry_count >= max_retries:
                     raise TimeoutError(
                         f"Timeout waiting for prompt {prompt_id} to complete"
@@ -594,8 +845,7 @@ class ComfyUIClient:
             except Exception as e:
                 raise RuntimeError(f"Error processing image upload: {e}")
 
-        if self.debug:
-            print(f"Set data for {key} (id: {key_id}): {self.comfyui_prompt[key_id]}")
+        logger.debug("Set data for %s (id: %s): %s", key, key_id, self.comfyui_prompt[key_id])
 
     def find_key_by_title(self, target_title):
         target_title = target_title.strip()
@@ -608,8 +858,7 @@ class ComfyUIClient:
             title = value.get("_meta", {}).get("title", "").strip()
             if title == target_title:
                 return key
-        if self.debug:
-            print(f"Key not found: {target_title}")
+        logger.debug("Key not found: %s", target_title)
         return None
 
     def generate(self, node_names=None) -> dict:
@@ -0,0 +1,315 @@
+"""
+One shared websocket per ComfyUI server.
+
+ComfyUI sends a prompt's execution events only to the websocket of the
+client_id that queued it. A ServerConnection owns one websocket and one HTTP
+session per server under a fixed client_id, which every ComfyUIClientAsync on
+that server queues its prompts with, and routes each execution event to the
+PromptWatch of its prompt_id. Other messages (queue status) go to every watch.
+
+When the websocket drops it reconnects with exponential backoff under the same
+client_id, so ComfyUI resumes sending events for prompts still running. Events
+sent while it was down are lost, so after each reconnect every watched prompt
+is looked up in /history, also between reconnect attempts, and the ones that
+finished meanwhile get their final events from there. Watches of prompts that
+haven't finished fail with ConnectionError once the websocket has been down
+for longer than GIVE_UP_AFTER seconds.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+from .timeline import EXECUTION_EVENTS
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+GIVE_UP_AFTER = float(os.environ.get("COMFY_WS_GIVE_UP", "60"))
+# How long a new client waits for a reconnecting websocket before failing
+CONNECT_WAIT = 10.0
+HEARTBEAT = 30.0
+HISTORY_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# A connection nobody uses is closed after this many seconds
+IDLE_CLOSE = 30.0
+# Prompts whose events are kept until they are watched (a prompt's first events
+# can arrive between queueing it and watching it)
+RECENT_PROMPTS = 64
+
+
+class PromptWatch:
+    """Events of one prompt as (type, data, time) tuples, read with get()"""
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.queue = asyncio.Queue()
+        self.missed = False  # the websocket was down at some point while watching
+        self.finished = False  # final events were recovered from /history
+
+    def put(self, msg_type, data, now):
+        self.queue.put_nowait((msg_type, data, now))
+
+    def fail(self, error):
+        self.queue.put_nowait(error)
+
+    async def get(self, timeout=None):
+        """Next event; raises asyncio.TimeoutError, or the error the connection failed with"""
+        item = await asyncio.wait_for(self.queue.get(), timeout)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class ServerConnection:
+    """The shared websocket and HTTP session of one ComfyUI server"""
+
+    def __init__(self, server, give_up=GIVE_UP_AFTER):
+        self.server = server
+        self.client_id = str(uuid.uuid4())
+        self.give_up = give_up
+        self.loop = asyncio.get_running_loop()
+        self.session = None
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.generation = 0  # incremented on every (re)connect
+        self.watches = {}  # prompt_id -> PromptWatch
+        self.recent = OrderedDict()  # prompt_id -> [events] of prompts not watched yet
+        self.refs = 0
+        self.task = None
+        self.start_lock = asyncio.Lock()
+        self.close_handle = None
+        self.closed = False
+
+    async def start(self):
+        """Connect if needed; raises ConnectionError if the server can't be reached"""
+        async with self.start_lock:
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            if self.task is None:
+                await self._connect()
+                self.task = asyncio.ensure_future(self._run())
+                return
+        if not self.connected.is_set():
+            try:
+                await asyncio.wait_for(self.connected.wait(), CONNECT_WAIT)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"Failed to connect to ComfyUI server {self.server}: still reconnecting")
+
+    async def _connect(self):
+        try:
+            self.ws = await self.session.ws_connect(
+                f"ws://{self.server}/ws?clientId={self.client_id}", heartbeat=HEARTBEAT
+            )
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError(f"Failed to connect to ComfyUI server {self.server}: {e}")
+        self.generation += 1
+        self.connected.set()
+
+    async def _run(self):
+        """Read the websocket, reconnecting with backoff whenever it drops"""
+        down_since = None
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            if self.ws is None:
+                try:
+                    await self._connect()
+                except ConnectionError as e:
+                    await self._reconcile(list(self.watches))
+                    now = time.time()
+                    down_since = down_since or now
+                    if now - down_since > self.give_up and self.watches:
+                        self._fail_watches(ConnectionError(
+                            f"Lost connection to ComfyUI server {self.server} for {now - down_since:.0f}s: {e}"
+                        ))
+                    logger.info("Reconnecting to %s in %.1fs: %s", self.server, delay, e)
+                    await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+                if down_since is not None:
+                    logger.info("Reconnected to %s after %.1fs", self.server, time.time() - down_since)
+                    down_since = None
+                    delay = RECONNECT_MIN_DELAY
+                    # Events sent while disconnected are lost; /history has the prompts that finished
+                    asyncio.ensure_future(self._reconcile(list(self.watches)))
+            await self._read()
+            self.connected.clear()
+            for watch in self.watches.values():
+                watch.missed = True
+            ws, self.ws = self.ws, None
+            await ws.close()
+            down_since = time.time()
+            logger.warning("WebSocket to %s closed, reconnecting", self.server)
+
+    async def _read(self):
+        while True:
+            message = await self.ws.receive()
+            if message.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    self._dispatch(json.loads(message.data))
+                except (json.JSONDecodeError, AttributeError) as e:
+                    logger.debug("Ignoring malformed message from %s: %s", self.server, e)
+            elif message.type in (
+                aiohttp.WSMsgType.CLOSE,
+                aiohttp.WSMsgType.CLOSING,
+                aiohttp.WSMsgType.CLOSED,
+                aiohttp.WSMsgType.ERROR,
+            ):
+                return
+
+    def _dispatch(self, data):
+        msg_type = data.get("type")
+        msg_data = data.get("data") or {}
+        now = time.time()
+        if msg_type not in EXECUTION_EVENTS:
+            for watch in list(self.watches.values()):
+                watch.put(msg_type, msg_data, now)
+            return
+        prompt_id = msg_data.get("prompt_id")
+        watch = self.watches.get(prompt_id)
+        if watch is not None:
+            watch.put(msg_type, msg_data, now)
+        elif prompt_id is not None:
+            self.recent.setdefault(prompt_id, []).append((msg_type, msg_data, now))
+            while len(self.recent) > RECENT_PROMPTS:
+                self.recent.popitem(last=False)
+
+    def watch(self, prompt_id, since=None):
+        """
+        Route prompt_id's events to a new PromptWatch, replaying those that already
+        arrived. `since` is the generation the prompt was queued in: if the websocket
+        reconnected after that, the prompt is also looked up in /history.
+        """
+        watch = PromptWatch(prompt_id)
+        self.watches[prompt_id] = watch
+        for event in self.recent.pop(prompt_id, ()):
+            watch.put(*event)
+        if (since is not None and since != self.generation) or not self.connected.is_set():
+            watch.missed = True
+        if since is not None and since != self.generation:
+            asyncio.ensure_future(self._reconcile([prompt_id]))
+        return watch
+
+    def unwatch(self, watch):
+        if self.watches.get(watch.prompt_id) is watch:
+            del self.watches[watch.prompt_id]
+
+    def cancel(self, prompt_id, error):
+        """Fail the watch of a prompt that will never run"""
+        watch = self.watches.get(prompt_id)
+        if watch is not None and not watch.finished:
+            watch.fail(error)
+
+    def _fail_watches(self, error):
+        for watch in self.watches.values():
+            if not watch.finished:
+                watch.fail(error)
+        self.watches.clear()
+
+    async def _reconcile(self, prompt_ids):
+        """Give watches of prompts that finished while disconnected their final events from /history"""
+        for prompt_id in prompt_ids:
+            watch = self.watches.get(prompt_id)
+            if watch is None or watch.finished:
+                continue
+            try:
+                async with self.session.get(
+                    f"http://{self.server}/history/{prompt_id}", timeout=HISTORY_TIMEOUT
+                ) as response:
+                    response.raise_for_status()
+                    entry = (await response.json()).get(prompt_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+                logger.debug("History lookup for %s on %s failed: %s", prompt_id, self.server, e)
+                continue
+            if not entry:
+                # Still queued or running; its events keep coming on the new connection
+                continue
+            logger.info("Prompt %s finished while disconnected from %s; recovered from /history", prompt_id, self.server)
+            watch.finished = True
+            now = time.time()
+            for msg_type, msg_data in (entry.get("status") or {}).get("messages", []):
+                if msg_type in ("execution_error", "execution_interrupted"):
+                    watch.put(msg_type, msg_data, now)
+            watch.put("executing", {"node": None, "prompt_id": prompt_id}, now)
+
+    async def close(self):
+        self.closed = True
+        if self.close_handle is not None:
+            self.close_handle.cancel()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self._fail_watches(ConnectionError(f"Connection to {self.server} closed"))
+        try:
+            if self.ws is not None:
+                await self.ws.close()
+        except Exception as e:
+            logger.debug("Error closing WebSocket: %s", e)
+        if self.session is not None:
+            await self.session.close()
+
+
+class ConnectionPool:
+    """
+    ServerConnection per server address, shared by every client in the event loop.
+    A connection is closed IDLE_CLOSE seconds after its last client releases it.
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    async def acquire(self, server):
+        conn = self.connections.get(server)
+        if conn is None or conn.closed or conn.loop is not asyncio.get_running_loop():
+            conn = self.connections[server] = ServerConnection(server)
+        conn.refs += 1
+        if conn.close_handle is not None:
+            conn.close_handle.cancel()
+            conn.close_handle = None
+        try:
+            await conn.start()
+        except BaseException:
+            self.release(conn)
+            raise
+        return conn
+
+    def release(self, conn):
+        conn.refs -= 1
+        if conn.refs <= 0 and not conn.closed:
+            conn.close_handle = conn.loop.call_later(
+                IDLE_CLOSE, lambda: asyncio.ensure_future(self._close_idle(conn))
+            )
+
+    async def _close_idle(self, conn):
+        if conn.refs > 0 or conn.closed:
+            return
+        if self.connections.get(conn.server) is conn:
+            del self.connections[conn.server]
+        await conn.close()
+
+    def status(self):
+        return {
+            server: {
+                "connected": conn.connected.is_set(),
+                "clients": conn.refs,
+                "watching": len(conn.watches),
+                "reconnects": max(0, conn.generation - 1),
+            }
+            for server, conn in self.connections.items()
+        }
+
+    async def close_all(self):
+        connections = list(self.connections.values())
+        self.connections.clear()
+        for conn in connections:
+            await conn.close()
+
+
+# Shared by every ComfyUIClientAsync
+connections = ConnectionPool()
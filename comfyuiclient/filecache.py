@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+
+
+class FileCache:
+    """
+    In-memory cache of small files (workflows, templates, index.html) keyed by path.
+
+    An entry is reused while the file's mtime and size are unchanged, so edits
+    made outside the server are picked up on the next read without a restart.
+    Values derived from a file (its API-format conversion, scan results) are
+    stored with the entry and dropped together with it.
+
+    Returned objects are shared between callers and must not be mutated;
+    WorkflowManager.inject_variables() deep-copies, so it is safe to pass them on.
+    """
+
+    def __init__(self):
+        self.entries = {}  # abspath -> {"stamp", "raw", "json", "derived"}
+        self.lock = threading.Lock()
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry["stamp"] == stamp:
+                return entry
+        with open(path, "rb") as f:
+            raw = f.read()
+        entry = {"stamp": stamp, "raw": raw, "json": None, "derived": {}}
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def get_bytes(self, path):
+        """File content as bytes; raises FileNotFoundError like open()"""
+        return self._entry(path)["raw"]
+
+    def get_json(self, path):
+        """Parsed JSON content of the file"""
+        entry = self._entry(path)
+        if entry["json"] is None:
+            entry["json"] = json.loads(entry["raw"].decode("utf-8"))
+        return entry["json"]
+
+    def derive(self, path, name, func):
+        """Return func(parsed JSON), computed once per file version and cached under `name`"""
+        entry = self._entry(path)
+        if name not in entry["derived"]:
+            if entry["json"] is None:
+                entry["json"] = json.loads(entry["raw"].decode("utf-8"))
+            entry["derived"][name] = func(entry["json"])
+        return entry["derived"][name]
+
+    def invalidate(self, path):
+        """Forget a file, e.g. after the server wrote or deleted it"""
+        with self.lock:
+            self.entries.pop(os.path.abspath(path), None)
+
+
+# Shared by the server handlers and the CLI
+file_cache = FileCache()
@@ -0,0 +1,366 @@
+"""
+SQLite-backed queue of batch rows shared by the coordinator and workers.
+
+The web server (coordinator) enqueues a batch's rows and collects finished
+ones; any number of `run.py worker` processes, on this host or on others
+that see the same file, claim rows, run them and report back. Claims are
+leases: a worker that dies stops renewing them and its rows go back to the
+queue once the lease expires. Failed rows are retried with backoff up to the
+batch's max_retries. Only the standard library is used.
+"""
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_LEASE = 120.0
+INSERT_CHUNK = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    spec TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'running',
+    total INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+    batch_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    inputs TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    collected INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (batch_id, idx)
+);
+CREATE INDEX IF NOT EXISTS rows_status ON rows (status, not_before);
+CREATE INDEX IF NOT EXISTS rows_collect ON rows (batch_id, collected, status);
+"""
+
+# Row states; "done" and "error" are final and wait for the coordinator to collect them
+PENDING, RUNNING, DONE, ERROR, CANCELLED = "pending", "running", "done", "error", "cancelled"
+
+
+def _locked(method):
+    # The coordinator calls in from asyncio.to_thread workers; one call at a time per connection
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _lost_row(index, inputs, error, attempts):
+    """Row record (as batchrun.error_row builds) of a row whose workers kept dying"""
+    return {
+        "index": index,
+        "inputs": inputs,
+        "status": "error",
+        "error": error,
+        "error_type": "LeaseExpired",
+        "attempts": attempts,
+        "outputs": [],
+    }
+
+
+class JobQueue:
+    """
+    Batch rows in a SQLite file. Every method is a short transaction; WAL mode lets
+    readers and writers from several processes proceed concurrently. A method can
+    still wait up to 30s for another process's write lock, so the coordinator calls
+    them through asyncio.to_thread; calls from several threads are serialized.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.specs = {}
+        self.lock = threading.RLock()
+
+    @_locked
+    def close(self):
+        self.db.close()
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same row
+        self.db.execute("BEGIN IMMEDIATE")
+
+    @_locked
+    def create_batch(self, batch_id, spec, rows, priority=0):
+        """
+        Enqueue a batch. spec holds everything a worker needs besides the row
+        (workflow, servers, retry settings, ...); rows is an iterable of (index, inputs).
+        Returns the number of rows enqueued.
+        """
+        total = 0
+        self._transaction()
+        try:
+            self.db.execute(
+                "INSERT INTO batches (batch_id, spec, priority, created) VALUES (?, ?, ?, ?)",
+                (batch_id, json.dumps(spec), priority, time.time()),
+            )
+            chunk = []
+            for index, inputs in rows:
+                chunk.append((batch_id, index, json.dumps(inputs)))
+                if len(chunk) >= INSERT_CHUNK:
+                    self.db.executemany("INSERT INTO rows (batch_id, idx, inputs) VALUES (?, ?, ?)", chunk)
+                    total += len(chunk)
+                    chunk = []
+            if chunk:
+                self.db.executemany("INSERT INTO rows (batch_id, idx, inputs) VALUES (?, ?, ?)", chunk)
+                total += len(chunk)
+            self.db.execute("UPDATE batches SET total = ? WHERE batch_id = ?", (total, batch_id))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return total
+
+    @_locked
+    def get_spec(self, batch_id):
+        spec = self.specs.get(batch_id)
+        if spec is None:
+            row = self.db.execute("SELECT spec FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            spec = self.specs[batch_id] = json.loads(row[0])
+        return spec
+
+    @_locked
+    def claim(self, worker_id, lease=DEFAULT_LEASE):
+        """
+        Lease the next runnable row: highest batch priority first, then oldest batch,
+        then row index. Rows whose lease expired (dead worker) are taken over, unless
+        they already had max_retries + 1 attempts: a row that keeps killing its worker
+        (a crash, an OOM) is failed instead of being passed around the fleet forever.
+        Returns {"batch_id", "index", "inputs", "attempt", "spec"} or None.
+        """
+        now = time.time()
+        self._transaction()
+        try:
+            while True:
+                row = self.db.execute(
+                    """
+                    SELECT r.batch_id, r.idx, r.inputs, r.attempts, r.status FROM rows r
+                    JOIN batches b ON b.batch_id = r.batch_id
+                    WHERE b.status = 'running' AND (
+                        (r.status = 'pending' AND r.not_before <= ?)
+                        OR (r.status = 'running' AND r.lease_until < ?)
+                    )
+                    ORDER BY b.priority DESC, b.created, r.idx
+                    LIMIT 1
+                    """,
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    self.db.execute("COMMIT")
+                    return None
+                batch_id, index, inputs, attempts, status = row
+                if status == PENDING or attempts <= (self.get_spec(batch_id) or {}).get("max_retries", 0):
+                    break
+                record = _lost_row(index, json.loads(inputs), f"Worker lost its lease on all {attempts} attempt(s)", attempts)
+                self.db.execute(
+                    "UPDATE rows SET status = ?, result = ?, worker = NULL, lease_until = NULL "
+                    "WHERE batch_id = ? AND idx = ?",
+                    (ERROR, json.dumps(record, ensure_ascii=False), batch_id, index),
+                )
+            self.db.execute(
+                "UPDATE rows SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE batch_id = ? AND idx = ?",
+                (RUNNING, worker_id, now + lease, batch_id, index),
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return {
+            "batch_id": batch_id,
+            "index": index,
+            "inputs": json.loads(inputs),
+            "attempt": attempts + 1,
+            "spec": self.get_spec(batch_id),
+        }
+
+    @_locked
+    def renew(self, worker_id, lease=DEFAULT_LEASE):
+        """Extend the leases of every row this worker is running"""
+        self.db.execute(
+            "UPDATE rows SET lease_until = ? WHERE worker = ? AND status = ?",
+            (time.time() + lease, worker_id, RUNNING),
+        )
+
+    @_locked
+    def cancelled_batches(self, worker_id):
+        """IDs of cancelled batches that this worker is still running rows of"""
+        return [batch_id for (batch_id,) in self.db.execute(
+            "SELECT DISTINCT r.batch_id FROM rows r JOIN batches b ON b.batch_id = r.batch_id "
+            "WHERE r.worker = ? AND r.status = ? AND b.status = 'cancelled'",
+            (worker_id, RUNNING),
+        ).fetchall()]
+
+    @_locked
+    def complete(self, worker_id, batch_id, index, result):
+        """Store a row's result; ignored if the lease was lost to another worker"""
+        self.db.execute(
+            "UPDATE rows SET status = ?, result = ?, lease_until = NULL "
+            "WHERE batch_id = ? AND idx = ? AND worker = ? AND status = ?",
+            (DONE, json.dumps(result, ensure_ascii=False), batch_id, index, worker_id, RUNNING),
+        )
+
+    @_locked
+    def fail(self, worker_id, batch_id, index, result, retry_delay=None):
+        """
+        Record a failed attempt: requeue the row after retry_delay seconds,
+        or mark it as failed for good when retry_delay is None.
+        """
+        if retry_delay is None:
+            self.db.execute(
+                "UPDATE rows SET status = ?, result = ?, lease_until = NULL "
+                "WHERE batch_id = ? AND idx = ? AND worker = ? AND status = ?",
+                (ERROR, json.dumps(result, ensure_ascii=False), batch_id, index, worker_id, RUNNING),
+            )
+        else:
+            self.db.execute(
+                "UPDATE rows SET status = ?, worker = NULL, lease_until = NULL, not_before = ? "
+                "WHERE batch_id = ? AND idx = ? AND worker = ? AND status = ?",
+                (PENDING, time.time() + retry_delay, batch_id, index, worker_id, RUNNING),
+            )
+
+    @_locked
+    def cancel(self, batch_id):
+        """Stop handing out the batch's rows; rows already running finish normally"""
+        self._transaction()
+        try:
+            self.db.execute("UPDATE batches SET status = 'cancelled' WHERE batch_id = ?", (batch_id,))
+            self.db.execute(
+                "UPDATE rows SET status = ? WHERE batch_id = ? AND status = ?",
+                (CANCELLED, batch_id, PENDING),
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    @_locked
+    def collect(self, batch_id, limit=500):
+        """Return up to `limit` finished rows not collected yet, as (index, status, attempts, result)"""
+        self._transaction()
+        try:
+            rows = self.db.execute(
+                "SELECT idx, status, attempts, result FROM rows "
+                "WHERE batch_id = ? AND collected = 0 AND status IN (?, ?) LIMIT ?",
+                (batch_id, DONE, ERROR, limit),
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE rows SET collected = 1 WHERE batch_id = ? AND idx = ?",
+                [(batch_id, r[0]) for r in rows],
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return [(idx, status, attempts, json.loads(result)) for idx, status, attempts, result in rows]
+
+    @_locked
+    def counts(self, batch_id):
+        """Number of rows per status for a batch"""
+        return dict(self.db.execute(
+            "SELECT status, COUNT(*) FROM rows WHERE batch_id = ? GROUP BY status", (batch_id,)
+        ).fetchall())
+
+    @_locked
+    def live_leases(self, batch_id):
+        """Rows of the batch still being worked on under an unexpired lease"""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM rows WHERE batch_id = ? AND status = ? AND lease_until >= ?",
+            (batch_id, RUNNING, time.time()),
+        ).fetchone()[0]
+
+    @_locked
+    def has_uncollected(self, batch_id):
+        return self.db.execute(
+            "SELECT 1 FROM rows WHERE batch_id = ? AND collected = 0 AND status IN (?, ?) LIMIT 1",
+            (batch_id, DONE, ERROR),
+        ).fetchone() is not None
+
+    @_locked
+    def workers(self):
+        """Rows currently leased per worker ID"""
+        return dict(self.db.execute(
+            "SELECT worker, COUNT(*) FROM rows WHERE status = ? GROUP BY worker", (RUNNING,)
+        ).fetchall())
+
+    @_locked
+    def finish_batch(self, batch_id, status):
+        self.db.execute("UPDATE batches SET status = ? WHERE batch_id = ?", (status, batch_id))
+
+
+class QueuedBatchHandle:
+    """
+    Coordinator side of a batch run through the JobQueue.
+
+    Mirrors BatchHandle (cancel(), wait(), done, cancelled, completed, failed):
+    it polls the queue for rows finished by workers, passes each row record to
+    on_row(record) and resolves `done` once no row is pending or running.
+    """
+
+    def __init__(self, queue, batch_id, on_row, poll_interval=0.5):
+        self.queue = queue
+        self.batch_id = batch_id
+        self.on_row = on_row
+        self.poll_interval = poll_interval
+        self.cancelled = False
+        self.completed = 0
+        self.failed = 0
+        self.done = asyncio.get_event_loop().create_future()
+        self.task = asyncio.ensure_future(self._poll())
+
+    def cancel(self):
+        self.cancelled = True
+        self.queue.cancel(self.batch_id)
+
+    async def wait(self):
+        return await self.done
+
+    def _outstanding(self):
+        if self.cancelled:
+            # Rows of a cancelled batch are not re-leased, so only live leases still count
+            return self.queue.live_leases(self.batch_id)
+        counts = self.queue.counts(self.batch_id)
+        return counts.get(PENDING, 0) + counts.get(RUNNING, 0)
+
+    async def _poll(self):
+        # Queue calls can wait for another process's write lock, so they run off the event loop
+        try:
+            while True:
+                outstanding = await asyncio.to_thread(self._outstanding)
+                for index, status, attempts, record in await asyncio.to_thread(self.queue.collect, self.batch_id):
+                    if status == DONE:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    self.on_row(record)
+                if outstanding == 0 and not await asyncio.to_thread(self.queue.has_uncollected, self.batch_id):
+                    await asyncio.to_thread(
+                        self.queue.finish_batch, self.batch_id, "cancelled" if self.cancelled else "finished"
+                    )
+                    self.done.set_result(self.completed)
+                    return
+                await asyncio.sleep(self.poll_interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.done.done():
+                self.done.set_exception(e)
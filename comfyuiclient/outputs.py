@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+ROWS_FILE = "rows.jsonl"
+INDEX_FILE = "index.json"
+PROGRESS_FILE = "progress.jsonl"
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif'}
+
+
+def image_extension(data, default=".png"):
+    """File extension for encoded image bytes, from their magic number"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return ".png"
+    if data[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if data[:2] == b"BM":
+        return ".bmp"
+    return default
+
+
+def _write_atomic(path, write, binary):
+    # A unique temp file per writer, so concurrent writers never share or remove each other's
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        # mkstemp creates the file private (0600); outputs are read by other processes and users
+        os.chmod(tmp_path, 0o644)
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8")) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, data):
+    """Write JSON to a temp file and rename it over path, so readers never see a partial file"""
+    _write_atomic(path, lambda f: json.dump(data, f, indent=2), binary=False)
+
+
+def write_bytes_atomic(path, data):
+    """Write bytes to a temp file and rename it over path, so a crash never leaves a partial output"""
+    _write_atomic(path, lambda f: f.write(data), binary=True)
+
+
+def content_hash(data):
+    """Short stable hash of JSON-serializable data (row inputs, workflows)"""
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class RunProgress:
+    """
+    Progress manifest of a CLI run, progress.jsonl in its output directory.
+
+    The first line records the workflow hash and total; each completed row appends
+    {"index", "key", "outputs"}, where key hashes the row's inputs and outputs are
+    paths relative to the output directory. Outputs are written atomically before
+    their row is recorded, so a recorded row is complete. With resume=True rows
+    already recorded for the same workflow are reported done by is_done();
+    otherwise the manifest starts over.
+    """
+
+    def __init__(self, out_dir, workflow, total, resume=False):
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, PROGRESS_FILE)
+        self.workflow_hash = content_hash(workflow)
+        self.done = {}  # index -> {"key", "outputs"}
+        os.makedirs(out_dir, exist_ok=True)
+        if resume and self._load():
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self._write({"workflow": self.workflow_hash, "total": total, "created": time.time()})
+
+    def _load(self):
+        """Read completed rows; False if there is no usable manifest for this workflow"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+        if not lines:
+            return False
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            return False
+        if header.get("workflow") != self.workflow_hash:
+            logger.warning("Workflow changed since %s was written; running all rows again", self.path)
+            return False
+        for line in lines[1:]:
+            # A line cut off by a crash is not a completed row
+            if not line.endswith("\n"):
+                break
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self.done[entry["index"]] = entry
+        if lines[-1] and not lines[-1].endswith("\n"):
+            # Drop the partial line so new rows start on a line of their own
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.writelines(lines[:-1])
+        return True
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def is_done(self, index, inputs):
+        """True if the row was completed with the same inputs and its outputs are still there"""
+        entry = self.done.get(index)
+        if entry is None or entry["key"] != content_hash(inputs):
+            return False
+        return all(os.path.exists(os.path.join(self.out_dir, o)) for o in entry["outputs"])
+
+    def add(self, index, inputs, outputs):
+        """Record a completed row; outputs are file paths, relative to out_dir or absolute below it"""
+        outputs = [os.path.relpath(o, self.out_dir) for o in outputs]
+        entry = {"index": index, "key": content_hash(inputs), "outputs": outputs}
+        self.done[index] = entry
+        self._write(entry)
+
+    def close(self):
+        self.file.close()
+
+
+class JobManifest:
+    """
+    Per-job record of a batch run, stored inside the job output directory.
+
+    manifest.json holds the job summary and is rewritten only on start and finish.
+    rows.jsonl gets one line per finished row (inputs, output files, timings),
+    appended as rows complete so large batches never rewrite the whole list.
+    Per-node execution time from row timelines is summed into meta["node_time"].
+    """
+
+    def __init__(self, job_dir, job_id, **meta):
+        self.job_dir = job_dir
+        self.job_id = job_id
+        self.meta = {
+            "job_id": job_id,
+            "created": time.time(),
+            "finished": None,
+            "status": "running",
+            "completed": 0,
+            "failed": 0,
+            "file_count": 0,
+            "node_time": {},
+        }
+        self.meta.update(meta)
+        os.makedirs(job_dir, exist_ok=True)
+        self._write_meta()
+
+    @property
+    def rows_path(self):
+        return os.path.join(self.job_dir, ROWS_FILE)
+
+    def _write_meta(self):
+        write_json_atomic(os.path.join(self.job_dir, MANIFEST_FILE), self.meta)
+
+    def add_row(self, row):
+        """Append a finished (or failed, status "error") row and update the running counters"""
+        with open(self.rows_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        if row.get("status") == "error":
+            self.meta["failed"] += 1
+            return
+        self.meta["completed"] += 1
+        self.meta["file_count"] += sum(
+            1 for o in row.get("outputs", []) if o.get("filename")
+        )
+        node_time = self.meta["node_time"]
+        for node_id, node in (row.get("timeline") or {}).get("nodes", {}).items():
+            if node.get("duration") is not None:
+                node_time[node_id] = node_time.get(node_id, 0) + node["duration"]
+
+    def finish(self, status="completed"):
+        self.meta["status"] = status
+        self.meta["finished"] = time.time()
+        self._write_meta()
+
+    @staticmethod
+    def load(job_dir):
+        """Load a job manifest summary, or None for legacy directories without one"""
+        try:
+            with open(os.path.join(job_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def read_raw_rows(job_dir, offset=0):
+        """
+        Yield (next_offset, line) for each complete line of rows.jsonl after byte `offset`.
+        A line still being written is left for the next call, so readers can follow
+        a running job by passing the last next_offset back in.
+        """
+        try:
+            f = open(os.path.join(job_dir, ROWS_FILE), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                offset += len(line)
+                if line.strip():
+                    yield offset, line
+
+    @staticmethod
+    def iter_rows(job_dir, start=0):
+        """Yield (line_index, row) from rows.jsonl starting at line `start`"""
+        try:
+            f = open(os.path.join(job_dir, ROWS_FILE), "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for i, line in enumerate(f):
+                if i < start or not line.strip():
+                    continue
+                yield i, json.loads(line)
+
+
+class OutputIndex:
+    """
+    Top-level index of all output jobs, kept in memory and mirrored to index.json.
+
+    Listing queries are answered from memory, so the outputs directory is only
+    scanned once when the index file does not exist yet (e.g. for older data).
+    Changes made from the event loop are written in a background thread, several
+    at once if they come in while a write is running; flush() waits for them.
+    """
+
+    SORT_KEYS = ("created", "job_id", "workflow_name", "completed", "file_count")
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, INDEX_FILE)
+        self.jobs = {}
+        self._dirty = False
+        self._save_task = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f)
+        except FileNotFoundError:
+            self.rebuild()
+        except json.JSONDecodeError:
+            logger.warning("Output index is corrupt, rebuilding: %s", self.path)
+            self.rebuild()
+
+    def rebuild(self):
+        """Scan the outputs directory once and build the index from manifests or file listings"""
+        self.jobs = {}
+        for d in os.listdir(self.root):
+            job_dir = os.path.join(self.root, d)
+            if not os.path.isdir(job_dir):
+                continue
+            entry = JobManifest.load(job_dir)
+            if entry is None:
+                files = [f for f in os.listdir(job_dir)
+                         if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+                entry = {
+                    "job_id": d,
+                    "created": os.path.getmtime(job_dir),
+                    "finished": None,
+                    "status": "unknown",
+                    "workflow_name": None,
+                    "completed": None,
+                    "file_count": len(files),
+                }
+            self.jobs[d] = entry
+        self.save()
+
+    def save(self):
+        write_json_atomic(self.path, self.jobs)
+
+    def _changed(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_in_background())
+
+    async def _save_in_background(self):
+        while self._dirty:
+            self._dirty = False
+            # Entries are replaced, never modified, so a shallow copy is a consistent snapshot
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, dict(self.jobs))
+            except OSError as e:
+                logger.warning("Failed to write output index %s: %s", self.path, e)
+
+    async def flush(self):
+        """Wait until every change made so far is written"""
+        while self._save_task is not None and not self._save_task.done():
+            await self._save_task
+
+    def upsert(self, entry):
+        self.jobs[entry["job_id"]] = dict(entry)
+        self._changed()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def remove(self, job_id):
+        if self.jobs.pop(job_id, None) is not None:
+            self._changed()
+
+    def query(self, workflow=None, sort="created", order="desc", offset=0, limit=None):
+        """
+        Filter, sort and paginate indexed jobs.
+        Returns (total_matching, page_items).
+        """
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        items = self.jobs.values()
+        if workflow:
+            items = [j for j in items if j.get("workflow_name") == workflow]
+
+        def sort_key(job):
+            # None sorts before any value so legacy entries don't break ordering
+            value = job.get(sort)
+            return (value is not None, value if value is not None else 0, job["job_id"])
+
+        items = sorted(items, key=sort_key, reverse=(order == "desc"))
+        total = len(items)
+        end = None if limit is None else offset + limit
+        return total, items[offset:end]
@@ -0,0 +1,188 @@
+"""
+Client-side preprocessing of image inputs before they are uploaded to ComfyUI.
+
+Templates declare it with a "preprocess" entry, either on the template itself
+(applies to every image input) or on a single variable:
+
+    {"max_dimension": 1024, "format": "jpeg", "quality": 90, "exif_transpose": true}
+
+max_dimension   longest side in pixels; larger images are downscaled, smaller ones kept
+format          "jpeg", "png", "webp" or "original" (keep the source format)
+quality         JPEG/WEBP quality, 1-95
+exif_transpose  rotate according to the EXIF orientation tag and drop it
+
+Work runs in a process pool so decoding large camera images does not block
+the event loop. Results are cached on disk by (source hash, spec), so the
+same image used by many rows or batches is processed and stored only once.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+SPEC_KEYS = ("max_dimension", "format", "quality", "exif_transpose")
+FORMATS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+DEFAULT_CACHE_DIR = os.environ.get(
+    "COMFY_PREPROCESS_CACHE", os.path.join(tempfile.gettempdir(), "comfyui_preprocess")
+)
+HASH_CHUNK_SIZE = 1024 * 1024
+EXIF_ORIENTATION = 0x0112
+
+
+def normalize_spec(spec):
+    """Validate a preprocess spec and fill in defaults; returns None if there is nothing to do"""
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError("preprocess must be an object")
+    unknown = set(spec) - set(SPEC_KEYS)
+    if unknown:
+        raise ValueError(f"preprocess: unknown option(s) {', '.join(sorted(unknown))}")
+    fmt = str(spec.get("format", "original")).lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt != "original" and fmt not in FORMATS:
+        raise ValueError(f"preprocess: unsupported format '{fmt}'")
+    max_dimension = spec.get("max_dimension")
+    if max_dimension is not None:
+        max_dimension = int(max_dimension)
+        if max_dimension <= 0:
+            raise ValueError("preprocess: max_dimension must be positive")
+    quality = int(spec.get("quality", 90))
+    if not 1 <= quality <= 95:
+        raise ValueError("preprocess: quality must be between 1 and 95")
+    return {
+        "max_dimension": max_dimension,
+        "format": fmt,
+        "quality": quality,
+        "exif_transpose": bool(spec.get("exif_transpose", True)),
+    }
+
+
+def spec_for(preprocess, key):
+    """
+    Pick the spec that applies to variable `key` from a request/template "preprocess" value:
+    either a single spec for all image inputs or a mapping of variable id -> spec.
+    """
+    if not preprocess or not isinstance(preprocess, dict):
+        return None
+    if any(k in SPEC_KEYS for k in preprocess):
+        return preprocess
+    return preprocess.get(key)
+
+
+def validate_preprocess(preprocess):
+    """Raise ValueError if any spec in a "preprocess" value (see spec_for) is invalid"""
+    if preprocess and isinstance(preprocess, dict) and not any(k in SPEC_KEYS for k in preprocess):
+        for spec in preprocess.values():
+            normalize_spec(spec)
+    else:
+        normalize_spec(preprocess)
+
+
+def template_preprocess(template):
+    """Collect the preprocess specs declared in a template as {variable id: spec} (or one shared spec)"""
+    per_variable = {
+        v["id"]: v["preprocess"] for v in template.get("variables", [])
+        if v.get("id") and v.get("preprocess")
+    }
+    shared = template.get("preprocess")
+    if not per_variable:
+        return shared
+    if shared:
+        for v in template.get("variables", []):
+            if v.get("type") == "image" and v.get("id") not in per_variable:
+                per_variable[v["id"]] = shared
+    return per_variable
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def process_image(path, spec, cache_dir):
+    """
+    Preprocess one image file according to a normalized spec (runs in a worker process).
+    Returns (output_path, source_size, output_size); output_path is the cached result.
+    """
+    spec_key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+    source_hash = _file_sha256(path)
+    ext = FORMATS.get(spec["format"]) or os.path.splitext(path)[1].lower() or ".png"
+    out_path = os.path.join(cache_dir, f"{source_hash[:24]}_{spec_key}{ext}")
+    source_size = os.path.getsize(path)
+    if os.path.exists(out_path):
+        return out_path, source_size, os.path.getsize(out_path)
+
+    with Image.open(path) as img:
+        pil_format = img.format
+        changed = False
+        if spec["exif_transpose"] and img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            img = ImageOps.exif_transpose(img)
+            changed = True
+        if spec["max_dimension"] and max(img.size) > spec["max_dimension"]:
+            img.thumbnail((spec["max_dimension"], spec["max_dimension"]), Image.LANCZOS)
+            changed = True
+        save_format = pil_format if spec["format"] == "original" else spec["format"].upper()
+        if save_format == "MPO":
+            # Multi-picture JPEGs from cameras; PIL cannot write them back
+            save_format = "JPEG"
+        save_kwargs = {}
+        if save_format in ("JPEG", "WEBP"):
+            save_kwargs["quality"] = spec["quality"]
+        if save_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, format=save_format, **save_kwargs)
+    output_size = os.path.getsize(tmp_path)
+    if not changed and output_size >= source_size:
+        # Re-encoding alone didn't make it smaller (e.g. a tiny PNG), upload the original
+        os.remove(tmp_path)
+        return path, source_size, source_size
+    os.replace(tmp_path, out_path)
+    return out_path, source_size, output_size
+
+
+class InputPreprocessor:
+    """
+    Runs process_image() in a process pool and remembers results per
+    (path, mtime, size, spec) so unchanged files are not even re-hashed.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_workers=None):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.executor = None
+        self.results = {}
+
+    async def process(self, path, spec):
+        """Return (path to upload, source_size, output_size) for `path` under `spec`"""
+        spec = normalize_spec(spec)
+        if spec is None:
+            size = os.path.getsize(path)
+            return path, size, size
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, json.dumps(spec, sort_keys=True))
+        cached = self.results.get(key)
+        if cached is not None and os.path.exists(cached[0]):
+            return cached
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        result = await asyncio.get_event_loop().run_in_executor(
+            self.executor, process_image, path, spec, self.cache_dir
+        )
+        self.results[key] = result
+        return result
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,287 @@
+"""
+Age and size quotas for the server's data directories.
+
+Each RetentionArea is a directory whose top-level entries (job directories in
+data/outputs, files in data/uploads, ...) are evicted least recently used
+first: entries older than max_age go, then the oldest ones until the area fits
+in max_bytes. A free-space watermark (min_free_bytes) evicts across all areas
+by age when the disk itself runs low. Recency is the entry's mtime, so
+touch() an entry when it is reused to keep it.
+
+RemoteUploads tracks the file names uploaded to ComfyUI's input folder.
+ComfyUI has no API to delete them, so names that no running row references
+any more are deleted when the input folder is reachable from this host (a
+local or shared ComfyUI installation), and otherwise logged once and dropped.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 600.0
+# Entries younger than this are never evicted, so files a request is still writing survive
+DEFAULT_GRACE = 3600.0
+
+GB = 1024 ** 3
+DAY = 86400
+
+
+def entry_size(path):
+    """Size in bytes of a file, or of every file below a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+
+class RetentionArea:
+    """
+    A directory under quota. protect(name) -> bool can veto evicting an entry
+    (a job that is still running, for example).
+    """
+
+    def __init__(self, name, path, max_age=None, max_bytes=None, protect=None):
+        self.name = name
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.protect = protect
+        self.sizes = {}  # entry name -> (mtime_ns, size), so unchanged job directories aren't re-walked
+
+    def entries(self, now, grace):
+        """(mtime, size, name) of the evictable entries, oldest first, and the area's total size"""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return [], 0
+        result = []
+        total = 0
+        sizes = {}
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            cached = self.sizes.get(name)
+            if cached is not None and cached[0] == st.st_mtime_ns:
+                size = cached[1]
+            else:
+                size = entry_size(path)
+            sizes[name] = (st.st_mtime_ns, size)
+            total += size
+            if now - st.st_mtime < grace or (self.protect is not None and self.protect(name)):
+                continue
+            result.append((st.st_mtime, size, name))
+        self.sizes = sizes
+        result.sort()
+        return result, total
+
+    def evict(self, name):
+        path = os.path.join(self.path, name)
+        try:
+            remove_entry(path)
+        except FileNotFoundError:
+            pass
+        self.sizes.pop(name, None)
+
+
+class RemoteUploads:
+    """
+    Ledger of names uploaded to ComfyUI input folders, in a JSON-lines file.
+    Rows acquire() the names they upload and release() them when they finish;
+    names that are released and older than the grace period are unreferenced.
+    """
+
+    def __init__(self, ledger_path, input_dir=None):
+        self.ledger_path = ledger_path
+        self.input_dir = input_dir
+        self.refs = Counter()
+        self.lock = threading.Lock()
+
+    def acquire(self, server, name):
+        with self.lock:
+            self.refs[(server, name)] += 1
+            with open(self.ledger_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"server": server, "name": name, "time": time.time()}) + "\n")
+
+    def release(self, server, names):
+        with self.lock:
+            for name in names:
+                key = (server, name)
+                self.refs[key] -= 1
+                if self.refs[key] <= 0:
+                    del self.refs[key]
+
+    def _load(self):
+        entries = {}
+        try:
+            with open(self.ledger_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries[(entry["server"], entry["name"])] = entry
+        except FileNotFoundError:
+            pass
+        return list(entries.values())
+
+    def sweep(self, now, grace):
+        """
+        Delete unreferenced names from input_dir when it is set and compact the ledger.
+        Without input_dir they are logged and dropped from the ledger, so each is reported once.
+        Returns {"deleted": n, "unreferenced": [entries left on the servers]}.
+        """
+        with self.lock:
+            entries = self._load()
+            keep = []
+            unreferenced = []
+            deleted = 0
+            for entry in entries:
+                if (entry["server"], entry["name"]) in self.refs or now - entry["time"] < grace:
+                    keep.append(entry)
+                    continue
+                if self.input_dir:
+                    try:
+                        os.remove(os.path.join(self.input_dir, os.path.basename(entry["name"])))
+                        deleted += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logger.warning("Could not delete ComfyUI input %s: %s", entry["name"], e)
+                        keep.append(entry)
+                        unreferenced.append(entry)
+                else:
+                    unreferenced.append(entry)
+            if unreferenced and not self.input_dir:
+                logger.info("%d ComfyUI input(s) are no longer used and can be deleted: %s", len(unreferenced),
+                            ", ".join(f"{entry['server']}: {entry['name']}" for entry in unreferenced))
+            if len(keep) != len(entries) or deleted:
+                tmp_path = f"{self.ledger_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for entry in keep:
+                        f.write(json.dumps(entry) + "\n")
+                os.replace(tmp_path, self.ledger_path)
+        return {"deleted": deleted, "unreferenced": unreferenced}
+
+
+class RetentionManager:
+    """
+    Periodically enforces the areas' quotas and the free-space watermark.
+    sweep() does blocking disk work and returns a report listing the evicted
+    entry names per area; run() calls it in a thread every `interval` seconds,
+    or sooner after request_sweep(), and passes each report to on_sweep(report)
+    back on the event loop.
+    """
+
+    def __init__(self, areas, min_free_bytes=None, remote_uploads=None,
+                 interval=DEFAULT_INTERVAL, grace=DEFAULT_GRACE):
+        self.areas = areas
+        self.min_free_bytes = min_free_bytes
+        self.remote_uploads = remote_uploads
+        self.interval = interval
+        self.grace = grace
+        self.last_report = None
+        self.lock = threading.Lock()
+        self.wakeup = None
+
+    @staticmethod
+    def touch(path):
+        """Mark an entry as recently used"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def sweep(self):
+        with self.lock:
+            now = time.time()
+            report = {"time": now, "areas": {}}
+            candidates = []
+            for area in self.areas:
+                entries, total = area.entries(now, self.grace)
+                evicted = []
+                freed = 0
+                for mtime, size, name in entries:
+                    too_old = area.max_age is not None and now - mtime > area.max_age
+                    too_big = area.max_bytes is not None and total - freed > area.max_bytes
+                    if not (too_old or too_big):
+                        candidates.append((mtime, size, name, area))
+                        continue
+                    area.evict(name)
+                    evicted.append(name)
+                    freed += size
+                report["areas"][area.name] = {
+                    "bytes": total - freed,
+                    "evicted": evicted,
+                    "freed": freed,
+                }
+
+            if self.min_free_bytes and self.areas:
+                # Low on disk: keep evicting the least recently used entries of any area
+                free = shutil.disk_usage(self.areas[0].path).free
+                for mtime, size, name, area in sorted(candidates, key=lambda c: c[0]):
+                    if free >= self.min_free_bytes:
+                        break
+                    area.evict(name)
+                    free += size
+                    stats = report["areas"][area.name]
+                    stats["bytes"] -= size
+                    stats["evicted"].append(name)
+                    stats["freed"] += size
+                report["free"] = free
+                if free < self.min_free_bytes:
+                    logger.warning("Only %d bytes free after retention sweep (minimum %d)",
+                                   free, self.min_free_bytes)
+
+            if self.remote_uploads is not None:
+                remote = self.remote_uploads.sweep(now, self.grace)
+                report["remote_uploads"] = {
+                    "deleted": remote["deleted"],
+                    "unreferenced": len(remote["unreferenced"]),
+                }
+
+            for name, stats in report["areas"].items():
+                if stats["evicted"]:
+                    logger.info("Retention evicted %d %s entries (%d bytes)", len(stats["evicted"]), name, stats["freed"])
+            self.last_report = report
+            return report
+
+    def request_sweep(self):
+        """Run the next sweep now instead of waiting for the interval"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self, on_sweep=None):
+        """Background loop; cancel the task to stop it"""
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                report = await asyncio.to_thread(self.sweep)
+                if on_sweep is not None:
+                    on_sweep(report)
+            except Exception:
+                logger.exception("Retention sweep failed")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,445 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from .affinity import group_rows
+from .client import ComfyUIClientAsync
+from .tracing import set_trace_id, span
+
+logger = logging.getLogger(__name__)
+
+# Errors caused by the row's own data; retrying the same row would fail again
+NON_RETRYABLE_ERRORS = (ValueError, FileNotFoundError)
+MAX_RETRY_BACKOFF = 60.0
+
+
+class SubmissionController:
+    """
+    Adaptive window of pending prompts for one ComfyUI backend.
+
+    The target number of prompts we keep submitted-but-unfinished follows
+    AIMD: it grows by one when a prompt started executing almost as soon as
+    it was queued (the GPU was waiting for us), and is halved when prompts
+    wait longer than three execution times in the queue, or when the
+    backend reports more queued prompts than max_pending over the websocket
+    `status` messages (queue_remaining), e.g. because of other tenants.
+    """
+
+    def __init__(self, min_pending=1, max_pending=8, initial_pending=2):
+        self.min_pending = min_pending
+        self.max_pending = max_pending
+        self.target = float(max(min_pending, min(initial_pending, max_pending)))
+        self.in_flight = 0
+        self.queue_remaining = None
+        self.avg_exec = None
+        self.completed = 0
+        self.last_decrease = 0.0
+        self._changed = asyncio.Event()
+
+    def _can_submit(self):
+        if self.in_flight >= int(self.target):
+            return False
+        # Always allow one prompt so we make progress, but don't pile onto a deep queue
+        if self.in_flight > 0 and self.queue_remaining is not None:
+            return self.queue_remaining < self.max_pending
+        return True
+
+    async def acquire(self):
+        while not self._can_submit():
+            self._changed.clear()
+            await self._changed.wait()
+        self.in_flight += 1
+
+    def release(self, timeline=None):
+        """Free a pending slot, adapting the target from the finished prompt's timeline"""
+        self.in_flight -= 1
+        if timeline is not None and timeline.execution_time is not None:
+            self.completed += 1
+            exec_time = timeline.execution_time
+            self.avg_exec = exec_time if self.avg_exec is None else 0.8 * self.avg_exec + 0.2 * exec_time
+            queue_wait = timeline.queue_wait or 0.0
+            if queue_wait > 3 * self.avg_exec:
+                self._decrease()
+            elif queue_wait < 0.1 * self.avg_exec:
+                self.target = min(self.max_pending, self.target + 1)
+        if self.in_flight == 0:
+            # Nobody is listening to this backend any more, the last report goes stale
+            self.queue_remaining = None
+        self._changed.set()
+
+    def _decrease(self):
+        # At most one multiplicative decrease per average execution time
+        now = time.time()
+        if now - self.last_decrease < (self.avg_exec or 1.0):
+            return
+        self.last_decrease = now
+        self.target = max(self.min_pending, self.target / 2)
+
+    def on_event(self, event):
+        """Client event listener: track queue_remaining from `status` messages"""
+        if event["type"] != "status":
+            return
+        exec_info = event["data"].get("status", {}).get("exec_info", {})
+        if "queue_remaining" in exec_info:
+            self.queue_remaining = exec_info["queue_remaining"]
+            if self.queue_remaining > self.max_pending:
+                self._decrease()
+            self._changed.set()
+
+    def status(self):
+        return {
+            "target": self.target,
+            "in_flight": self.in_flight,
+            "queue_remaining": self.queue_remaining,
+            "avg_exec": self.avg_exec,
+            "completed": self.completed,
+        }
+
+
+class BatchHandle:
+    """
+    A batch submitted to the BatchScheduler.
+
+    Rows are pulled lazily from `rows` (an iterable of (index, row) pairs) only
+    when a backend slot is free, so the batch never has to be materialized.
+    A failing row is retried up to `max_retries` times with exponential
+    backoff, preferably on a different backend, and otherwise reported through
+    on_error; it never stops the rest of the batch.
+
+    With affinity (a function row -> model key, see affinity.model_key_func)
+    the rows are read once up front and grouped by key, and each backend is
+    given rows of the group it ran last.
+    """
+
+    def __init__(self, batch_id, rows, run_row, priority=0, backends=None, on_result=None,
+                 on_error=None, max_retries=0, retry_backoff=1.0, row_timeout=None, affinity=None):
+        self.batch_id = batch_id
+        self.rows = iter(rows)
+        self.run_row = run_row
+        self.priority = priority
+        self.backends = backends
+        self.on_result = on_result
+        self.on_error = on_error
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.row_timeout = row_timeout
+        self.affinity = affinity
+        self.groups = None  # affinity key -> deque of (index, row), built on first dispatch
+        self.retries = []  # [{"index", "row", "attempt", "not_before", "failed_on"}]
+        self.clients = set()  # clients running a row of this batch right now
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.exhausted = False
+        self.cancelled = False
+        self.error = None
+        self.last_served = 0
+        self.done = asyncio.get_event_loop().create_future()
+
+    @property
+    def active(self):
+        """Whether the batch may still hand out rows (new ones or retries)"""
+        if self.cancelled or self.error is not None:
+            return False
+        return not self.exhausted or bool(self.retries)
+
+    def cancel(self):
+        """
+        Stop dispatching further rows; rows already running are allowed to finish.
+        BatchScheduler.cancel() also cancels their prompts.
+        """
+        self.cancelled = True
+        self._check_done()
+
+    def _check_done(self):
+        if self.in_flight == 0 and not self.active and not self.done.done():
+            if self.error is not None:
+                self.done.set_exception(self.error)
+            else:
+                self.done.set_result(self.completed)
+
+    async def wait(self):
+        """
+        Wait until every dispatched row has finished or failed for good.
+        Raises only if the rows iterable itself failed.
+        """
+        return await self.done
+
+
+class BatchScheduler:
+    """
+    Owns submission to each ComfyUI backend and shares it between batches.
+
+    Each backend gets up to `max_pending` worker slots, each with its own
+    client (all sharing the backend's websocket); a SubmissionController decides how many of them may have a prompt
+    pending at once. A slot that gets a go-ahead takes the next row from the
+    highest-priority batch that targets its backend; batches with equal
+    priority are served round-robin (least recently served first), so a small
+    batch submitted while a huge one is running gets its rows interleaved
+    instead of waiting behind it.
+    """
+
+    def __init__(self, min_pending=1, max_pending=8, initial_pending=2, client_factory=None):
+        self.min_pending = min_pending
+        self.max_pending = max_pending
+        self.initial_pending = initial_pending
+        self.client_factory = client_factory or (lambda server: ComfyUIClientAsync(server, "dummy.json"))
+        self.batches = []
+        self.workers = {}  # server -> [asyncio.Task]
+        self.wakeup = {}  # server -> asyncio.Event
+        self.controllers = {}  # server -> SubmissionController
+        self.loaded = {}  # server -> affinity key of the last grouped row sent to it
+        self._serve_counter = itertools.count(1)
+
+    def submit(self, batch_id, rows, run_row, priority=0, backends=None, on_result=None,
+               on_error=None, max_retries=0, retry_backoff=1.0, row_timeout=None, affinity=None):
+        """
+        Submit a batch.
+
+        run_row(client, index, row) is awaited for each row on a backend slot and its
+        return value is passed to on_result(index, row, result, attempts).
+        Rows that still fail after max_retries retries (or with a non-retryable error)
+        are passed to on_error(index, row, error, attempts).
+        row_timeout bounds each attempt in seconds.
+        backends is the list of server addresses the batch may run on.
+        affinity(row) -> key groups rows that load the same models (see BatchHandle).
+        """
+        batch = BatchHandle(
+            batch_id, rows, run_row, priority, backends, on_result,
+            on_error, max_retries, retry_backoff, row_timeout, affinity
+        )
+        self.batches.append(batch)
+        for server in backends:
+            self._ensure_workers(server)
+            self.wakeup[server].set()
+        return batch
+
+    async def cancel(self, batch):
+        """
+        Cancel a batch: stop dispatching its rows, delete its prompts still waiting in
+        the ComfyUI queues and interrupt a backend only if the prompt it is running
+        belongs to this batch. Prompts of other batches and other users are untouched.
+        Returns {server: {"deleted": [prompt_ids], "interrupted": prompt_id or None}}.
+        """
+        batch.cancel()
+        by_server = {}
+        for client in batch.clients:
+            by_server.setdefault(client.SERVER_ADDRESS, []).append(client)
+        result = {}
+        for server, clients in by_server.items():
+            prompt_ids = set()
+            for client in clients:
+                client.cancelling = True
+                prompt_ids.update(client.pending_prompts)
+            # Clients of a server share its connection, so a separate one can cancel their prompts
+            canceller = self.client_factory(server)
+            try:
+                await canceller.connect()
+                result[server] = await canceller.cancel_prompts(prompt_ids)
+            except ConnectionError as e:
+                logger.warning("Failed to cancel prompts on %s: %s", server, e)
+                result[server] = {"error": str(e)}
+            finally:
+                await canceller.close()
+        return result
+
+    def status(self):
+        return {
+            "batches": [{
+                "batch_id": b.batch_id,
+                "priority": b.priority,
+                "backends": b.backends,
+                "in_flight": b.in_flight,
+                "completed": b.completed,
+                "failed": b.failed,
+                "retrying": len(b.retries),
+            } for b in self.batches],
+            "backends": {server: c.status() for server, c in self.controllers.items()},
+        }
+
+    def _ensure_workers(self, server):
+        if server in self.workers:
+            return
+        self.wakeup[server] = asyncio.Event()
+        self.controllers[server] = SubmissionController(
+            self.min_pending, self.max_pending, self.initial_pending
+        )
+        self.workers[server] = [
+            asyncio.ensure_future(self._worker(server))
+            for _ in range(self.max_pending)
+        ]
+
+    def _next_task(self, server):
+        """Pick the next (batch, index, row, attempt, failed_on) for a free slot on `server`, or None"""
+        now = time.time()
+        candidates = [b for b in self.batches if b.active and server in b.backends]
+        # Strict priority first, then least recently served for round-robin
+        candidates.sort(key=lambda b: (-b.priority, b.last_served))
+        for batch in candidates:
+            task = self._take_retry(batch, server, now)
+            while task is None and not batch.exhausted:
+                try:
+                    if batch.affinity is not None:
+                        task = self._take_grouped(batch, server)
+                        if task is None:
+                            raise StopIteration
+                    else:
+                        index, row = next(batch.rows)
+                        task = (index, row, 1, ())
+                except StopIteration:
+                    batch.exhausted = True
+                    self._finish_if_done(batch)
+                except Exception as e:
+                    # Failing to produce a row (e.g. a bad sweep spec) fails the batch
+                    batch.error = e
+                    self._finish_if_done(batch)
+                    break
+            if task is None:
+                continue
+            batch.last_served = next(self._serve_counter)
+            batch.in_flight += 1
+            return (batch,) + task
+        return None
+
+    def _take_grouped(self, batch, server):
+        """
+        Next row of an affinity batch for `server`: from the group it ran last if any
+        rows are left, else the first group no other backend of the batch is on,
+        else a share of the largest group. Returns a task tuple or None when empty.
+        """
+        if batch.groups is None:
+            batch.groups = group_rows(batch.rows, batch.affinity)
+        if not batch.groups:
+            return None
+        key = self.loaded.get(server)
+        if key not in batch.groups:
+            taken = {self.loaded.get(other) for other in batch.backends if other != server}
+            free = [k for k in batch.groups if k not in taken]
+            key = free[0] if free else max(batch.groups, key=lambda k: len(batch.groups[k]))
+        rows = batch.groups[key]
+        index, row = rows.popleft()
+        if not rows:
+            del batch.groups[key]
+        self.loaded[server] = key
+        return index, row, 1, ()
+
+    def _take_retry(self, batch, server, now):
+        """Pop a retry that is due and may run on `server`; avoid backends it already failed on"""
+        for i, retry in enumerate(batch.retries):
+            if retry["not_before"] > now:
+                continue
+            others = [b for b in batch.backends if b not in retry["failed_on"]]
+            if server in retry["failed_on"] and others:
+                continue
+            del batch.retries[i]
+            return retry["index"], retry["row"], retry["attempt"], retry["failed_on"]
+        return None
+
+    def _wake(self, batch):
+        for server in batch.backends:
+            if server in self.wakeup:
+                self.wakeup[server].set()
+
+    def _finish_if_done(self, batch):
+        batch._check_done()
+        if batch.done.done() and batch in self.batches:
+            self.batches.remove(batch)
+
+    def _row_failed(self, batch, server, index, row, attempt, failed_on, error):
+        """Schedule a retry with exponential backoff, or report the row as failed"""
+        if batch.cancelled or attempt > batch.max_retries or isinstance(error, NON_RETRYABLE_ERRORS):
+            batch.failed += 1
+            logger.warning("Row %s failed after %d attempt(s): %s", index, attempt, error)
+            if batch.on_error is not None:
+                batch.on_error(index, row, error, attempt)
+            return
+        delay = min(batch.retry_backoff * 2 ** (attempt - 1), MAX_RETRY_BACKOFF)
+        logger.info("Row %s failed on %s (%s), retrying in %.1fs", index, server, error, delay)
+        batch.retries.append({
+            "index": index,
+            "row": row,
+            "attempt": attempt + 1,
+            "not_before": time.time() + delay,
+            "failed_on": tuple(failed_on) + (server,),
+        })
+        asyncio.get_event_loop().call_later(delay, self._wake, batch)
+
+    async def _worker(self, server):
+        controller = self.controllers[server]
+        client = None
+        try:
+            while True:
+                await controller.acquire()
+                task = self._next_task(server)
+                if task is None:
+                    controller.release()
+                    # Cleared before any await, so work arriving while the client
+                    # closes still wakes this worker up
+                    self.wakeup[server].clear()
+                    # Idle: release the shared connection until more work arrives
+                    if client is not None:
+                        await client.close()
+                        client = None
+                    await self.wakeup[server].wait()
+                    continue
+
+                batch, index, row, attempt, failed_on = task
+                # Log records and spans from this row carry the batch ID as trace ID
+                set_trace_id(batch.batch_id)
+                timeline = None
+                row_client = None
+                try:
+                    if client is None:
+                        client = self.client_factory(server)
+                        client.add_event_listener(controller.on_event)
+                        await client.connect()
+                    client.last_timeline = None
+                    client.cancelling = False
+                    row_client = client
+                    batch.clients.add(client)
+                    with span("row", server=server, index=index, attempt=attempt):
+                        if batch.row_timeout:
+                            try:
+                                result = await asyncio.wait_for(
+                                    batch.run_row(client, index, row), batch.row_timeout
+                                )
+                            except asyncio.TimeoutError:
+                                raise TimeoutError(f"Row {index} did not finish within {batch.row_timeout}s")
+                        else:
+                            result = await batch.run_row(client, index, row)
+                    timeline = client.last_timeline
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._row_failed(batch, server, index, row, attempt, failed_on, e)
+                    # Start the next row with a fresh client
+                    if client is not None:
+                        await client.close()
+                        client = None
+                else:
+                    # The row succeeded; a failing on_result must not make it run again
+                    batch.completed += 1
+                    if batch.on_result is not None:
+                        try:
+                            batch.on_result(index, row, result, attempt)
+                        except Exception:
+                            logger.exception("Recording the result of row %s failed", index)
+                finally:
+                    batch.clients.discard(row_client)
+                    controller.release(timeline)
+                    batch.in_flight -= 1
+                    self._finish_if_done(batch)
+        finally:
+            if client is not None:
+                await client.close()
+
+    async def close(self):
+        for tasks in self.workers.values():
+            for task in tasks:
+                task.cancel()
+        for tasks in self.workers.values():
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers.clear()
+        self.wakeup.clear()
+        self.controllers.clear()
@@ -0,0 +1,174 @@
+"""
+Parameter-grid and seed-sweep expansion for batch runs.
+
+A sweep spec describes many batch rows compactly. Keys are anything
+WorkflowManager.inject_variables accepts ("node_id.field" or a **var** name).
+
+    {"3.cfg": [4, 6, 8], "3.steps": {"range": [10, 50, 10]}}
+        cartesian product of the axes (3 x 4 = 12 rows)
+
+    {"zip": {"6.text": ["a cat", "a dog"], "7.image": ["cat.png", "dog.png"]}}
+        axes advance together (2 rows)
+
+    {"3.seed": {"random": 50, "seed": 1234}}
+        50 reproducible random seeds derived from the master seed
+
+    [spec, spec, ...]  or  {"product": [spec, ...]}
+        cartesian product of sub-specs, e.g. a zip group times a seed sweep
+
+Rows are produced lazily by expand_sweep(), so a 10x10x50 grid is never
+materialized; count_sweep() gives the number of rows without expanding.
+"""
+import itertools
+import math
+import random
+
+RANDOM_SEED_MAX = 2 ** 32 - 1
+
+
+def _axis_values(name, axis):
+    """Return a re-iterable sequence of values for one axis"""
+    if isinstance(axis, list):
+        return axis
+    if not isinstance(axis, dict):
+        # A single scalar is a one-value axis
+        return [axis]
+    if "values" in axis:
+        return list(axis["values"])
+    if "range" in axis:
+        bounds = axis["range"]
+        if not isinstance(bounds, list) or not 1 <= len(bounds) <= 3:
+            raise ValueError(f"Sweep axis '{name}': range must be [stop], [start, stop] or [start, stop, step]")
+        if all(isinstance(b, int) for b in bounds):
+            return range(*bounds)
+        return _float_range(name, *bounds)
+    if "random" in axis:
+        count = int(axis["random"])
+        low = int(axis.get("min", 0))
+        high = int(axis.get("max", RANDOM_SEED_MAX))
+        master_seed = axis.get("seed", 0)
+        return _RandomAxis(f"{master_seed}:{name}", count, low, high)
+    raise ValueError(f"Sweep axis '{name}': expected a list, 'values', 'range' or 'random'")
+
+
+def _float_range(name, start, stop=None, step=1.0):
+    if stop is None:
+        start, stop = 0.0, start
+    if step == 0:
+        raise ValueError(f"Sweep axis '{name}': range step must not be 0")
+    # Rounded first so e.g. (0.4 - 0.1) / 0.1 == 3.0000000000000004 doesn't add a value past stop
+    count = max(0, math.ceil(round((stop - start) / step, 9)))
+    # Round to avoid 0.30000000000000004 style values ending up in prompts
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+class _RandomAxis:
+    """Reproducible random integers; re-iterating yields the same sequence"""
+
+    def __init__(self, seed, count, low, high):
+        self.seed = seed
+        self.count = count
+        self.low = low
+        self.high = high
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        for _ in range(self.count):
+            yield rng.randint(self.low, self.high)
+
+
+def _is_group(spec):
+    return isinstance(spec, list) or (
+        isinstance(spec, dict) and len(spec) == 1 and next(iter(spec)) in ("zip", "product")
+    )
+
+
+def expand_sweep(spec):
+    """Lazily yield one dict of values per row described by `spec`"""
+    if isinstance(spec, list):
+        yield from _product_of_specs(spec)
+        return
+    if not isinstance(spec, dict):
+        raise ValueError("Sweep spec must be an object or a list")
+    if _is_group(spec):
+        kind, children = next(iter(spec.items()))
+        if kind == "product":
+            yield from _product_of_specs(children)
+        else:
+            yield from _zip_of(children)
+        return
+    names = list(spec.keys())
+    axes = [_axis_values(name, spec[name]) for name in names]
+    for combo in itertools.product(*axes):
+        yield dict(zip(names, combo))
+
+
+def _product_of_specs(specs):
+    # Recursive instead of itertools.product so sub-specs are re-expanded, not stored
+    if not specs:
+        yield {}
+        return
+    for first in expand_sweep(specs[0]):
+        for rest in _product_of_specs(specs[1:]):
+            row = dict(first)
+            row.update(rest)
+            yield row
+
+
+def _zip_of(children):
+    if isinstance(children, dict):
+        iterators = [expand_sweep({name: axis}) for name, axis in children.items()]
+    else:
+        iterators = [expand_sweep(child) for child in children]
+    for parts in zip(*iterators):
+        row = {}
+        for part in parts:
+            row.update(part)
+        yield row
+
+
+def count_sweep(spec):
+    """Number of rows expand_sweep(spec) yields, computed without expanding; validates the spec"""
+    if isinstance(spec, list):
+        total = 1
+        for child in spec:
+            total *= count_sweep(child)
+        return total
+    if not isinstance(spec, dict):
+        raise ValueError("Sweep spec must be an object or a list")
+    if _is_group(spec):
+        kind, children = next(iter(spec.items()))
+        if kind == "product":
+            return count_sweep(children)
+        if isinstance(children, dict):
+            counts = [len(_axis_values(name, axis)) for name, axis in children.items()]
+        else:
+            counts = [count_sweep(child) for child in children]
+        return min(counts) if counts else 0
+    total = 1
+    for name, axis in spec.items():
+        total *= len(_axis_values(name, axis))
+    return total
+
+
+def iter_batch_rows(rows, sweep=None):
+    """
+    Combine explicit batch rows with a sweep: every row is repeated for each
+    sweep combination, sweep values overriding the row's own.
+    Yields (index, inputs) pairs lazily.
+    """
+    rows = rows or [{}]
+    index = 0
+    for row in rows:
+        if sweep is None:
+            yield index, row
+            index += 1
+            continue
+        for combo in expand_sweep(sweep):
+            inputs = dict(row)
+            inputs.update(combo)
+            yield index, inputs
+            index += 1
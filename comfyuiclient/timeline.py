@@ -0,0 +1,127 @@
+import time
+
+# Websocket message types that describe the execution of a single prompt
+EXECUTION_EVENTS = (
+    "execution_start",
+    "execution_cached",
+    "executing",
+    "progress",
+    "executed",
+    "execution_error",
+    "execution_interrupted",
+    "execution_success",
+)
+
+
+class ExecutionTimeline:
+    """
+    Per-prompt timeline built from ComfyUI websocket events.
+
+    Records queue wait (prompt accepted -> execution_start), per-node start/end
+    and duration, cached nodes, sampler progress with step rate, and errors.
+    """
+
+    def __init__(self, prompt_id, queued_at=None):
+        self.prompt_id = prompt_id
+        self.queued_at = queued_at if queued_at is not None else time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.status = "queued"
+        self.error = None
+        # Set when the websocket reconnected while the prompt ran, so some of its events may be lost
+        self.events_missed = False
+        self.cached_nodes = []
+        self.nodes = {}  # node_id -> {"start", "end", "steps", "max_steps", "last_progress"}
+        self._current_node = None
+
+    def _end_current(self, now):
+        if self._current_node is not None:
+            node = self.nodes[self._current_node]
+            if node["end"] is None:
+                node["end"] = now
+        self._current_node = None
+
+    def handle(self, msg_type, data, now=None):
+        """Update the timeline from one websocket message belonging to this prompt"""
+        now = now if now is not None else time.time()
+
+        if msg_type == "execution_start":
+            self.started_at = now
+            self.status = "running"
+        elif msg_type == "execution_cached":
+            self.cached_nodes.extend(str(n) for n in data.get("nodes", []))
+        elif msg_type == "executing":
+            self._end_current(now)
+            node_id = data.get("node")
+            if node_id is None:
+                self.finished_at = now
+                if self.status != "error":
+                    self.status = "success"
+            else:
+                node_id = str(node_id)
+                self.nodes.setdefault(node_id, {
+                    "start": now, "end": None, "steps": None, "max_steps": None, "last_progress": None
+                })
+                self._current_node = node_id
+        elif msg_type == "progress":
+            node_id = str(data.get("node") or self._current_node)
+            node = self.nodes.get(node_id)
+            if node is not None:
+                node["steps"] = data.get("value")
+                node["max_steps"] = data.get("max")
+                node["last_progress"] = now
+        elif msg_type == "executed":
+            node = self.nodes.get(str(data.get("node")))
+            if node is not None and node["end"] is None:
+                node["end"] = now
+        elif msg_type == "execution_error":
+            self._end_current(now)
+            self.status = "error"
+            self.error = {
+                "node_id": data.get("node_id"),
+                "node_type": data.get("node_type"),
+                "message": data.get("exception_message"),
+            }
+        elif msg_type == "execution_interrupted":
+            self._end_current(now)
+            self.status = "interrupted"
+        elif msg_type == "execution_success":
+            self._end_current(now)
+            self.finished_at = self.finished_at or now
+            self.status = "success"
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def execution_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def to_dict(self):
+        nodes = {}
+        for node_id, node in self.nodes.items():
+            entry = {
+                "start": node["start"] - self.queued_at,
+                "duration": None if node["end"] is None else node["end"] - node["start"],
+            }
+            if node["steps"] is not None:
+                entry["steps"] = node["steps"]
+                entry["max_steps"] = node["max_steps"]
+                elapsed = node["last_progress"] - node["start"]
+                entry["steps_per_second"] = node["steps"] / elapsed if elapsed > 0 else None
+            nodes[node_id] = entry
+        return {
+            "prompt_id": self.prompt_id,
+            "status": self.status,
+            "queue_wait": self.queue_wait,
+            "execution_time": self.execution_time,
+            "nodes": nodes,
+            "cached_nodes": self.cached_nodes,
+            "error": self.error,
+            "events_missed": self.events_missed,
+        }
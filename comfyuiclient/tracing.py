@@ -0,0 +1,117 @@
+"""
+Leveled logging with per-batch trace IDs and optional span timing.
+
+All library and server messages go through loggers under "comfyuiclient".
+configure_logging() sets the level (COMFY_LOG_LEVEL, default INFO) and an
+optional JSON-lines span file (COMFY_TRACE_FILE). Debug dumps are guarded by
+logger.isEnabledFor(DEBUG) or use lazy %-formatting, so they cost nothing
+when the level is above DEBUG; span() is a no-op without a trace file.
+
+The current trace ID (a batch job ID, for example) lives in a context
+variable, so it follows the asyncio task that set it and is added to every
+log record and span written from there.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("comfyuiclient")
+
+trace_id_var = contextvars.ContextVar("comfyui_trace_id", default=None)
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(trace_id)s] %(name)s: %(message)s"
+
+_trace_file = None
+
+
+class _TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get() or "-"
+        return True
+
+
+def configure_logging(level=None, trace_file=None):
+    """
+    Set up the "comfyuiclient" logger hierarchy.
+    level and trace_file default to COMFY_LOG_LEVEL / COMFY_TRACE_FILE.
+    """
+    global _trace_file
+    level = level or os.environ.get("COMFY_LOG_LEVEL", "INFO")
+    root = logging.getLogger("comfyuiclient")
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    if not any(getattr(h, "_comfyui_handler", False) for h in root.handlers):
+        handler = logging.StreamHandler()
+        handler._comfyui_handler = True
+        handler.addFilter(_TraceIdFilter())
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+        root.propagate = False
+
+    trace_file = trace_file or os.environ.get("COMFY_TRACE_FILE")
+    if trace_file:
+        close_trace_file()
+        _trace_file = open(trace_file, "a", encoding="utf-8", buffering=1)
+
+
+def close_trace_file():
+    global _trace_file
+    if _trace_file is not None:
+        _trace_file.close()
+        _trace_file = None
+
+
+def set_trace_id(trace_id):
+    """Set the trace ID for the current task; returns a token for trace_id_var.reset()"""
+    return trace_id_var.set(trace_id)
+
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+
+@contextlib.contextmanager
+def _span(name, attrs):
+    start = time.time()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        record = {
+            "trace_id": trace_id_var.get(),
+            "span": name,
+            "start": start,
+            "duration": time.time() - start,
+            "status": status,
+        }
+        record.update(attrs)
+        if _trace_file is not None:
+            _trace_file.write(json.dumps(record, default=str) + "\n")
+
+
+def span(name, **attrs):
+    """
+    Time a block and write it to the trace file as one JSON line:
+    {"trace_id", "span", "start", "duration", "status", **attrs}.
+    The yielded dict can be updated to add attributes. Without a trace file
+    this returns a shared no-op context.
+    """
+    if _trace_file is None:
+        return _NULL_SPAN
+    return _span(name, attrs)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
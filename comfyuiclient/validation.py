@@ -0,0 +1,287 @@
+"""
+Pre-flight validation of batch rows against ComfyUI's node schema.
+
+The schema comes from a server's /object_info and is cached per server for
+OBJECT_INFO_TTL seconds. validate_batch() checks the workflow once (unknown
+node types, missing required inputs, dangling links, bad literal values) and
+then every row's injected values: enum membership (sampler names, model and
+LoRA files), INT/FLOAT conversion and ranges, and that local files meant for
+upload exist. Each distinct (node type, field, value) is checked only once,
+so a batch of thousands of rows costs little more than its distinct values;
+errors are grouped by value with the indices of the rows that carry it.
+"""
+import asyncio
+import difflib
+import os
+import time
+
+import aiohttp
+
+from .workflow_manager import WorkflowManager
+
+OBJECT_INFO_TTL = float(os.environ.get("COMFY_OBJECT_INFO_TTL", "300"))
+# /object_info is large on installations with many custom nodes, but a hung server must not stall validation
+OBJECT_INFO_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# Rows listed per error; the full count is in "row_count"
+MAX_ROWS_PER_ERROR = 50
+
+# Input options that mark a combo as a file picker the client uploads local files for
+UPLOAD_FLAGS = ("image_upload", "video_upload", "audio_upload", "upload")
+SCALAR_TYPES = ("INT", "FLOAT", "STRING", "BOOLEAN")
+
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+class NodeSchema:
+    """Input specs of every node type known to one server, from /object_info"""
+
+    def __init__(self, object_info):
+        self.object_info = object_info
+        self.memo = {}
+
+    def inputs(self, class_type):
+        """{field: (spec, required)} for a node type, or None if the type is unknown"""
+        info = self.object_info.get(class_type)
+        if info is None:
+            return None
+        fields = {}
+        for section in ("required", "optional"):
+            for field, spec in (info.get("input", {}).get(section) or {}).items():
+                fields[field] = (spec, section == "required")
+        return fields
+
+    def check_value(self, class_type, field, value):
+        """Error message for a literal input value, or None if it is acceptable"""
+        # The type is part of the key so that True and 1 (equal in Python) are told apart
+        try:
+            key = (class_type, field, type(value), value)
+            hash(key)
+        except TypeError:
+            key = (class_type, field, type(value), repr(value))
+        if key not in self.memo:
+            self.memo[key] = self._check_value(class_type, field, value)
+        return self.memo[key]
+
+    def _check_value(self, class_type, field, value):
+        fields = self.inputs(class_type)
+        if fields is None or field not in fields:
+            # Unknown types are reported once for the workflow; extra fields are ignored by ComfyUI
+            return None
+        spec = fields[field][0]
+        input_type = spec[0] if spec else None
+        options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+        if isinstance(input_type, list) or input_type == "COMBO":
+            choices = input_type if isinstance(input_type, list) else options.get("options", [])
+            if value in choices:
+                return None
+            if isinstance(value, str) and any(options.get(flag) for flag in UPLOAD_FLAGS):
+                if os.path.isfile(value):
+                    return None
+                if os.path.sep in value or "/" in value:
+                    return f"File not found: {value}"
+            message = f"{value!r} is not one of the {len(choices)} allowed values"
+            close = difflib.get_close_matches(str(value), [str(c) for c in choices], n=3)
+            if close:
+                message += f" (did you mean {', '.join(repr(c) for c in close)}?)"
+            return message
+        if input_type not in SCALAR_TYPES:
+            # Inputs like MODEL or IMAGE must be links; ComfyUI reports literals itself
+            return None
+        try:
+            if input_type == "INT":
+                if isinstance(value, bool):
+                    raise ValueError
+                converted = int(value)
+            elif input_type == "FLOAT":
+                if isinstance(value, bool):
+                    raise ValueError
+                converted = float(value)
+            else:
+                return None
+        except (TypeError, ValueError):
+            return f"{value!r} is not a valid {input_type}"
+        if "min" in options and converted < options["min"]:
+            return f"{value!r} is below the minimum {options['min']}"
+        if "max" in options and converted > options["max"]:
+            return f"{value!r} is above the maximum {options['max']}"
+        return None
+
+
+class SchemaCache:
+    """NodeSchema per server address, refetched after `ttl` seconds"""
+
+    def __init__(self, ttl=OBJECT_INFO_TTL):
+        self.ttl = ttl
+        self.entries = {}  # server -> (fetched_at, NodeSchema)
+        self.locks = {}
+
+    async def get(self, server):
+        entry = self.entries.get(server)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        lock = self.locks.setdefault(server, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(server)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                return entry[1]
+            object_info = await self._fetch(server)
+            schema = NodeSchema(object_info)
+            self.entries[server] = (time.time(), schema)
+            return schema
+
+    async def _fetch(self, server):
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://{server}/object_info", timeout=OBJECT_INFO_TIMEOUT) as response:
+                    response.raise_for_status()
+                    return await response.json()
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"Failed to get node schema from {server}: {e}")
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Failed to get node schema from {server}: timed out")
+
+    def invalidate(self, server=None):
+        if server is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(server, None)
+
+
+# Shared by the server handlers and the CLI
+schema_cache = SchemaCache()
+
+
+def injection_targets(workflow):
+    """
+    Map injection keys to the fields they change: "node_id.field" for every
+    literal field, and each **name** variable to the (node_id, field) pairs using it.
+    """
+    direct = set()
+    regex = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        for field, value in (node.get("inputs") or {}).items():
+            direct.add(f"{node_id}.{field}")
+            if isinstance(value, str):
+                for match in WorkflowManager.VAR_PATTERN.finditer(value):
+                    regex.setdefault(match.group("name"), []).append((node_id, field))
+    return direct, regex
+
+
+def injected_value(field_value, row, direct_key):
+    """Final value of one field for a row, as WorkflowManager.inject_variables computes it"""
+    if direct_key in row:
+        value = WorkflowManager._cast_value(row[direct_key])
+        if not isinstance(value, str):
+            return value
+        template = value
+    else:
+        template = field_value
+    if not isinstance(template, str):
+        return template
+    match = WorkflowManager.VAR_PATTERN.fullmatch(template)
+    if match and match.group("name") in row:
+        return WorkflowManager._cast_value(row[match.group("name")])
+    for match in reversed(list(WorkflowManager.VAR_PATTERN.finditer(template))):
+        if match.group("name") in row:
+            template = template[:match.start()] + str(row[match.group("name")]) + template[match.end():]
+    return template
+
+
+def validate_workflow(workflow, schema):
+    """Errors in the workflow itself, shared by every row"""
+    errors = []
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            continue
+        class_type = node["class_type"]
+        fields = schema.inputs(class_type)
+        if fields is None:
+            errors.append({"node_id": node_id, "field": None, "value": class_type,
+                           "error": f"Unknown node type {class_type} (custom node not installed?)"})
+            continue
+        inputs = node.get("inputs") or {}
+        for field, (spec, required) in fields.items():
+            if required and field not in inputs:
+                errors.append({"node_id": node_id, "field": field, "value": None,
+                               "error": f"Missing required input {field}"})
+        for field, value in inputs.items():
+            if is_link(value):
+                if value[0] not in workflow:
+                    errors.append({"node_id": node_id, "field": field, "value": value,
+                                   "error": f"Linked to missing node {value[0]}"})
+                continue
+            if isinstance(value, str) and WorkflowManager.VAR_PATTERN.search(value):
+                # Filled in per row
+                continue
+            message = schema.check_value(class_type, field, value)
+            if message:
+                errors.append({"node_id": node_id, "field": field, "value": value, "error": message})
+    return errors
+
+
+def validate_rows(workflow, rows, schema):
+    """
+    Check the values every row injects. rows is an iterable of (index, inputs).
+    Returns (row_count, errors) with errors grouped by node, field and value.
+    """
+    direct, regex = injection_targets(workflow)
+    grouped = {}  # (node_id, field, value repr, message) -> error with rows
+    count = 0
+    for index, row in rows:
+        count += 1
+        fields = set()
+        for key in row:
+            if key in direct:
+                fields.add(tuple(key.split(".", 1)))
+            for target in regex.get(key, ()):
+                fields.add(target)
+        for node_id, field in fields:
+            node = workflow[node_id]
+            field_value = node["inputs"][field]
+            if is_link(field_value) and f"{node_id}.{field}" not in row:
+                continue
+            value = injected_value(field_value, row, f"{node_id}.{field}")
+            if is_link(value):
+                continue
+            message = schema.check_value(node["class_type"], field, value)
+            if message is None:
+                continue
+            group_key = (node_id, field, repr(value), message)
+            error = grouped.get(group_key)
+            if error is None:
+                error = grouped[group_key] = {
+                    "node_id": node_id, "field": field, "value": value,
+                    "error": message, "rows": [], "row_count": 0,
+                }
+            error["row_count"] += 1
+            if len(error["rows"]) < MAX_ROWS_PER_ERROR:
+                error["rows"].append(index)
+    return count, list(grouped.values())
+
+
+async def validate_batch(workflow, rows, servers, cache=None):
+    """
+    Validate a workflow and its rows against the schema of every server the batch
+    may run on. rows is an iterable of (index, inputs) and is consumed once per
+    server, so pass a callable returning a fresh iterable when there are several.
+    Returns {"valid", "rows", "errors"}; every error carries its "server".
+    """
+    cache = cache or schema_cache
+    errors = []
+    count = 0
+    for server in servers:
+        schema = await cache.get(server)
+        server_rows = rows() if callable(rows) else rows
+
+        def check():
+            return validate_workflow(workflow, schema), validate_rows(workflow, server_rows, schema)
+
+        workflow_errors, (count, row_errors) = await asyncio.to_thread(check)
+        for error in workflow_errors + row_errors:
+            error["server"] = server
+            errors.append(error)
+    return {"valid": not errors, "rows": count, "errors": errors}
@@ -0,0 +1,116 @@
+"""
+Backend warm-up before a batch starts.
+
+The first prompt on a backend pays for loading its checkpoints and LoRAs.
+warm_up() sends every target backend, in parallel, a cheap version of the
+batch's workflow built by warmup_workflow(): one sampling step, small empty
+latents, batch size 1 and previews instead of saved images. It waits until
+the models are loaded, so real rows start on warm backends and their
+timings are not skewed. Warm-up timing is reported per backend, separately
+from the rows; a failed warm-up is reported, not raised.
+"""
+import asyncio
+import copy
+import logging
+import time
+
+from .batchrun import upload_inputs
+from .client import ComfyUIClientAsync
+from .tracing import span
+from .validation import is_link
+from .workflow_manager import WorkflowManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 600.0
+WARMUP_LATENT_SIZE = 64
+# Rows looked at for distinct model groups when picking what to warm each backend with
+WARMUP_SCAN_ROWS = 1000
+
+
+def warmup_workflow(workflow):
+    """Cheap copy of an API workflow that still loads every model it uses"""
+    workflow = copy.deepcopy(workflow)
+    for node in workflow.values():
+        if not isinstance(node, dict) or "class_type" not in node:
+            continue
+        inputs = node.get("inputs") or {}
+        if node["class_type"] == "SaveImage":
+            # Previews go to ComfyUI's temp folder instead of cluttering its outputs
+            node["class_type"] = "PreviewImage"
+            node["inputs"] = {"images": inputs.get("images")}
+            continue
+        for field, value in inputs.items():
+            if is_link(value) or not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if field == "steps":
+                inputs[field] = 1
+            elif field == "batch_size":
+                inputs[field] = 1
+            elif field in ("width", "height") and node["class_type"].startswith("Empty") and "Latent" in node["class_type"]:
+                inputs[field] = min(value, WARMUP_LATENT_SIZE)
+    return workflow
+
+
+def pick_warmup_rows(rows, servers, affinity=None, scan=WARMUP_SCAN_ROWS):
+    """
+    Row inputs to warm each server with: the first row, or with affinity (see
+    BatchScheduler) the first rows of distinct model groups, one per server,
+    found among the first `scan` rows. Returns {server: (affinity key, inputs)}.
+    """
+    picks = []
+    seen = set()
+    for count, (index, inputs) in enumerate(rows):
+        if count >= scan:
+            break
+        key = affinity(inputs) if affinity is not None else None
+        if key not in seen:
+            picks.append((key, inputs))
+            seen.add(key)
+            if affinity is None or len(picks) >= len(servers):
+                break
+    if not picks:
+        return {}
+    return {server: picks[i % len(picks)] for i, server in enumerate(servers)}
+
+
+async def warm_up_backend(server, workflow, inputs, preprocessor=None, preprocess=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Run the warm-up prompt for one row's inputs on one backend.
+    Returns {"server", "status", "duration", "model_load", "error"}.
+    """
+    started = time.time()
+    result = {"server": server, "status": "ok", "duration": None, "model_load": None, "error": None}
+    client = ComfyUIClientAsync(server, "dummy.json")
+    try:
+        with span("warmup", server=server):
+            await client.connect()
+            processed_inputs = await upload_inputs(client, inputs, preprocessor, preprocess)
+            prompt = warmup_workflow(WorkflowManager.inject_variables(workflow, processed_inputs))
+            timeline = await client.execute(prompt, timeout)
+        # Time spent in loader nodes is the model loading the batch would otherwise pay for
+        nodes = timeline.to_dict()["nodes"]
+        result["model_load"] = sum(
+            node["duration"] or 0 for node_id, node in nodes.items()
+            if "Loader" in prompt.get(node_id, {}).get("class_type", "")
+        )
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+        logger.warning("Warm-up on %s failed: %s", server, e)
+    finally:
+        await client.close()
+    result["duration"] = time.time() - started
+    return result
+
+
+async def warm_up(servers, workflow, inputs_for, preprocessor=None, preprocess=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Warm every backend in parallel. inputs_for(server) gives the row inputs to warm
+    it with (the first row, or the first row of the model group it will run).
+    Returns the per-backend results in the order of servers.
+    """
+    return await asyncio.gather(*(
+        warm_up_backend(server, workflow, inputs_for(server), preprocessor, preprocess, timeout)
+        for server in servers
+    ))
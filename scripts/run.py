@@ -2,15 +2,31 @@ import argparse
 import asyncio
 import json
 import os
+import socket
 import sys
 import glob
+import time
+import uuid
 from typing import List, Dict, Any
 
 # Add project root to path
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT)
 
+from comfyuiclient.affinity import model_key_func
+from comfyuiclient.batchrun import error_row, run_batch_row
 from comfyuiclient.client import ComfyUIClientAsync
+from comfyuiclient.connection import connections
+from comfyuiclient.filecache import file_cache
+from comfyuiclient.jobqueue import DEFAULT_LEASE, JobQueue
+from comfyuiclient.outputs import RunProgress, image_extension, write_bytes_atomic
+from comfyuiclient.scheduler import MAX_RETRY_BACKOFF, NON_RETRYABLE_ERRORS, BatchScheduler
 from comfyuiclient.workflow_manager import WorkflowManager
+from comfyuiclient.sweep import count_sweep, iter_batch_rows
+from comfyuiclient.tracing import close_trace_file, configure_logging, new_trace_id, set_trace_id
+from comfyuiclient.preprocess import InputPreprocessor, spec_for, template_preprocess, validate_preprocess
+from comfyuiclient.validation import validate_batch
+from comfyuiclient.warmup import pick_warmup_rows, warm_up
 
 # Supported file extensions for folder expansion
 IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif'}
@@ -87,7 +103,8 @@ async def extract_vars(args):
     print(json.dumps(vars, indent=2))
 
 
-async def run_workflow(client: ComfyUIClientAsync, workflow: Dict, inputs: Dict[str, Any], output_dir: str, var_types: Dict[str, str]):
+async def run_workflow(client: ComfyUIClientAsync, workflow: Dict, inputs: Dict[str, Any], output_dir: str, var_types: Dict[str, str],
+                       preprocessor: InputPreprocessor = None, preprocess=None, log=print):
     # Process inputs: upload images if needed
     processed_inputs = inputs.copy()
     
@@ -97,72 +114,199 @@ async def run_workflow(client: ComfyUIClientAsync, workflow: Dict, inputs: Dict[
         is_file_type = var_type in ['image', 'video', 'audio', 'file'] or key.lower().find('image') >= 0
         
         if is_file_type and isinstance(value, str) and os.path.exists(value) and os.path.isfile(value):
-            print(f"Uploading {key}: {value}...")
-            with open(value, 'rb') as f:
-                file_data = f.read()
-                filename = os.path.basename(value)
-                server_path = await client.upload_image_bytes(file_data, filename=filename)
+            upload_path = value
+            spec = spec_for(preprocess, key)
+            if preprocessor is not None and spec and os.path.splitext(value)[1].lower() in IMAGE_EXTENSIONS:
+                upload_path, source_size, upload_size = await preprocessor.process(value, spec)
+                log(f"Preprocessed {key}: {source_size} -> {upload_size} bytes")
+            # Unique name so concurrent runs never overwrite each other's inputs in ComfyUI
+            ext = os.path.splitext(upload_path)[1].lower()
+            filename = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
+            log(f"Uploading {key}: {value}...")
+            with open(upload_path, 'rb') as f:
+                server_path = await client.upload_image_file(f, filename=filename)
                 processed_inputs[key] = server_path
-                print(f"Uploaded to {server_path}")
+                log(f"Uploaded to {server_path}")
 
     # Inject variables
     final_workflow = WorkflowManager.inject_variables(workflow, processed_inputs)
 
     # Queue prompt
-    print("Queueing workflow...")
-    results = await client.generate_from_workflow(final_workflow)
+    log("Queueing workflow...")
+    client.comfyui_prompt = final_workflow
+    results = await client.generate(decode=False)
     
-    # Save results
+    # Save results; written atomically so an interrupted run never leaves a partial file
     os.makedirs(output_dir, exist_ok=True)
+    saved = []
     for node_id, data in results.items():
-        from PIL import Image
-        if isinstance(data, Image.Image):
-            filename = f"{output_dir}/output_{node_id}.png"
-            data.save(filename)
-            print(f"Saved {filename}")
+        if isinstance(data, bytes):
+            # Written as downloaded from ComfyUI, without decoding
+            filename = f"{output_dir}/output_{node_id}{image_extension(data)}"
+            write_bytes_atomic(filename, data)
         else:
             filename = f"{output_dir}/output_{node_id}.txt"
-            with open(filename, "w", encoding='utf-8') as f:
-                f.write(str(data))
-            print(f"Saved {filename}")
+            write_bytes_atomic(filename, str(data).encode('utf-8'))
+        log(f"Saved {filename}")
+        saved.append(filename)
+    return saved
+
+
+def print_validation(result):
+    if result["valid"]:
+        print(f"✅ All {result['rows']} jobs passed validation")
+        return
+    print(f"❌ {len(result['errors'])} problem(s) found in {result['rows']} jobs:")
+    for error in result["errors"]:
+        where = f"node {error['node_id']}" + (f".{error['field']}" if error.get("field") else "")
+        if "rows" in error:
+            rows = ", ".join(str(i + 1) for i in error["rows"])
+            more = error["row_count"] - len(error["rows"])
+            where += f" in job(s) {rows}" + (f" and {more} more" if more else "")
+        print(f"  [{error['server']}] {where}: {error['error']}")
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+
+class ProgressLine:
+    """
+    Live progress of a `run`: jobs/s, ETA and per-server load (pending prompts out
+    of the submission window, and the share of time the server had work).
+    On a terminal the line is redrawn in place on stderr and log() prints above it;
+    otherwise it is printed as a plain line every LOG_INTERVAL seconds.
+    """
+
+    TICK = 0.5
+    LOG_INTERVAL = 30.0
+
+    def __init__(self, total, scheduler, servers, stream=sys.stderr):
+        self.total = total
+        self.scheduler = scheduler
+        self.servers = servers
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.ticks = 0
+        self.busy_ticks = {server: 0 for server in servers}
+
+    def render(self):
+        done = self.completed + self.failed
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.skipped - done
+        eta = format_duration(remaining / rate) if rate > 0 else "--:--"
+        loads = []
+        for server in self.servers:
+            controller = self.scheduler.controllers.get(server)
+            pending = f"{controller.in_flight}/{int(controller.target)}" if controller else "0/0"
+            busy = 100 * self.busy_ticks[server] / self.ticks if self.ticks else 0
+            loads.append(f"{server} {pending} {busy:.0f}%")
+        failed = f", {self.failed} failed" if self.failed else ""
+        return (f"[{done + self.skipped}/{self.total}{failed}] {rate:.2f} jobs/s, ETA {eta} | "
+                + "  ".join(loads))
+
+    def _sample(self):
+        self.ticks += 1
+        for server in self.servers:
+            controller = self.scheduler.controllers.get(server)
+            if controller is not None and controller.in_flight > 0:
+                self.busy_ticks[server] += 1
+
+    def _draw(self):
+        self.stream.write("\r\033[K" + self.render())
+        self.stream.flush()
+
+    def log(self, message):
+        if self.tty:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+            print(message, flush=True)
+            self._draw()
+        else:
+            print(message)
+
+    async def run(self):
+        last_logged = time.time()
+        while True:
+            await asyncio.sleep(self.TICK)
+            self._sample()
+            if self.tty:
+                self._draw()
+            elif time.time() - last_logged >= self.LOG_INTERVAL:
+                last_logged = time.time()
+                print(self.render(), flush=True)
+
+    def finish(self):
+        if self.tty:
+            self._draw()
+            self.stream.write("\n")
+            self.stream.flush()
+        else:
+            print(self.render())
 
 
 async def run(args):
     workflow = None
     var_types = {}
+    sweep = None
+    preprocess = None
     
-    # Load from template or workflow
+    # Load from template or workflow; files are parsed and converted once per version
     if args.template:
         try:
-            with open(args.template, 'r', encoding='utf-8') as f:
-                template = json.load(f)
-                workflow = template.get('workflow')
-                # Build var_types from template variables
-                for v in template.get('variables', []):
-                    var_types[v['id']] = v.get('type', 'text')
-                print(f"Loaded template with {len(template.get('variables', []))} variables")
+            template = file_cache.get_json(args.template)
+            workflow = template.get('workflow')
+            sweep = template.get('sweep')
+            preprocess = template_preprocess(template)
+            # Build var_types from template variables
+            for v in template.get('variables', []):
+                var_types[v['id']] = v.get('type', 'text')
+            print(f"Loaded template with {len(template.get('variables', []))} variables")
         except Exception as e:
             print(f"Error loading template: {e}")
             return
     else:
         try:
-            with open(args.workflow, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
+            workflow = file_cache.get_json(args.workflow)
         except Exception as e:
             print(f"Error loading workflow: {e}")
             return
         
         # Extract var types from regex variables
-        vars_def = WorkflowManager.extract_variables(workflow)
+        try:
+            vars_def = file_cache.derive(args.workflow, "variables", WorkflowManager.extract_variables)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
         var_types = {v['name']: v['type'] for v in vars_def}
 
     if not workflow:
         print("Error: No workflow found")
         return
 
+    # A sweep file overrides the template's sweep
+    if args.sweep:
+        try:
+            with open(args.sweep, 'r', encoding='utf-8') as f:
+                sweep = json.load(f)
+        except Exception as e:
+            print(f"Error loading sweep file: {e}")
+            return
+
+    if args.no_preprocess:
+        preprocess = None
+
     # Ensure API format
     try:
         workflow = WorkflowManager.ensure_api_format(workflow)
+        validate_preprocess(preprocess)
     except ValueError as e:
         print(f"Error: {e}")
         return
@@ -200,34 +344,241 @@ async def run(args):
         expanded = expand_folder_inputs(inputs, var_types)
         expanded_inputs.extend(expanded)
     inputs_list = expanded_inputs
-    
-    print(f"Total jobs to run: {len(inputs_list)}")
 
-    # Initialize client
-    server_addr = os.environ.get("COMFY_BASE_URL", "127.0.0.1:8188").replace("http://", "").replace("https://", "")
-    client = ComfyUIClientAsync(server_addr, "dummy.json")
-    
-    async def generate_from_workflow(wf):
-        client.comfyui_prompt = wf
-        return await client.generate()
+    # Sweep combinations are generated lazily for each row as jobs run
+    try:
+        total = len(inputs_list) * (count_sweep(sweep) if sweep is not None else 1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
     
-    client.generate_from_workflow = generate_from_workflow
+    print(f"Total jobs to run: {total}")
+    batch_id = new_trace_id()
+    set_trace_id(batch_id)
 
-    await client.connect()
-    
+    # Rows are dispatched by the same scheduler as the web server: up to --concurrency
+    # prompts pending per server, adapted to each server's queue
+    servers = args.server or [os.environ.get("COMFY_BASE_URL", "127.0.0.1:8188")]
+    servers = [s.replace("http://", "").replace("https://", "").strip() for s in servers]
+
+    if args.dry_run:
+        # Check every row against the servers' node schema without running anything
+        try:
+            result = await validate_batch(workflow, lambda: iter_batch_rows(inputs_list, sweep), servers)
+        except ConnectionError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print_validation(result)
+        sys.exit(0 if result["valid"] else 1)
+    scheduler = BatchScheduler(max_pending=args.concurrency, initial_pending=min(2, args.concurrency))
+    preprocessor = InputPreprocessor() if preprocess else None
+
+    # Completed rows are recorded in progress.jsonl; --resume skips them
+    progress = RunProgress(args.out, workflow, total, resume=args.resume)
+    if args.resume and progress.done:
+        print(f"Resuming: {len(progress.done)} jobs already completed")
+    skipped = 0
+    status = ProgressLine(total, scheduler, servers)
+
+    def pending_rows():
+        nonlocal skipped
+        for i, inputs in iter_batch_rows(inputs_list, sweep):
+            if progress.is_done(i, inputs):
+                skipped += 1
+                status.skipped += 1
+                continue
+            yield i, inputs
+
+    async def run_row(client, i, inputs):
+        status.log(f"\n=== Running job {i+1}/{total} on {client.SERVER_ADDRESS} ===")
+        sub_output_dir = os.path.join(args.out, f"run_{i}") if total > 1 else args.out
+        return await run_workflow(client, workflow, inputs, sub_output_dir, var_types,
+                                  preprocessor, preprocess, log=status.log)
+
+    def on_result(i, inputs, saved, attempts):
+        progress.add(i, inputs, saved)
+        status.completed += 1
+
+    def on_error(i, inputs, error, attempts):
+        status.failed += 1
+        status.log(f"❌ Job {i+1} failed after {attempts} attempt(s): {error}")
+
+    affinity = model_key_func(workflow) if args.group_by_model else None
+    if args.warmup:
+        # Load each server's models with a cheap prompt before real jobs are dispatched
+        picks = pick_warmup_rows(iter_batch_rows(inputs_list, sweep), servers, affinity)
+        print(f"Warming up {len(servers)} server(s)...")
+        for result in await warm_up(list(picks), workflow, lambda server: picks[server][1], preprocessor, preprocess):
+            if result["status"] == "ok":
+                print(f"  {result['server']}: {result['duration']:.1f}s (model loading {result['model_load']:.1f}s)")
+            else:
+                print(f"  {result['server']}: warm-up failed after {result['duration']:.1f}s: {result['error']}")
+        if affinity is not None:
+            for server, (key, _) in picks.items():
+                scheduler.loaded[server] = key
+        status.started = time.time()
+
+    handle = scheduler.submit(
+        batch_id, pending_rows(), run_row, backends=servers, on_result=on_result, on_error=on_error,
+        max_retries=args.max_retries, retry_backoff=2.0,
+        affinity=affinity
+    )
+    reporter = asyncio.ensure_future(status.run())
     try:
-        for i, inputs in enumerate(inputs_list):
-            print(f"\n=== Running job {i+1}/{len(inputs_list)} ===")
-            sub_output_dir = os.path.join(args.out, f"run_{i}") if len(inputs_list) > 1 else args.out
-            await run_workflow(client, workflow, inputs, sub_output_dir, var_types)
+        await handle.wait()
     finally:
-        await client.close()
+        reporter.cancel()
+        status.finish()
+        progress.close()
+        await scheduler.close()
+        if preprocessor is not None:
+            preprocessor.close()
     
-    print(f"\n✅ Completed {len(inputs_list)} jobs. Output saved to: {args.out}")
+    if skipped:
+        print(f"\nSkipped {skipped} jobs completed by an earlier run")
+    if status.failed:
+        print(f"\n❌ {status.failed} of {total} jobs failed; rerun with --resume to retry them. Output saved to: {args.out}")
+        sys.exit(1)
+    print(f"\n✅ Completed {total} jobs. Output saved to: {args.out}")
+
+
+async def worker(args):
+    """
+    Run rows from the shared job queue that the web server (coordinator) fills
+    when COMFY_BATCH_QUEUE=1 or a batch is submitted with "queue": true.
+    Several workers, on this host or others sharing the queue file and the
+    outputs directory, can run against one queue.
+    """
+    queue = JobQueue(args.queue)
+    worker_id = args.id or f"{socket.gethostname()}-{os.getpid()}"
+    preprocessor = InputPreprocessor()
+    busy = 0
+    running = {}  # batch_id -> clients running its rows
+    print(f"Worker {worker_id} polling {args.queue} with {args.concurrency} slot(s)")
+
+    async def renew_leases():
+        while True:
+            await asyncio.sleep(args.lease / 3)
+            queue.renew(worker_id, args.lease)
+
+    async def watch_cancelled():
+        while True:
+            await asyncio.sleep(args.poll)
+            if running:
+                for batch_id in queue.cancelled_batches(worker_id):
+                    await cancel_running(batch_id)
+
+    async def cancel_running(batch_id):
+        # Only this batch's prompts are deleted or interrupted on the ComfyUI servers
+        for client in list(running.get(batch_id, ())):
+            if client.cancelling or client.connection is None:
+                continue
+            try:
+                await client.cancel_prompts(client.pending_prompts)
+                print(f"[{batch_id}] cancelled; stopped its prompts on {client.SERVER_ADDRESS}")
+            except ConnectionError as e:
+                print(f"[{batch_id}] cancelled; failed to stop its prompts on {client.SERVER_ADDRESS}: {e}")
+
+    async def run_claimed(job, clients, slot):
+        spec = job["spec"]
+        batch_id, index, inputs, attempt = job["batch_id"], job["index"], job["inputs"], job["attempt"]
+        set_trace_id(batch_id)
+        servers = args.server or spec["servers"]
+        server = servers[(slot + index) % len(servers)]
+        client = None
+        try:
+            client = clients.get(server)
+            if client is None:
+                client = clients[server] = ComfyUIClientAsync(server, "dummy.json")
+                await client.connect()
+            client.cancelling = False
+            running.setdefault(batch_id, set()).add(client)
+            output_dir = os.path.join(args.outputs, batch_id) if args.outputs else spec["output_dir"]
+            row = run_batch_row(
+                client, spec["workflow"], index, inputs, batch_id, output_dir, spec["workflow_label"],
+                preprocessor, spec.get("preprocess")
+            )
+            if spec.get("row_timeout"):
+                try:
+                    result = await asyncio.wait_for(row, spec["row_timeout"])
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Row {index} did not finish within {spec['row_timeout']}s")
+            else:
+                result = await row
+            result["attempts"] = attempt
+            result["worker"] = worker_id
+            queue.complete(worker_id, batch_id, index, result)
+            print(f"[{batch_id}] row {index} done on {server}")
+        except Exception as e:
+            # Start the next row with a fresh client
+            cancelled = client is not None and client.cancelling
+            client = clients.pop(server, None)
+            if client is not None:
+                await client.close()
+            retry_delay = None
+            if attempt <= spec.get("max_retries", 0) and not cancelled and not isinstance(e, NON_RETRYABLE_ERRORS):
+                retry_delay = min(spec.get("retry_backoff", 1.0) * 2 ** (attempt - 1), MAX_RETRY_BACKOFF)
+            queue.fail(worker_id, batch_id, index, error_row(index, inputs, e, attempt), retry_delay)
+            if retry_delay is None:
+                print(f"[{batch_id}] row {index} failed after {attempt} attempt(s): {e}")
+            else:
+                print(f"[{batch_id}] row {index} failed on {server} ({e}), retrying in {retry_delay:.1f}s")
+        finally:
+            running.get(batch_id, set()).discard(client)
+            if not running.get(batch_id):
+                running.pop(batch_id, None)
+
+    async def slot(n):
+        nonlocal busy
+        clients = {}
+        try:
+            while True:
+                job = queue.claim(worker_id, args.lease)
+                if job is None:
+                    if args.exit_when_idle and busy == 0:
+                        return
+                    await asyncio.sleep(args.poll)
+                    continue
+                busy += 1
+                try:
+                    await run_claimed(job, clients, n)
+                finally:
+                    busy -= 1
+        finally:
+            for client in clients.values():
+                await client.close()
+
+    renewer = asyncio.ensure_future(renew_leases())
+    canceller = asyncio.ensure_future(watch_cancelled())
+    try:
+        await asyncio.gather(*(slot(n) for n in range(args.concurrency)))
+    finally:
+        renewer.cancel()
+        canceller.cancel()
+        preprocessor.close()
+        queue.close()
+
+
+async def run_command(args):
+    try:
+        await args.func(args)
+    finally:
+        # Shared server connections otherwise outlive the event loop
+        await connections.close_all()
+
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 
 def main():
     parser = argparse.ArgumentParser(description="ComfyUI Client Builder CLI")
+    parser.add_argument("--log-level", help="Library log level (DEBUG, INFO, WARNING...); default COMFY_LOG_LEVEL or INFO")
+    parser.add_argument("--trace-file", help="Append timing spans as JSON lines to this file (default COMFY_TRACE_FILE)")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     # extract-vars
@@ -242,19 +593,45 @@ def main():
     parser_run.add_argument("--set", action="append", help="Set variable value: name=value")
     parser_run.add_argument("--file", action="append", help="Set file variable: name=path")
     parser_run.add_argument("--batch", "-b", help="Path to JSON file with batch variables")
+    parser_run.add_argument("--sweep", help="Path to JSON sweep spec (parameter grid / seed sweep) applied to every row")
     parser_run.add_argument("--out", "-o", default="./outputs", help="Output directory")
+    parser_run.add_argument("--no-preprocess", action="store_true", help="Upload original files, ignoring the template's preprocess settings")
+    parser_run.add_argument("--resume", action="store_true", help="Skip jobs already completed in the output directory (from its progress.jsonl)")
+    parser_run.add_argument("--server", action="append", help="ComfyUI server address (repeatable; default COMFY_BASE_URL). Jobs are spread across all of them")
+    parser_run.add_argument("--concurrency", "-c", type=positive_int, default=1, help="Maximum prompts pending per server at once (adapted to the server's queue)")
+    parser_run.add_argument("--max-retries", type=int, default=0, help="Retries per failed job, preferably on another server")
+    parser_run.add_argument("--group-by-model", action="store_true", help="Run jobs that load the same checkpoint/LoRA together (and on the same server) instead of in input order")
+    parser_run.add_argument("--warmup", action="store_true", help="Load models on every server with a 1-step prompt before the jobs start (timed separately)")
+    parser_run.add_argument("--dry-run", action="store_true", help="Validate every job against the servers' node schema (/object_info) and exit without running")
     parser_run.set_defaults(func=run)
 
+    # worker
+    parser_worker = subparsers.add_parser("worker", help="Run batch rows from the shared job queue (coordinator: scripts/server.py)")
+    parser_worker.add_argument("--queue", default=os.environ.get("COMFY_QUEUE_DB", os.path.join(PROJECT_ROOT, "data", "queue.db")),
+                               help="Path to the SQLite job queue (default: data/queue.db or COMFY_QUEUE_DB)")
+    parser_worker.add_argument("--server", action="append", help="ComfyUI server to use instead of the batch's own (repeatable)")
+    parser_worker.add_argument("--concurrency", "-c", type=positive_int, default=2, help="Rows run at the same time by this worker")
+    parser_worker.add_argument("--outputs", help="Outputs root directory, if it is mounted elsewhere than on the coordinator")
+    parser_worker.add_argument("--id", help="Worker ID (default: hostname-pid)")
+    parser_worker.add_argument("--lease", type=float, default=DEFAULT_LEASE, help="Seconds a claimed row stays reserved without renewal")
+    parser_worker.add_argument("--poll", type=float, default=1.0, help="Seconds between polls when the queue is empty")
+    parser_worker.add_argument("--exit-when-idle", action="store_true", help="Exit once the queue has no runnable rows")
+    parser_worker.set_defaults(func=worker)
+
     args = parser.parse_args()
     
     # Validate run command
     if args.command == "run" and not args.workflow and not args.template:
         parser.error("Either 'workflow' or '--template' is required for 'run' command")
     
-    if asyncio.iscoroutinefunction(args.func):
-        asyncio.run(args.func(args))
-    else:
-        args.func(args)
+    configure_logging(args.log_level, args.trace_file)
+    try:
+        if asyncio.iscoroutinefunction(args.func):
+            asyncio.run(run_command(args))
+        else:
+            args.func(args)
+    finally:
+        close_trace_file()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
 import os
 import sys
 import json
-import base64
-import io
 import asyncio
 import uuid
 import time
+import hashlib
+import tempfile
+import logging
+import gzip
+from collections import OrderedDict
 from typing import Dict, Any, List
 
 from aiohttp import web
@@ -15,10 +18,29 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(PROJECT_ROOT)
 
 from comfyuiclient.client import ComfyUIClientAsync
+from comfyuiclient.connection import connections
 from comfyuiclient.workflow_manager import WorkflowManager
+from comfyuiclient.affinity import model_key_func
+from comfyuiclient.batchrun import error_row, run_batch_row, safe_workflow_name as safe_workflow_name_for
+from comfyuiclient.filecache import file_cache
+from comfyuiclient.jobqueue import JobQueue, QueuedBatchHandle
+from comfyuiclient.outputs import JobManifest, OutputIndex, image_extension, write_bytes_atomic
+from comfyuiclient.preprocess import InputPreprocessor, validate_preprocess
+from comfyuiclient.retention import DAY, GB, RemoteUploads, RetentionArea, RetentionManager
+from comfyuiclient.scheduler import BatchScheduler
+from comfyuiclient.sweep import count_sweep, iter_batch_rows
+from comfyuiclient.tracing import close_trace_file, configure_logging, set_trace_id, span
+from comfyuiclient.validation import validate_batch
+from comfyuiclient.warmup import pick_warmup_rows, warm_up
 from PIL import Image
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 routes = web.RouteTableDef()
+logger = logging.getLogger("comfyuiclient.server")
 
 # Configuration
 COMFY_SERVER = os.environ.get("COMFY_BASE_URL", "127.0.0.1:8188").replace("http://", "").replace("https://", "")
@@ -28,22 +50,77 @@ DATA_DIR = os.path.join(PROJECT_ROOT, "data")
 WORKFLOWS_DIR = os.path.join(DATA_DIR, "workflows")
 TEMPLATES_DIR = os.path.join(DATA_DIR, "templates")
 OUTPUTS_DIR = os.path.join(DATA_DIR, "outputs")
+PREPROCESS_CACHE_DIR = os.path.join(DATA_DIR, "cache", "preprocess")
 
 # Ensure directories exist
 for d in [WORKFLOWS_DIR, TEMPLATES_DIR, OUTPUTS_DIR]:
     os.makedirs(d, exist_ok=True)
 
+# Index of all output jobs, answered from memory instead of scanning OUTPUTS_DIR
+output_index = OutputIndex(OUTPUTS_DIR)
+
 # Active batch jobs for cancellation
-active_batch_jobs = {}  # job_id -> {"cancelled": bool, "results": [], "server": str}
+active_batch_jobs = {}  # job_id -> {"cancelled": bool, "results": [], "server": str, "handle": BatchHandle or None while warming up}
+
+# Owns submission to every ComfyUI backend; batches share it by priority and round-robin.
+# Each backend keeps between 1 and COMFY_MAX_PENDING prompts pending, adapted to its queue.
+MAX_PENDING = int(os.environ.get("COMFY_MAX_PENDING", "4"))
+
+# Defaults for per-row retries in batch runs; each can be overridden in the /api/batch request
+DEFAULT_MAX_RETRIES = int(os.environ.get("COMFY_MAX_RETRIES", "2"))
+DEFAULT_RETRY_BACKOFF = float(os.environ.get("COMFY_RETRY_BACKOFF", "2.0"))
+DEFAULT_ROW_TIMEOUT = float(os.environ.get("COMFY_ROW_TIMEOUT", "0")) or None
+scheduler = None
+
+# Process pool for template-declared input preprocessing (resize/re-encode before upload)
+PREPROCESS_WORKERS = int(os.environ.get("COMFY_PREPROCESS_WORKERS", "0")) or None
+preprocessor = None
+
+# Shared SQLite job queue for `run.py worker` processes. With COMFY_BATCH_QUEUE=1 (or
+# "queue": true in the request) batches are run by workers instead of in this process.
+QUEUE_DB = os.environ.get("COMFY_QUEUE_DB", os.path.join(DATA_DIR, "queue.db"))
+USE_JOB_QUEUE = os.environ.get("COMFY_BATCH_QUEUE", "0") not in ("0", "", "false")
+job_queue = None  # opened by get_job_queue() on the first queued batch
+
+# Validate every row against the servers' node schema before a batch starts (the
+# request's "validate" overrides); rejected batches get a 422 with all errors
+VALIDATE_BATCHES = os.environ.get("COMFY_VALIDATE_BATCH", "0") not in ("0", "", "false")
+
+# Group rows that load the same checkpoint/LoRA files and keep each backend on one
+# group, instead of running them in input order (the request's "group_by_model" overrides)
+GROUP_BY_MODEL = os.environ.get("COMFY_GROUP_BY_MODEL", "0") not in ("0", "", "false")
+
+# Warm every backend with a 1-step version of the workflow before a batch starts (the
+# request's "warmup" overrides); per-backend warm-up timing goes to the job manifest
+WARMUP_BATCHES = os.environ.get("COMFY_WARMUP", "0") not in ("0", "", "false")
+
+# Disk retention: age (days) and size (GB) quotas per data directory, evicting the least
+# recently used entries; 0 disables a quota. COMFY_MIN_FREE_GB evicts from all of them
+# while the disk is below that much free space. Names uploaded to ComfyUI are tracked
+# in a ledger and deleted from COMFY_INPUT_DIR (ComfyUI's input folder, when it is
+# reachable from this host) once no running row uses them. Saved templates can point at
+# files in data/uploads, so uploads are only expired when COMFY_UPLOADS_MAX_AGE_DAYS is set.
+OUTPUTS_MAX_AGE_DAYS = float(os.environ.get("COMFY_OUTPUTS_MAX_AGE_DAYS", "0"))
+OUTPUTS_MAX_GB = float(os.environ.get("COMFY_OUTPUTS_MAX_GB", "0"))
+UPLOADS_MAX_AGE_DAYS = float(os.environ.get("COMFY_UPLOADS_MAX_AGE_DAYS", "0"))
+UPLOADS_MAX_GB = float(os.environ.get("COMFY_UPLOADS_MAX_GB", "0"))
+PREPROCESS_CACHE_MAX_GB = float(os.environ.get("COMFY_PREPROCESS_CACHE_MAX_GB", "2"))
+MIN_FREE_GB = float(os.environ.get("COMFY_MIN_FREE_GB", "0"))
+RETENTION_INTERVAL = float(os.environ.get("COMFY_RETENTION_INTERVAL", "600"))
+COMFY_INPUT_DIR = os.environ.get("COMFY_INPUT_DIR") or None
+retention = None
+retention_task = None
+remote_uploads = RemoteUploads(os.path.join(DATA_DIR, "remote_uploads.jsonl"), COMFY_INPUT_DIR)
 
 
 # ==================== Static Files ====================
 
+INDEX_HTML = os.path.join(PROJECT_ROOT, "web", "index.html")
+
 @routes.get('/')
 async def index(request):
     try:
-        with open('web/index.html', 'r', encoding='utf-8') as f:
-            return web.Response(text=f.read(), content_type='text/html')
+        return web.Response(body=file_cache.get_bytes(INDEX_HTML), content_type='text/html', charset='utf-8')
     except FileNotFoundError:
         return web.Response(text="web/index.html not found", status=404)
 
@@ -79,6 +156,7 @@ async def save_workflow(request):
         filepath = os.path.join(WORKFLOWS_DIR, f"{safe_name}.json")
         with open(filepath, 'w', encoding='utf-8') as f:
             json.dump(workflow, f, indent=2)
+        file_cache.invalidate(filepath)
         
         return web.json_response({"success": True, "name": safe_name})
     except Exception as e:
@@ -92,9 +170,21 @@ async def get_workflow(request):
     if not os.path.exists(filepath):
         return web.Response(text="Workflow not found", status=404)
     
-    with open(filepath, 'r', encoding='utf-8') as f:
-        workflow = json.load(f)
-    return web.json_response(workflow)
+    # Saved files are already JSON; serve the cached bytes without re-parsing
+    return web.Response(body=file_cache.get_bytes(filepath), content_type='application/json')
+
+@routes.get('/api/workflows/{name}/scan')
+async def scan_workflow(request):
+    """Scan a saved workflow for inputs; the result is cached until the file changes"""
+    name = request.match_info['name']
+    filepath = os.path.join(WORKFLOWS_DIR, f"{name}.json")
+    if not os.path.exists(filepath):
+        return web.Response(text="Workflow not found", status=404)
+    try:
+        inputs = file_cache.derive(filepath, "scan", WorkflowManager.scan_possible_inputs)
+        return web.json_response(inputs)
+    except Exception as e:
+        return web.Response(text=str(e), status=400)
 
 @routes.delete('/api/workflows/{name}')
 async def delete_workflow(request):
@@ -103,6 +193,7 @@ async def delete_workflow(request):
     filepath = os.path.join(WORKFLOWS_DIR, f"{name}.json")
     if os.path.exists(filepath):
         os.remove(filepath)
+    file_cache.invalidate(filepath)
     return web.json_response({"success": True})
 
 
@@ -135,6 +226,7 @@ async def save_template(request):
         filepath = os.path.join(TEMPLATES_DIR, f"{safe_name}.json")
         with open(filepath, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2)
+        file_cache.invalidate(filepath)
         
         return web.json_response({"success": True, "name": safe_name})
     except Exception as e:
@@ -148,9 +240,7 @@ async def get_template(request):
     if not os.path.exists(filepath):
         return web.Response(text="Template not found", status=404)
     
-    with open(filepath, 'r', encoding='utf-8') as f:
-        template = json.load(f)
-    return web.json_response(template)
+    return web.Response(body=file_cache.get_bytes(filepath), content_type='application/json')
 
 @routes.put('/api/templates/{name}')
 async def update_template(request):
@@ -162,6 +252,7 @@ async def update_template(request):
         data = await request.json()
         with open(filepath, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2)
+        file_cache.invalidate(filepath)
         return web.json_response({"success": True})
     except Exception as e:
         return web.Response(text=str(e), status=400)
@@ -173,6 +264,7 @@ async def delete_template(request):
     filepath = os.path.join(TEMPLATES_DIR, f"{name}.json")
     if os.path.exists(filepath):
         os.remove(filepath)
+    file_cache.invalidate(filepath)
     return web.json_response({"success": True})
 
 
@@ -181,11 +273,84 @@ async def delete_template(request):
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# Uploads are streamed to disk in chunks; anything larger than this is rejected
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def save_upload_part(part):
+    """
+    Stream one multipart file part to UPLOADS_DIR while hashing it.
+    Files are named by content hash, so uploading the same file again reuses the stored copy.
+    """
+    filename = part.filename or f"upload_{uuid.uuid4().hex[:8]}"
+    # Get extension from original filename
+    ext = os.path.splitext(filename)[1].lower() or '.png'
+    tmp_path = os.path.join(UPLOADS_DIR, f".upload_{uuid.uuid4().hex}.part")
+    
+    digest = hashlib.sha256()
+    total_bytes = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total_bytes += len(chunk)
+                if total_bytes > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(f"File {filename} exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    sha256 = digest.hexdigest()
+    # Safe ASCII filename to avoid encoding issues with ComfyUI
+    safe_filename = f"upload_{sha256[:16]}{ext}"
+    filepath = os.path.join(UPLOADS_DIR, safe_filename)
+    deduplicated = os.path.exists(filepath)
+    if deduplicated:
+        os.remove(tmp_path)
+        # Reused uploads count as recently used for retention
+        RetentionManager.touch(filepath)
+    else:
+        os.replace(tmp_path, filepath)
+    
+    # Validate image from its header only; Image.open does not decode pixel data
+    valid = False
+    try:
+        with Image.open(filepath) as img:
+            valid = True
+            logger.info("Uploaded file saved: %s (%d bytes, %s %s)", filepath, total_bytes, img.format, img.size)
+    except Exception as e:
+        logger.warning("Uploaded file saved but invalid image: %s (%d bytes) - %s", filepath, total_bytes, e)
+    
+    return {
+        "success": True,
+        "filename": safe_filename,
+        "path": filepath,
+        "size": total_bytes,
+        "sha256": sha256,
+        "deduplicated": deduplicated,
+        "valid": valid
+    }
+
+
 @routes.post('/api/upload')
 async def upload_file(request):
-    """Upload a file to server for batch processing"""
+    """
+    Upload files to server for batch processing.
+    Accepts any number of 'file' parts; a single file returns its entry directly,
+    several return {"success": true, "files": [...]}.
+    """
     try:
         reader = await request.multipart()
+        uploaded = []
         
         while True:
             part = await reader.next()
@@ -193,41 +358,15 @@ async def upload_file(request):
                 break
             
             if part.name == 'file':
-                filename = part.filename or f"upload_{uuid.uuid4().hex[:8]}"
-                # Get extension from original filename
-                ext = os.path.splitext(filename)[1].lower() or '.png'
-                # Generate safe ASCII filename to avoid encoding issues with ComfyUI
-                safe_filename = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-                
-                filepath = os.path.join(UPLOADS_DIR, safe_filename)
-                
-                # Read all file data
-                file_data = await part.read()
-                total_bytes = len(file_data)
-                
-                # Save file
-                with open(filepath, 'wb') as f:
-                    f.write(file_data)
-                
-                # Validate image
-                valid = False
-                try:
-                    img = Image.open(io.BytesIO(file_data))
-                    img.verify()
-                    valid = True
-                    print(f"Uploaded file saved: {filepath} ({total_bytes} bytes, {img.format} {img.size if hasattr(img, 'size') else 'unknown'})")
-                except Exception as e:
-                    print(f"Uploaded file saved but invalid image: {filepath} ({total_bytes} bytes) - {e}")
-                
-                return web.json_response({
-                    "success": True,
-                    "filename": safe_filename,
-                    "path": filepath,
-                    "size": total_bytes,
-                    "valid": valid
-                })
+                uploaded.append(await save_upload_part(part))
         
-        return web.Response(text="No file provided", status=400)
+        if not uploaded:
+            return web.Response(text="No file provided", status=400)
+        if len(uploaded) == 1:
+            return web.json_response(uploaded[0])
+        return web.json_response({"success": True, "files": uploaded})
+    except UploadTooLarge as e:
+        return web.Response(text=str(e), status=413)
     except Exception as e:
         return web.Response(text=str(e), status=500)
 
@@ -270,62 +409,99 @@ async def scan(request):
 
 # ==================== Single Run API ====================
 
+# /api/run file parts are kept in memory up to this size, then spooled to a temp file
+RUN_SPOOL_THRESHOLD = int(os.environ.get("RUN_SPOOL_THRESHOLD", str(8 * 1024 * 1024)))
+
+
+async def upload_run_file(client, key, fileobj, original_name):
+    """Upload one spooled /api/run file part to ComfyUI and return the name LoadImage expects"""
+    logger.debug("Uploading %s...", key)
+    # Generate safe ASCII filename to avoid encoding issues
+    ext = os.path.splitext(original_name)[1].lower() or '.png'
+    safe_name = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
+    
+    server_path = await client.upload_image_file(fileobj, filename=safe_name)
+    # ComfyUI LoadImage expects just the filename, not subfolder/filename
+    if '/' in server_path:
+        server_path = server_path.split('/')[-1]
+    remote_uploads.acquire(client.SERVER_ADDRESS, server_path)
+    logger.debug("%s uploaded as: %s", key, server_path)
+    return server_path
+
+
 @routes.post('/api/run')
 async def run(request):
+    """
+    Run a workflow once.
+    File parts are uploaded to ComfyUI as soon as each one has been received, concurrently
+    with reading the rest of the request; send server_address before files[...] parts
+    so uploads can start early (otherwise they start once the whole request is read).
+    """
+    job_id = f"run_{int(time.time())}_{uuid.uuid4().hex[:6]}"
+    set_trace_id(job_id)
     reader = await request.multipart()
     workflow_json = None
+    workflow_name = None
     inputs = {}
     custom_server = None
+    client = None
+    spooled = []  # [(key, fileobj, original filename)] waiting for the client
+    spool_files = []
+    uploads = {}  # key -> asyncio.Task returning the uploaded name
     
-    while True:
-        part = await reader.next()
-        if part is None:
-            break
-        
-        if part.name == 'workflow':
-            raw = await part.read()
-            workflow_json = json.loads(raw.decode('utf-8'))
-        elif part.name == 'server_address':
-             custom_server = await part.text()
-        elif part.name.startswith('vars['):
-            key = part.name[5:-1]
-            val = await part.text()
-            inputs[key] = val
-        elif part.name.startswith('files['):
-            key = part.name[6:-1]
-            filename = part.filename or f"temp_{key}"
-            file_data = await part.read()
-            inputs[key] = {'filename': filename, 'data': file_data}
-    
-    if not workflow_json:
-        return web.Response(text="Missing workflow", status=400)
-
-    server_addr = custom_server if custom_server else COMFY_SERVER
-    client = ComfyUIClientAsync(server_addr, "dummy.json")
+    async def ensure_client():
+        nonlocal client
+        if client is None:
+            client = ComfyUIClientAsync(custom_server if custom_server else COMFY_SERVER, "dummy.json")
+            await client.connect()
+        for key, fileobj, original_name in spooled:
+            uploads[key] = asyncio.ensure_future(upload_run_file(client, key, fileobj, original_name))
+        spooled.clear()
     
     try:
-        await client.connect()
+        started = time.time()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            
+            if part.name == 'workflow':
+                raw = await part.read()
+                workflow_json = json.loads(raw.decode('utf-8'))
+            elif part.name == 'server_address':
+                 custom_server = await part.text()
+            elif part.name == 'workflow_name':
+                workflow_name = await part.text()
+            elif part.name.startswith('vars['):
+                key = part.name[5:-1]
+                val = await part.text()
+                inputs[key] = val
+            elif part.name.startswith('files['):
+                key = part.name[6:-1]
+                filename = part.filename or f"temp_{key}"
+                fileobj = tempfile.SpooledTemporaryFile(max_size=RUN_SPOOL_THRESHOLD)
+                spool_files.append(fileobj)
+                while True:
+                    chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fileobj.write(chunk)
+                fileobj.seek(0)
+                inputs[key] = filename
+                spooled.append((key, fileobj, filename))
+                if custom_server is not None:
+                    await ensure_client()
         
-        async def generate_from_workflow(wf):
-            client.comfyui_prompt = wf
-            return await client.generate()
-        client.generate_from_workflow = generate_from_workflow
+        if not workflow_json:
+            return web.Response(text="Missing workflow", status=400)
+        
+        await ensure_client()
+        server_addr = client.SERVER_ADDRESS
 
         processed_inputs = inputs.copy()
-        for key, val in inputs.items():
-            if isinstance(val, dict) and 'data' in val:
-                print(f"Uploading {key}...")
-                # Generate safe ASCII filename to avoid encoding issues
-                original_name = val['filename']
-                ext = os.path.splitext(original_name)[1].lower() or '.png'
-                safe_name = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-                
-                server_path = await client.upload_image_bytes(val['data'], filename=safe_name)
-                # ComfyUI LoadImage expects just the filename, not subfolder/filename
-                if '/' in server_path:
-                    server_path = server_path.split('/')[-1]
-                processed_inputs[key] = server_path
-                print(f"  -> Uploaded as: {server_path}")
+        if uploads:
+            names = await asyncio.gather(*uploads.values())
+            processed_inputs.update(zip(uploads.keys(), names))
         
         try:
             workflow_json = WorkflowManager.ensure_api_format(workflow_json)
@@ -334,37 +510,174 @@ async def run(request):
         
         final_workflow = WorkflowManager.inject_variables(workflow_json, processed_inputs)
         
-        print(f"Running workflow on {server_addr}...")
-        results = await client.generate_from_workflow(final_workflow)
+        logger.info("Running workflow on %s...", server_addr)
+        upload_done = time.time()
+        images, text = await client.get_images(final_workflow)
+        generate_done = time.time()
+        
+        # Persist outputs like batch runs do and return URLs, instead of
+        # re-encoding every image into a base64 JSON body
+        job_output_dir = os.path.join(OUTPUTS_DIR, job_id)
+        manifest = JobManifest(
+            job_output_dir, job_id,
+            workflow_name=workflow_name,
+            server=server_addr,
+            total=1,
+        )
         
         resp_data = {}
-        for node_id, data in results.items():
-             if isinstance(data, Image.Image):
-                 buf = io.BytesIO()
-                 data.save(buf, format='PNG')
-                 b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-                 resp_data[node_id] = {
-                     'type': 'image',
-                     'data': f'data:image/png;base64,{b64}'
-                 }
-             else:
-                 resp_data[node_id] = {
-                     'type': 'text',
-                     'data': str(data)
-                 }
-
-        return web.json_response(resp_data)
+        job_results = {"index": 0, "inputs": inputs, "outputs": []}
+        for node_id, node_images in images.items():
+            for i, image_data in enumerate(node_images):
+                # Images are written as downloaded from ComfyUI, without decoding
+                ext = image_extension(image_data)
+                filename = f"output_{node_id}{ext}" if i == 0 else f"output_{node_id}_{i}{ext}"
+                await asyncio.to_thread(write_bytes_atomic, os.path.join(job_output_dir, filename), image_data)
+                output = {
+                    'node_id': node_id,
+                    'type': 'image',
+                    'filename': filename,
+                    'url': f"/api/outputs/{job_id}/{filename}"
+                }
+                job_results["outputs"].append(output)
+                resp_data[node_id if i == 0 else f"{node_id}_{i}"] = output
+        for node_id, node_text in text.items():
+            output = {
+                'node_id': node_id,
+                'type': 'text',
+                'data': str(node_text)
+            }
+            job_results["outputs"].append(output)
+            resp_data[node_id] = output
+        
+        job_results["timings"] = {
+            "started": started,
+            "upload": upload_done - started,
+            "generate": generate_done - upload_done,
+            "total": time.time() - started,
+        }
+        job_results["timeline"] = client.last_timeline.to_dict()
+        manifest.add_row(job_results)
+        manifest.finish("completed")
+        output_index.upsert(manifest.meta)
+
+        return web.json_response(resp_data, headers={"X-Job-Id": job_id})
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Request failed")
         return web.Response(text=str(e), status=500)
     finally:
-        await client.close()
+        for task in uploads.values():
+            task.cancel()
+        await asyncio.gather(*uploads.values(), return_exceptions=True)
+        remote_uploads.release(client.SERVER_ADDRESS if client is not None else None, [
+            task.result() for task in uploads.values()
+            if not task.cancelled() and task.exception() is None
+        ])
+        for fileobj in spool_files:
+            fileobj.close()
+        if client is not None:
+            await client.close()
 
 
 # ==================== Batch Run API ====================
 
+def prepare_batch(workflow, workflow_name, batch_data, sweep):
+    """
+    Resolve a batch request's workflow (the saved one named workflow_name when none
+    is given) and expand folder inputs. Returns (api_workflow, rows, total);
+    raises ValueError for an invalid request.
+    """
+    saved_path = os.path.join(WORKFLOWS_DIR, f"{os.path.basename(workflow_name)}.json")
+    if not workflow and os.path.isfile(saved_path):
+        # No workflow in the body: run the saved one, converted once and cached
+        workflow = file_cache.derive(saved_path, "api", WorkflowManager.ensure_api_format)
+    
+    if not workflow or not (batch_data or sweep):
+        raise ValueError("Missing workflow or batch data")
+    
+    # Ensure API format
+    workflow = WorkflowManager.ensure_api_format(workflow)
+    
+    # Expand folder paths - if any value is a directory, expand to individual files
+    IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif'}
+    expanded_batch = []
+    
+    for inputs in batch_data:
+        folder_vars = {}
+        
+        # Find folder paths
+        for key, value in inputs.items():
+            if isinstance(value, str) and os.path.isdir(value):
+                # List image files in folder
+                files = []
+                for f in sorted(os.listdir(value)):
+                    if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                        files.append(os.path.join(value, f))
+                if files:
+                    folder_vars[key] = files
+                    logger.info("Expanding folder '%s' -> %d images", value, len(files))
+        
+        if not folder_vars:
+            # No folders, keep as is
+            expanded_batch.append(inputs)
+        else:
+            # Expand based on first folder variable
+            primary_var = list(folder_vars.keys())[0]
+            for i, file_path in enumerate(folder_vars[primary_var]):
+                new_inputs = inputs.copy()
+                new_inputs[primary_var] = file_path
+                # Handle other folder vars if any
+                for other_var, other_files in folder_vars.items():
+                    if other_var != primary_var:
+                        new_inputs[other_var] = other_files[i] if i < len(other_files) else other_files[-1]
+                expanded_batch.append(new_inputs)
+    
+    batch_data = expanded_batch
+    total = len(batch_data or [{}]) * (count_sweep(sweep) if sweep is not None else 1)
+    logger.info("Total jobs after folder and sweep expansion: %d", total)
+    return workflow, batch_data, total
+
+
+def get_job_queue():
+    """The shared job queue, opened on first use so servers that never queue a batch don't create queue.db"""
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(QUEUE_DB)
+    return job_queue
+
+
+def batch_servers(server_address):
+    """Backends of a batch: a comma-separated server_address, or COMFY_SERVER"""
+    return [s.strip() for s in (server_address or COMFY_SERVER).split(',') if s.strip()]
+
+
+@routes.post('/api/batch/validate')
+async def validate_batch_request(request):
+    """
+    Check a batch before running it: takes the /api/batch body and validates every
+    expanded row against the node schema (/object_info) of each target server.
+    Returns {"valid", "rows", "errors"}; errors are grouped by node, field and value.
+    """
+    try:
+        data = await request.json()
+        workflow, batch_data, total = prepare_batch(
+            data.get('workflow'), data.get('workflow_name', 'workflow'), data.get('batch', []), data.get('sweep')
+        )
+        result = await validate_batch(
+            workflow, lambda: iter_batch_rows(batch_data, data.get('sweep')),
+            batch_servers(data.get('server_address'))
+        )
+        return web.json_response(result)
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
+    except ConnectionError as e:
+        return web.Response(text=str(e), status=502)
+    except Exception as e:
+        logger.exception("Request failed")
+        return web.Response(text=str(e), status=500)
+
+
 @routes.post('/api/batch')
 async def batch_run(request):
     """Run batch jobs and return results"""
@@ -373,204 +686,283 @@ async def batch_run(request):
         workflow = data.get('workflow')
         workflow_name = data.get('workflow_name', 'workflow')  # Get workflow name for output filenames
         batch_data = data.get('batch', [])  # List of input dicts
+        sweep = data.get('sweep')  # Optional compact parameter grid, expanded lazily per row
         custom_server = data.get('server_address')
         save_outputs = data.get('save_outputs', True)
+        # Optional image preprocessing before upload: one spec or {variable id: spec}
+        preprocess = data.get('preprocess')
+        # wait=false returns 202 at once; results are then read from /api/batch/{job_id}/results
+        wait = data.get('wait', True)
         
-        if not workflow or not batch_data:
-            return web.Response(text="Missing workflow or batch data", status=400)
-        
-        # Ensure API format
         try:
-            workflow = WorkflowManager.ensure_api_format(workflow)
+            validate_preprocess(preprocess)
+            workflow, batch_data, total = prepare_batch(workflow, workflow_name, batch_data, sweep)
         except ValueError as e:
             return web.Response(text=str(e), status=400)
         
-        # Expand folder paths - if any value is a directory, expand to individual files
-        IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif'}
-        expanded_batch = []
-        
-        for inputs in batch_data:
-            folder_vars = {}
-            
-            # Find folder paths
-            for key, value in inputs.items():
-                if isinstance(value, str) and os.path.isdir(value):
-                    # List image files in folder
-                    files = []
-                    for f in sorted(os.listdir(value)):
-                        if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
-                            files.append(os.path.join(value, f))
-                    if files:
-                        folder_vars[key] = files
-                        print(f"Expanding folder '{value}' -> {len(files)} images")
-            
-            if not folder_vars:
-                # No folders, keep as is
-                expanded_batch.append(inputs)
-            else:
-                # Expand based on first folder variable
-                primary_var = list(folder_vars.keys())[0]
-                for i, file_path in enumerate(folder_vars[primary_var]):
-                    new_inputs = inputs.copy()
-                    new_inputs[primary_var] = file_path
-                    # Handle other folder vars if any
-                    for other_var, other_files in folder_vars.items():
-                        if other_var != primary_var:
-                            new_inputs[other_var] = other_files[i] if i < len(other_files) else other_files[-1]
-                    expanded_batch.append(new_inputs)
-        
-        batch_data = expanded_batch
-        print(f"Total jobs after folder expansion: {len(batch_data)}")
+        if data.get('validate', VALIDATE_BATCHES):
+            result = await validate_batch(
+                workflow, lambda: iter_batch_rows(batch_data, sweep), batch_servers(custom_server)
+            )
+            if not result["valid"]:
+                return web.json_response(result, status=422)
         
         server_addr = custom_server if custom_server else COMFY_SERVER
-        client = ComfyUIClientAsync(server_addr, "dummy.json")
+        # Several backends may be given as a comma-separated list; rows are spread across them
+        servers = batch_servers(server_addr)
+        priority = int(data.get('priority', 0))
+        # Per-row failure handling: retries with exponential backoff and a deadline per attempt
+        max_retries = int(data.get('max_retries', DEFAULT_MAX_RETRIES))
+        retry_backoff = float(data.get('retry_backoff', DEFAULT_RETRY_BACKOFF))
+        row_timeout = data.get('row_timeout', DEFAULT_ROW_TIMEOUT)
+        row_timeout = float(row_timeout) if row_timeout else None
         
         job_id = f"batch_{int(time.time())}_{uuid.uuid4().hex[:6]}"
+        set_trace_id(job_id)
         job_output_dir = os.path.join(OUTPUTS_DIR, job_id)
-        os.makedirs(job_output_dir, exist_ok=True)
+        manifest = JobManifest(
+            job_output_dir, job_id,
+            workflow_name=workflow_name,
+            server=server_addr,
+            total=total,
+        )
+        output_index.upsert(manifest.meta)
         
-        # Register job for cancellation tracking
+        # Sanitize workflow name for filename
+        safe_workflow_name = safe_workflow_name_for(workflow_name)
+        
+        async def run_row(client, idx, inputs):
+            for value in inputs.values():
+                if isinstance(value, str) and os.path.dirname(os.path.abspath(value)) == UPLOADS_DIR:
+                    RetentionManager.touch(value)
+            # Names uploaded to ComfyUI stay referenced until the row is done with them
+            server = client.SERVER_ADDRESS
+            uploaded = []
+
+            def on_upload(name):
+                uploaded.append(name)
+                remote_uploads.acquire(server, name)
+
+            try:
+                return await run_batch_row(
+                    client, workflow, idx, inputs, job_id, job_output_dir, safe_workflow_name,
+                    preprocessor, preprocess, on_upload
+                )
+            finally:
+                remote_uploads.release(server, uploaded)
+        
+        def on_result(idx, inputs, job_results, attempts):
+            # Store result
+            job_results["attempts"] = attempts
+            record_batch_row(job_id, job_results)
+            logger.debug("Job %d completed with %d outputs", idx + 1, len(job_results['outputs']))
+        
+        def on_error(idx, inputs, error, attempts):
+            # A failed row is recorded and the rest of the batch keeps running
+            record_batch_row(job_id, error_row(idx, inputs, error, attempts))
+        
+        affinity = model_key_func(workflow) if data.get('group_by_model', GROUP_BY_MODEL) else None
+        
+        async def start_rows():
+            """Warm up the backends if asked to, then hand the rows over; returns the batch handle"""
+            if data.get('warmup', WARMUP_BATCHES):
+                # Load each backend's models with a cheap prompt before real rows are dispatched
+                picks = pick_warmup_rows(iter_batch_rows(batch_data, sweep), servers, affinity)
+                warmup = await warm_up(list(picks), workflow, lambda server: picks[server][1], preprocessor, preprocess)
+                manifest.meta["warmup"] = warmup
+                logger.info("Warm-up took %.1fs", max((w["duration"] for w in warmup), default=0))
+                if affinity is not None:
+                    # Each backend starts with the model group it was warmed with
+                    for server, (key, _) in picks.items():
+                        scheduler.loaded[server] = key
+            
+            if data.get('queue', USE_JOB_QUEUE):
+                # Coordinator mode: rows go to the shared job queue and `run.py worker`
+                # processes run them; finished rows are collected back into the manifest
+                spec = {
+                    "workflow": workflow,
+                    "workflow_label": safe_workflow_name,
+                    "output_dir": job_output_dir,
+                    "servers": servers,
+                    "preprocess": preprocess,
+                    "max_retries": max_retries,
+                    "retry_backoff": retry_backoff,
+                    "row_timeout": row_timeout,
+                }
+                queue = get_job_queue()
+                # Off the event loop: inserting the rows can wait for a worker's write lock
+                await asyncio.to_thread(queue.create_batch, job_id, spec, iter_batch_rows(batch_data, sweep), priority)
+                return QueuedBatchHandle(queue, job_id, lambda row: record_batch_row(job_id, row))
+            # Rows are dispatched by the shared scheduler, which interleaves them
+            # fairly with other running batches on the same backends
+            return scheduler.submit(
+                job_id, iter_batch_rows(batch_data, sweep), run_row,
+                priority=priority, backends=servers, on_result=on_result, on_error=on_error,
+                max_retries=max_retries, retry_backoff=retry_backoff, row_timeout=row_timeout,
+                affinity=affinity
+            )
+        
+        if retention is not None and retention.min_free_bytes:
+            # Check free space now rather than at the next interval
+            retention.request_sweep()
+        
+        # Register job for cancellation tracking and result streaming.
+        # Rows are only kept in memory when the response has to include them.
         active_batch_jobs[job_id] = {
             "cancelled": False,
-            "results": [],
+            "results": [] if wait else None,
             "server": server_addr,
-            "total": len(batch_data)
+            "servers": servers,
+            "total": total,
+            "manifest": manifest,
+            "handle": None,  # set once the rows have been handed over (after any warm-up)
+            "finished": False,
+            "rows_added": asyncio.Event(),
         }
         
-        await client.connect()
-        
-        async def generate_from_workflow(wf):
-            client.comfyui_prompt = wf
-            return await client.generate()
-        client.generate_from_workflow = generate_from_workflow
+        if not wait:
+            # The warm-up runs in the background too; its timing ends up in manifest.json
+            active_batch_jobs[job_id]["task"] = asyncio.ensure_future(finish_batch(job_id, start_rows))
+            return web.json_response({
+                "job_id": job_id,
+                "total": total,
+                "results_url": f"/api/batch/{job_id}/results"
+            }, status=202)
         
-        cancelled = False
-        try:
-            for idx, inputs in enumerate(batch_data):
-                # Check if cancelled
-                if active_batch_jobs.get(job_id, {}).get("cancelled"):
-                    print(f"Batch {job_id} cancelled at job {idx}")
-                    cancelled = True
-                    break
-                
-                print(f"Running batch job {idx+1}/{len(batch_data)}...")
-                
-                # Upload local files to ComfyUI server
-                processed_inputs = {}
-                for key, value in inputs.items():
-                    if isinstance(value, str) and os.path.isfile(value):
-                        # Local file exists, upload to ComfyUI
-                        ext = os.path.splitext(value)[1].lower()
-                        if ext in IMAGE_EXTENSIONS:
-                            original_name = os.path.basename(value)
-                            file_size = os.path.getsize(value)
-                            print(f"  Uploading {original_name} ({file_size} bytes)...")
-                            
-                            # Generate safe ASCII filename to avoid encoding issues
-                            safe_name = f"upload_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-                            
-                            with open(value, 'rb') as f:
-                                file_data = f.read()
-                            
-                            print(f"    Read {len(file_data)} bytes from file")
-                            
-                            uploaded_path = await client.upload_image_bytes(file_data, filename=safe_name)
-                            # ComfyUI LoadImage expects just the filename, not subfolder/filename
-                            if '/' in uploaded_path:
-                                uploaded_path = uploaded_path.split('/')[-1]
-                            processed_inputs[key] = uploaded_path
-                            print(f"    -> Uploaded as: {uploaded_path}")
-                        else:
-                            processed_inputs[key] = value
-                    else:
-                        processed_inputs[key] = value
-                
-                # Inject variables
-                final_workflow = WorkflowManager.inject_variables(workflow, processed_inputs)
-                
-                # Debug: print injected values
-                print(f"  Injected inputs: {processed_inputs}")
-                
-                # Debug: print the LoadImage node before and after injection
-                if "7" in workflow:
-                    print(f"  Node 7 BEFORE: {json.dumps(workflow['7'], indent=2)}")
-                if "7" in final_workflow:
-                    print(f"  Node 7 AFTER:  {json.dumps(final_workflow['7'], indent=2)}")
-                
-                # Run
-                results = await client.generate_from_workflow(final_workflow)
-                
-                # Extract source image name from inputs for filename
-                source_image_name = None
-                for key, value in inputs.items():
-                    if isinstance(value, str):
-                        # Check if it's a file path
-                        if os.path.isfile(value) or '/' in value or '\\' in value:
-                            basename = os.path.basename(value)
-                            name_without_ext = os.path.splitext(basename)[0]
-                            source_image_name = name_without_ext
-                            break
-                
-                if not source_image_name:
-                    source_image_name = f"run_{idx}"
-                
-                # Sanitize workflow name for filename
-                safe_workflow_name = "".join(c for c in workflow_name if c.isalnum() or c in ('-', '_')).strip()
-                if not safe_workflow_name:
-                    safe_workflow_name = "workflow"
-                
-                job_results = {"index": idx, "inputs": inputs, "outputs": []}
-                
-                for node_id, data in results.items():
-                    if isinstance(data, Image.Image):
-                        # Save to file with format: {original_image}_{workflow}.png
-                        filename = f"{source_image_name}_{safe_workflow_name}.png"
-                        filepath = os.path.join(job_output_dir, filename)
-                        data.save(filepath, format='PNG')
-                        
-                        # Return URL instead of base64 (much smaller response)
-                        job_results["outputs"].append({
-                            "node_id": node_id,
-                            "type": "image",
-                            "filename": filename,
-                            "url": f"/api/outputs/{job_id}/{filename}"
-                        })
-                    else:
-                        job_results["outputs"].append({
-                            "node_id": node_id,
-                            "type": "text",
-                            "data": str(data)
-                        })
-                
-                # Store result
-                active_batch_jobs[job_id]["results"].append(job_results)
-                print(f"  Job {idx+1} completed with {len(job_results['outputs'])} outputs")
-        finally:
-            await client.close()
-            # Cleanup job tracking after a delay (keep for a while for status checks)
-            asyncio.get_event_loop().call_later(300, lambda: active_batch_jobs.pop(job_id, None))
-        
-        results_to_return = active_batch_jobs.get(job_id, {}).get("results", [])
-        completed = len(results_to_return)
-        
-        print(f"Batch {'cancelled' if cancelled else 'completed'}. {completed}/{len(batch_data)} jobs done.")
+        await finish_batch(job_id, start_rows)
+        handle = active_batch_jobs[job_id]["handle"]
+        results_to_return = sorted(
+            active_batch_jobs.get(job_id, {}).get("results", []),
+            key=lambda r: r["index"]
+        )
         return web.json_response({
             "job_id": job_id,
-            "total": len(batch_data),
-            "completed": completed,
-            "cancelled": cancelled,
+            "total": total,
+            "completed": manifest.meta["completed"],
+            "failed": manifest.meta["failed"],
+            "cancelled": handle.cancelled,
+            "warmup": manifest.meta.get("warmup"),
             "results": results_to_return
         })
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Request failed")
         return web.Response(text=str(e), status=500)
 
 
+def record_batch_row(job_id, row):
+    """Persist a finished or failed row and wake up result streams following the job"""
+    job = active_batch_jobs[job_id]
+    if job["results"] is not None:
+        job["results"].append(row)
+    job["manifest"].add_row(row)
+    notify_rows_added(job)
+
+
+def notify_rows_added(job):
+    # Readers wait on the current event; swap in a fresh one for the next row
+    job["rows_added"].set()
+    job["rows_added"] = asyncio.Event()
+
+
+async def finish_batch(job_id, start_rows):
+    """Start a batch's rows with start_rows(), wait for it to finish and record its final status"""
+    job = active_batch_jobs[job_id]
+    manifest = job["manifest"]
+    total = job["total"]
+    try:
+        handle = job["handle"] = await start_rows()
+        if job["cancelled"]:
+            # Cancelled while the backends were warming up
+            await cancel_handle(handle)
+        with span("batch", total=total, servers=job["servers"]):
+            await handle.wait()
+    except Exception:
+        if job["results"] is not None:
+            raise
+        logger.exception("Batch failed")
+    finally:
+        if job["cancelled"]:
+            logger.info("Batch cancelled after %d jobs", manifest.meta["completed"])
+            manifest.finish("cancelled")
+        elif manifest.meta["completed"] == total:
+            manifest.finish("completed")
+        elif manifest.meta["completed"] + manifest.meta["failed"] == total:
+            manifest.finish("completed_with_errors")
+        else:
+            manifest.finish("failed")
+        output_index.upsert(manifest.meta)
+        job["finished"] = True
+        notify_rows_added(job)
+        # Cleanup job tracking after a delay (keep for a while for status checks)
+        asyncio.get_event_loop().call_later(300, lambda: active_batch_jobs.pop(job_id, None))
+    logger.info("Batch %s. %d/%d jobs done, %d failed.", manifest.meta["status"],
+                manifest.meta["completed"], total, manifest.meta["failed"])
+
+
+@routes.get('/api/batch/{job_id}/results')
+async def stream_batch_results(request):
+    """
+    Stream a job's rows as newline-delimited JSON, in completion order.
+    ?from=N skips the first N rows (resume after N received lines).
+    While the batch is running the stream follows it until it finishes;
+    ?follow=0 returns only the rows written so far.
+    """
+    job_id = request.match_info['job_id']
+    job_dir = os.path.join(OUTPUTS_DIR, os.path.basename(job_id))
+    if not os.path.isdir(job_dir):
+        return web.Response(text="Job not found", status=404)
+    try:
+        skip = max(0, int(request.query.get('from', 0)))
+    except ValueError:
+        return web.Response(text="Invalid from", status=400)
+    follow = request.query.get('follow', '1') not in ('0', 'false')
+    
+    resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await resp.prepare(request)
+    offset = 0
+    while True:
+        job = active_batch_jobs.get(job_id)
+        running = job is not None and not job["finished"]
+        # Taken before reading, so a row written meanwhile still wakes us up
+        rows_added = job["rows_added"] if running else None
+        for offset, line in JobManifest.read_raw_rows(job_dir, offset):
+            if skip:
+                skip -= 1
+                continue
+            await resp.write(line)
+        if not (follow and running):
+            break
+        await rows_added.wait()
+    await resp.write_eof()
+    return resp
+
+
+@routes.get('/api/batch/scheduler')
+async def scheduler_status(request):
+    """Show queued batches, the per-backend submission window and websocket connections"""
+    status = scheduler.status()
+    status["connections"] = connections.status()
+    workers = await asyncio.to_thread(job_queue.workers) if job_queue is not None else {}
+    status["queue"] = {"path": QUEUE_DB, "workers": workers}
+    return web.json_response(status)
+
+
+async def cancel_handle(handle):
+    """Cancel a batch's rows; returns the prompts removed from each backend"""
+    if isinstance(handle, QueuedBatchHandle):
+        # Workers cancel the prompts of rows they are running when they see the batch cancelled
+        await asyncio.to_thread(handle.cancel)
+        return {}
+    return await scheduler.cancel(handle)
+
+
 @routes.post('/api/batch/{job_id}/cancel')
 async def cancel_batch(request):
-    """Cancel a running batch job and interrupt ComfyUI"""
+    """
+    Cancel a running batch job. Only this batch's prompts are removed from the
+    ComfyUI queues, and a backend is interrupted only while it runs one of them.
+    """
     job_id = request.match_info['job_id']
     
     if job_id not in active_batch_jobs:
@@ -578,21 +970,16 @@ async def cancel_batch(request):
     
     job = active_batch_jobs[job_id]
     job["cancelled"] = True
+    # Still warming up: finish_batch cancels the rows as soon as they are handed over
+    prompts = await cancel_handle(job["handle"]) if job["handle"] is not None else {}
     
-    # Send interrupt to ComfyUI
-    try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"http://{job['server']}/interrupt") as resp:
-                print(f"Sent interrupt to ComfyUI: {resp.status}")
-    except Exception as e:
-        print(f"Failed to send interrupt: {e}")
-    
+    results = job["results"]
     return web.json_response({
         "success": True,
         "job_id": job_id,
-        "completed": len(job["results"]),
-        "results": job["results"]
+        "completed": len(results) if results is not None else job["manifest"].meta["completed"] + job["manifest"].meta["failed"],
+        "prompts": prompts,
+        "results": results if results is not None else []
     })
 
 
@@ -600,36 +987,73 @@ async def cancel_batch(request):
 
 @routes.get('/api/outputs')
 async def list_outputs(request):
-    """List all output jobs"""
-    jobs = []
-    for d in sorted(os.listdir(OUTPUTS_DIR), reverse=True):
-        job_dir = os.path.join(OUTPUTS_DIR, d)
-        if os.path.isdir(job_dir):
-            files = [f for f in os.listdir(job_dir) if f.endswith('.png')]
-            jobs.append({
-                "job_id": d,
-                "file_count": len(files)
-            })
-    return web.json_response(jobs)
+    """
+    List output jobs from the index.
+    Query: offset, limit, sort (created|job_id|workflow_name|completed|file_count),
+    order (asc|desc), workflow (filter by workflow name).
+    The total number of matching jobs is returned in the X-Total-Count header.
+    """
+    try:
+        offset = int(request.query.get('offset', 0))
+        limit = request.query.get('limit')
+        limit = int(limit) if limit is not None else None
+        sort = request.query.get('sort', 'created')
+        order = request.query.get('order', 'desc')
+        total, items = output_index.query(
+            workflow=request.query.get('workflow'),
+            sort=sort, order=order, offset=offset, limit=limit
+        )
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
+    return web.json_response(items, headers={"X-Total-Count": str(total)})
 
 @routes.get('/api/outputs/{job_id}')
 async def get_outputs(request):
-    """Get outputs for a specific job"""
+    """
+    Get outputs for a specific job.
+    Reads the job's rows manifest; directories written before manifests existed are listed directly.
+    Query: offset, limit for paginating the file list.
+    """
     job_id = request.match_info['job_id']
     job_dir = os.path.join(OUTPUTS_DIR, job_id)
     
-    if not os.path.exists(job_dir):
+    # index.json lives next to the job directories
+    if not os.path.isdir(job_dir):
         return web.Response(text="Job not found", status=404)
+    # Viewed jobs count as recently used for retention
+    RetentionManager.touch(job_dir)
+    
+    try:
+        offset = int(request.query.get('offset', 0))
+        limit = request.query.get('limit')
+        limit = int(limit) if limit is not None else None
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
     
     files = []
-    for f in sorted(os.listdir(job_dir)):
-        if f.endswith('.png'):
-            files.append({
-                "filename": f,
-                "url": f"/api/outputs/{job_id}/{f}"
-            })
+    if JobManifest.load(job_dir) is not None:
+        for _, row in JobManifest.iter_rows(job_dir):
+            for output in row.get("outputs", []):
+                if output.get("filename"):
+                    files.append({
+                        "filename": output["filename"],
+                        "url": output["url"],
+                        "index": row["index"]
+                    })
+    else:
+        for f in sorted(os.listdir(job_dir)):
+            if f.endswith('.png'):
+                files.append({
+                    "filename": f,
+                    "url": f"/api/outputs/{job_id}/{f}"
+                })
     
-    return web.json_response({"job_id": job_id, "files": files})
+    total = len(files)
+    end = None if limit is None else offset + limit
+    return web.json_response(
+        {"job_id": job_id, "total": total, "files": files[offset:end]},
+        headers={"X-Total-Count": str(total)}
+    )
 
 @routes.get('/api/outputs/{job_id}/{filename}')
 async def get_output_file(request):
@@ -644,12 +1068,212 @@ async def get_output_file(request):
     return web.FileResponse(filepath)
 
 
+# ==================== Retention API ====================
+
+@routes.get('/api/retention')
+async def retention_status(request):
+    """Quotas, usage and evictions of the last retention sweep"""
+    report = retention.last_report or {}
+    areas = {
+        area.name: {
+            "path": area.path,
+            "max_age": area.max_age,
+            "max_bytes": area.max_bytes,
+            "bytes": report.get("areas", {}).get(area.name, {}).get("bytes"),
+            "evicted": len(report.get("areas", {}).get(area.name, {}).get("evicted", [])),
+        }
+        for area in retention.areas
+    }
+    return web.json_response({
+        "last_sweep": report.get("time"),
+        "interval": retention.interval,
+        "min_free_bytes": retention.min_free_bytes,
+        "free": report.get("free"),
+        "areas": areas,
+        "remote_uploads": report.get("remote_uploads"),
+    })
+
+
+@routes.post('/api/retention/sweep')
+async def retention_sweep(request):
+    """Run a retention sweep now and return its report"""
+    report = await asyncio.to_thread(retention.sweep)
+    forget_evicted_jobs(report)
+    return web.json_response({
+        "areas": {name: {"evicted": len(stats["evicted"]), "freed": stats["freed"], "bytes": stats["bytes"]}
+                  for name, stats in report["areas"].items()},
+        "free": report.get("free"),
+        "remote_uploads": report.get("remote_uploads"),
+    })
+
+
+def forget_evicted_jobs(report):
+    for job_id in report["areas"].get("outputs", {}).get("evicted", []):
+        output_index.remove(job_id)
+
+
+def protect_output(name):
+    # Running jobs and the index file itself are never evicted
+    return name in active_batch_jobs or not os.path.isdir(os.path.join(OUTPUTS_DIR, name))
+
+
 # ==================== App Setup ====================
 
-app = web.Application()
+async def start_scheduler(app):
+    global scheduler, preprocessor
+    scheduler = BatchScheduler(max_pending=MAX_PENDING, initial_pending=min(2, MAX_PENDING))
+    preprocessor = InputPreprocessor(PREPROCESS_CACHE_DIR, max_workers=PREPROCESS_WORKERS)
+
+async def start_retention(app):
+    global retention, retention_task
+    areas = [
+        RetentionArea("outputs", OUTPUTS_DIR, OUTPUTS_MAX_AGE_DAYS * DAY or None,
+                      OUTPUTS_MAX_GB * GB or None, protect=protect_output),
+        RetentionArea("uploads", UPLOADS_DIR, UPLOADS_MAX_AGE_DAYS * DAY or None, UPLOADS_MAX_GB * GB or None),
+        RetentionArea("preprocess_cache", PREPROCESS_CACHE_DIR, None, PREPROCESS_CACHE_MAX_GB * GB or None),
+    ]
+    retention = RetentionManager(areas, MIN_FREE_GB * GB or None, remote_uploads, interval=RETENTION_INTERVAL)
+    retention_task = asyncio.ensure_future(retention.run(on_sweep=forget_evicted_jobs))
+
+async def stop_retention(app):
+    retention_task.cancel()
+
+async def flush_output_index(app):
+    await output_index.flush()
+
+async def stop_scheduler(app):
+    await scheduler.close()
+    await connections.close_all()
+    preprocessor.close()
+    if job_queue is not None:
+        job_queue.close()
+    close_trace_file()
+
+# ==================== Compression & Conditional Requests ====================
+
+# Responses smaller than this are sent as-is; compressing them gains nothing
+COMPRESS_MIN_SIZE = 1024
+# Bodies above this are compressed in a thread so the event loop stays responsive
+COMPRESS_OFFLOAD_SIZE = 256 * 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript')
+# Recently compressed bodies by (etag, encoding); repeated responses such as
+# index.html and saved workflows are compressed once and then served from here
+COMPRESSED_CACHE_SIZE = 64
+compressed_bodies = OrderedDict()
+body_etags = OrderedDict()  # id(body) -> (body, etag) for bytes shared by FileCache
+
+
+def body_etag(body):
+    """Content hash used as the ETag; memoized for the same bytes object"""
+    cached = body_etags.get(id(body))
+    if cached is not None and cached[0] is body:
+        return cached[1]
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    body_etags[id(body)] = (body, etag)
+    if len(body_etags) > COMPRESSED_CACHE_SIZE:
+        body_etags.popitem(last=False)
+    return etag
+
+
+def choose_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header (q=0 excludes an encoding)"""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+async def get_compressed(body, etag, encoding):
+    key = (etag, encoding)
+    compressed = compressed_bodies.get(key)
+    if compressed is None:
+        if len(body) > COMPRESS_OFFLOAD_SIZE:
+            compressed = await asyncio.get_event_loop().run_in_executor(None, compress_body, body, encoding)
+        else:
+            compressed = compress_body(body, encoding)
+        compressed_bodies[key] = compressed
+        if len(compressed_bodies) > COMPRESSED_CACHE_SIZE:
+            compressed_bodies.popitem(last=False)
+    else:
+        compressed_bodies.move_to_end(key)
+    return compressed
+
+
+@web.middleware
+async def http_cache_middleware(request, handler):
+    """
+    Add an ETag to GET responses and answer If-None-Match with 304, and
+    compress text/JSON bodies with brotli (if installed) or gzip.
+    File responses (outputs, images) are left to aiohttp's own handling.
+    """
+    resp = await handler(request)
+    if type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes):
+        return resp
+    body = resp.body
+    content_type = resp.content_type or ''
+    compressible = len(body) >= COMPRESS_MIN_SIZE and content_type.startswith(COMPRESSIBLE_TYPES)
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', '')) if compressible else None
+    cacheable = request.method in ('GET', 'HEAD')
+    if not (cacheable or encoding):
+        return resp
+    
+    etag = body_etag(body)
+    if compressible:
+        resp.headers['Vary'] = 'Accept-Encoding'
+    if cacheable:
+        # Each encoding is a different representation and gets its own strong ETag
+        resp.etag = f"{etag}-{encoding}" if encoding else etag
+        if request.if_none_match and any(e.value == resp.etag.value for e in request.if_none_match):
+            headers = {'ETag': resp.headers['ETag']}
+            if compressible:
+                headers['Vary'] = 'Accept-Encoding'
+            return web.Response(status=304, headers=headers)
+    if encoding:
+        resp.body = await get_compressed(body, etag, encoding)
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+
+async def warm_index_cache(app):
+    """Keep a precompressed index.html in memory from the start"""
+    try:
+        body = file_cache.get_bytes(INDEX_HTML)
+    except FileNotFoundError:
+        return
+    etag = body_etag(body)
+    for encoding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        await get_compressed(body, etag, encoding)
+
+
+app = web.Application(middlewares=[http_cache_middleware])
 app.add_routes(routes)
+app.on_startup.append(warm_index_cache)
+app.on_startup.append(start_scheduler)
+app.on_startup.append(start_retention)
+app.on_cleanup.append(stop_scheduler)
+app.on_cleanup.append(stop_retention)
+app.on_cleanup.append(flush_output_index)
 
 if __name__ == '__main__':
-    print(f"Data directory: {DATA_DIR}")
-    print(f"Starting server at http://127.0.0.1:8000")
-    web.run_app(app, port=8000)
+    # Level from COMFY_LOG_LEVEL (DEBUG enables per-row dumps), spans to COMFY_TRACE_FILE
+    configure_logging()
+    logger.info("Data directory: %s", DATA_DIR)
+    logger.info("Starting server at http://127.0.0.1:8000")
+    web.run_app(app, port=8000, print=None)
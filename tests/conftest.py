@@ -0,0 +1,6 @@
+# Make the comfyuiclient package importable when pytest is run from any directory
+import os
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
@@ -0,0 +1,189 @@
+"""
+A fake ComfyUI server for client tests, served by aiohttp on a free local port.
+
+Prompts run one at a time in queue order. A "KSampler" node takes `exec_time`
+seconds (and can be interrupted), a "SaveImage" node reports one image.
+Events go to the websocket of the client_id the prompt was queued with, as in
+ComfyUI. Every request is logged in `requests` as (method, path, time).
+"""
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+# Loader -> sampler -> save; "9" is the only output node
+PROMPT = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}},
+    "3": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["4", 0]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+}
+IMAGE = b"\x89PNG\r\n\x1a\nfake"
+
+
+class FakeComfyUI:
+    def __init__(self, exec_time=0.05, report_outputs=True, finish_delay=0.0):
+        self.exec_time = exec_time
+        self.report_outputs = report_outputs  # send `executed` events for output nodes
+        self.finish_delay = finish_delay  # pause between the last node and the final `executing`
+        self.go = asyncio.Event()  # cleared: queued prompts wait and never start
+        self.go.set()
+        self.sockets = {}  # client_id -> websocket
+        self.ws_connects = 0
+        self.refuse_until = 0.0
+        self.pending = []  # [(prompt_id, prompt, client_id)]
+        self.running = None
+        self.interrupted = asyncio.Event()
+        self.history = {}
+        self.finished_at = {}  # prompt_id -> time its final event was sent
+        self.queued = []  # every prompt_id ever queued
+        self.deleted = []
+        self.interrupts = []
+        self.requests = []
+        self.runner = None
+        self.worker = None
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    async def __aenter__(self):
+        app = web.Application(middlewares=[self._log])
+        app.router.add_get("/ws", self._ws)
+        app.router.add_post("/prompt", self._prompt)
+        app.router.add_get("/queue", self._get_queue)
+        app.router.add_post("/queue", self._post_queue)
+        app.router.add_post("/interrupt", self._interrupt)
+        app.router.add_get("/history/{prompt_id}", self._history)
+        app.router.add_get("/view", self._view)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        self.worker = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        await self.runner.cleanup()
+
+    def count(self, method, path):
+        return sum(1 for m, p, _ in self.requests if m == method and p.startswith(path))
+
+    async def drop_websockets(self, refuse_for=0.0):
+        """Close every websocket and refuse new ones for `refuse_for` seconds"""
+        self.refuse_until = time.time() + refuse_for
+        for ws in list(self.sockets.values()):
+            await ws.close()
+
+    def queue_foreign_prompt(self, client_id="someone-else"):
+        """Queue a prompt on behalf of another user of the server"""
+        prompt_id = str(uuid.uuid4())
+        self.pending.append((prompt_id, PROMPT, client_id))
+        self.queued.append(prompt_id)
+        return prompt_id
+
+    @web.middleware
+    async def _log(self, request, handler):
+        self.requests.append((request.method, request.path, time.time()))
+        return await handler(request)
+
+    async def _send(self, client_id, msg_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({"type": msg_type, "data": data}))
+
+    async def _run(self):
+        while True:
+            await self.go.wait()
+            if not self.pending:
+                await asyncio.sleep(0.005)
+                continue
+            prompt_id, prompt, client_id = self.pending.pop(0)
+            self.running = prompt_id
+            self.interrupted.clear()
+            await self._execute(prompt_id, prompt, client_id)
+            self.running = None
+
+    async def _execute(self, prompt_id, prompt, client_id):
+        await self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+        outputs = {}
+        for node_id, node in prompt.items():
+            await self._send(client_id, "executing", {"node": node_id, "prompt_id": prompt_id})
+            if node["class_type"] == "KSampler":
+                try:
+                    await asyncio.wait_for(self.interrupted.wait(), self.exec_time)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    data = {"prompt_id": prompt_id, "node_id": node_id}
+                    self.history[prompt_id] = {
+                        "outputs": {},
+                        "status": {"status_str": "error", "messages": [["execution_interrupted", data]]},
+                    }
+                    await self._send(client_id, "execution_interrupted", data)
+                    return
+            elif node["class_type"] == "SaveImage":
+                outputs[node_id] = {"images": [{"filename": f"{prompt_id}_{node_id}.png", "subfolder": "", "type": "output"}]}
+                if self.report_outputs:
+                    await self._send(client_id, "executed", {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id})
+        await asyncio.sleep(self.finish_delay)
+        self.history[prompt_id] = {"outputs": outputs, "status": {"status_str": "success", "messages": []}}
+        self.finished_at[prompt_id] = time.time()
+        await self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    async def _ws(self, request):
+        if time.time() < self.refuse_until:
+            return web.Response(status=503)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query["clientId"]
+        self.sockets[client_id] = ws
+        self.ws_connects += 1
+        async for _ in ws:
+            pass
+        if self.sockets.get(client_id) is ws:
+            del self.sockets[client_id]
+        return ws
+
+    async def _prompt(self, request):
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.pending.append((prompt_id, body["prompt"], body.get("client_id")))
+        self.queued.append(prompt_id)
+        return web.json_response({"prompt_id": prompt_id, "number": len(self.queued), "node_errors": {}})
+
+    async def _get_queue(self, request):
+        return web.json_response({
+            "queue_running": [[0, self.running, {}, {}, []]] if self.running else [],
+            "queue_pending": [[i + 1, p[0], {}, {}, []] for i, p in enumerate(self.pending)],
+        })
+
+    async def _post_queue(self, request):
+        body = await request.json()
+        for prompt_id in body.get("delete", []):
+            for entry in list(self.pending):
+                if entry[0] == prompt_id:
+                    self.pending.remove(entry)
+                    self.deleted.append(prompt_id)
+        return web.Response()
+
+    async def _interrupt(self, request):
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get("prompt_id")
+        # Like newer ComfyUI: an interrupt naming another prompt is ignored
+        if self.running is not None and prompt_id in (None, self.running):
+            self.interrupts.append(self.running)
+            self.interrupted.set()
+        return web.Response()
+
+    async def _history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def _view(self, request):
+        return web.Response(body=IMAGE, content_type="image/png")
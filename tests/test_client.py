@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+from comfyuiclient.client import ComfyUIClientAsync, PromptCancelled
+from comfyuiclient.connection import connections
+from fake_comfy import IMAGE, PROMPT, FakeComfyUI
+
+
+def run(main, **options):
+    """Run main(comfy) against a fresh fake ComfyUI, closing shared connections afterwards"""
+    async def wrapper():
+        async with FakeComfyUI(**options) as comfy:
+            try:
+                return await main(comfy)
+            finally:
+                await connections.close_all()
+    return asyncio.run(wrapper())
+
+
+async def connected_client(comfy):
+    client = ComfyUIClientAsync(comfy.address, "dummy.json")
+    await client.connect()
+    return client
+
+
+# ==================== Timeouts ====================
+
+def test_timed_out_prompt_is_removed_from_the_queue():
+    async def main(comfy):
+        comfy.go.clear()
+        client = await connected_client(comfy)
+        with pytest.raises(TimeoutError):
+            await client.get_images(PROMPT, timeout=0.1)
+        assert comfy.deleted == comfy.queued
+        assert comfy.pending == []
+        assert client.pending_prompts == set()
+
+    run(main)
+
+
+def test_prompt_of_a_cancelled_caller_is_removed_from_the_queue():
+    async def main(comfy):
+        comfy.go.clear()
+        client = await connected_client(comfy)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.get_images(PROMPT), 0.1)
+        assert comfy.deleted == comfy.queued
+
+    run(main)
+
+
+def test_timed_out_running_prompt_is_interrupted():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        with pytest.raises(TimeoutError):
+            await client.get_images(PROMPT, timeout=0.2)
+        assert comfy.interrupts == comfy.queued
+        # A later prompt on the same client is not treated as cancelled
+        images, _ = await client.get_images(PROMPT, timeout=5)
+        assert list(images) == ["9"]
+
+    run(main, exec_time=1.0)
+
+
+# ==================== Shared connection ====================
+
+def test_clients_of_one_server_share_a_websocket():
+    async def main(comfy):
+        first = await connected_client(comfy)
+        second = await connected_client(comfy)
+        assert first.CLIENT_ID == second.CLIENT_ID
+        results = await asyncio.gather(first.get_images(PROMPT, timeout=5), second.get_images(PROMPT, timeout=5))
+        assert [list(images) for images, _ in results] == [["9"], ["9"]]
+        assert comfy.ws_connects == 1
+
+    run(main)
+
+
+def test_prompt_that_finished_while_disconnected_is_recovered_from_history():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        task = asyncio.ensure_future(client.get_images(PROMPT, timeout=10))
+        await asyncio.sleep(0.1)
+        # The prompt finishes while no websocket can connect, so its last events are lost
+        await comfy.drop_websockets(refuse_for=1.0)
+        images, _ = await task
+        assert list(images) == ["9"]
+        assert client.last_timeline.events_missed
+        assert comfy.count("GET", "/history") >= 1
+        assert comfy.ws_connects == 1
+
+    run(main, exec_time=0.3)
+
+
+def test_events_resume_after_a_reconnect():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        task = asyncio.ensure_future(client.get_images(PROMPT, timeout=10))
+        await asyncio.sleep(0.1)
+        await comfy.drop_websockets()
+        images, _ = await task
+        assert list(images) == ["9"]
+        assert comfy.ws_connects == 2
+        # Reconnected before the prompt finished, so its final event came on the new websocket
+        assert client.last_timeline.events_missed
+
+    run(main, exec_time=1.5)
+
+
+# ==================== Cancelling ====================
+
+def test_cancel_deletes_and_interrupts_only_own_prompts():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        running = asyncio.ensure_future(client.get_images(PROMPT, timeout=10))
+        await asyncio.sleep(0.1)
+        foreign = comfy.queue_foreign_prompt()
+        waiting = asyncio.ensure_future(client.get_images(PROMPT, timeout=10))
+        await asyncio.sleep(0.05)
+        running_id, waiting_id = comfy.queued[0], comfy.queued[2]
+
+        result = await client.cancel_prompts(set(client.pending_prompts))
+        assert result == {"deleted": [waiting_id], "interrupted": running_id}
+        for task in (running, waiting):
+            with pytest.raises(PromptCancelled):
+                await task
+        assert comfy.deleted == [waiting_id]
+        assert comfy.interrupts == [running_id]
+        assert foreign not in comfy.deleted
+
+    run(main, exec_time=2.0)
+
+
+def test_cancel_does_not_interrupt_a_foreign_running_prompt():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        comfy.queue_foreign_prompt()
+        await asyncio.sleep(0.05)
+        waiting = asyncio.ensure_future(client.get_images(PROMPT, timeout=10))
+        await asyncio.sleep(0.05)
+
+        result = await client.cancel_prompts(set(client.pending_prompts))
+        assert result == {"deleted": [comfy.queued[1]], "interrupted": None}
+        with pytest.raises(PromptCancelled):
+            await waiting
+        assert comfy.interrupts == []
+
+    run(main, exec_time=1.0)
+
+
+# ==================== Downloads ====================
+
+def test_images_download_while_the_prompt_finishes():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        images, _ = await client.get_images(PROMPT, timeout=5)
+        assert images == {"9": [IMAGE]}
+        # Outputs came from the executed event: the download started before the prompt
+        # finished and /history was never read
+        view_at = next(t for method, path, t in comfy.requests if path == "/view")
+        assert view_at < comfy.finished_at[comfy.queued[0]]
+        assert comfy.count("GET", "/history") == 0
+
+    run(main, finish_delay=0.3)
+
+
+def test_outputs_are_read_from_history_when_not_reported():
+    async def main(comfy):
+        client = await connected_client(comfy)
+        images, _ = await client.get_images(PROMPT, timeout=5)
+        assert images == {"9": [IMAGE]}
+        assert comfy.count("GET", "/history") == 1
+
+    run(main, report_outputs=False)
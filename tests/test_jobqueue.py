@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from comfyuiclient.jobqueue import CANCELLED, DONE, ERROR, PENDING, RUNNING, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.db"))
+    yield queue
+    queue.close()
+
+
+def rows(n):
+    return [(i, {"6.text": str(i)}) for i in range(n)]
+
+
+def test_claims_follow_priority_then_row_order(queue):
+    assert queue.create_batch("low", {"workflow": {}}, rows(2)) == 2
+    queue.create_batch("high", {"workflow": {"high": True}}, rows(1), priority=5)
+
+    first = queue.claim("w1")
+    assert (first["batch_id"], first["index"], first["attempt"]) == ("high", 0, 1)
+    assert first["spec"] == {"workflow": {"high": True}}
+    assert [queue.claim("w1")["index"], queue.claim("w2")["index"]] == [0, 1]
+    assert queue.claim("w3") is None
+    assert queue.workers() == {"w1": 2, "w2": 1}
+
+
+def test_expired_lease_is_taken_over(queue):
+    queue.create_batch("b", {"max_retries": 1}, rows(1))
+    claimed = queue.claim("dead", lease=0.05)
+    assert queue.claim("w2") is None
+    time.sleep(0.1)
+
+    taken = queue.claim("w2")
+    assert (taken["index"], taken["attempt"]) == (0, 2)
+    # The first worker lost its lease, so its late result is ignored
+    queue.complete("dead", "b", claimed["index"], {"outputs": ["late"]})
+    queue.complete("w2", "b", taken["index"], {"outputs": ["ok"]})
+    assert queue.collect("b") == [(0, DONE, 2, {"outputs": ["ok"]})]
+
+
+def test_row_that_keeps_losing_its_lease_fails(queue):
+    queue.create_batch("b", {"max_retries": 1}, rows(1))
+    for worker in ("dead1", "dead2"):
+        assert queue.claim(worker, lease=0.05)["index"] == 0
+        time.sleep(0.1)
+
+    # Row 0 had max_retries + 1 attempts; it is failed instead of leased a third time
+    assert queue.claim("w3") is None
+    (index, status, attempts, record), = queue.collect("b")
+    assert (index, status, attempts) == (0, ERROR, 2)
+    assert record["error_type"] == "LeaseExpired"
+    assert record["inputs"] == {"6.text": "0"}
+
+
+def test_renew_keeps_the_lease(queue):
+    queue.create_batch("b", {}, rows(1))
+    queue.claim("w1", lease=0.05)
+    queue.renew("w1", lease=60)
+    time.sleep(0.1)
+    assert queue.claim("w2") is None
+    assert queue.live_leases("b") == 1
+
+
+def test_failed_row_is_retried_after_its_delay(queue):
+    queue.create_batch("b", {}, rows(1))
+    claimed = queue.claim("w1")
+    queue.fail("w1", "b", claimed["index"], {"error": "boom"}, retry_delay=0.1)
+    assert queue.counts("b") == {PENDING: 1}
+    assert queue.claim("w1") is None
+    time.sleep(0.15)
+
+    retry = queue.claim("w2")
+    assert retry["attempt"] == 2
+    queue.fail("w2", "b", retry["index"], {"error": "boom again"})
+    assert queue.collect("b") == [(0, ERROR, 2, {"error": "boom again"})]
+    # Collected rows are returned only once
+    assert queue.collect("b") == []
+    assert not queue.has_uncollected("b")
+
+
+def test_cancel_stops_pending_rows_only(queue):
+    queue.create_batch("b", {}, rows(3))
+    running = queue.claim("w1")
+    queue.cancel("b")
+
+    assert queue.claim("w2") is None
+    assert queue.counts("b") == {RUNNING: 1, CANCELLED: 2}
+    assert queue.cancelled_batches("w1") == ["b"]
+    queue.complete("w1", "b", running["index"], {"outputs": []})
+    assert queue.collect("b") == [(0, DONE, 1, {"outputs": []})]
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from comfyuiclient.outputs import PROGRESS_FILE, OutputIndex, RunProgress
+
+WORKFLOW = {"3": {"class_type": "KSampler", "inputs": {"seed": 1}}}
+
+
+def write_output(out_dir, name):
+    path = os.path.join(out_dir, name)
+    with open(path, "wb") as f:
+        f.write(b"image")
+    return path
+
+
+def test_resume_skips_completed_rows(tmp_path):
+    out = str(tmp_path)
+    progress = RunProgress(out, WORKFLOW, total=3)
+    progress.add(0, {"6.text": "a"}, [write_output(out, "a.png")])
+    progress.add(1, {"6.text": "b"}, [write_output(out, "b.png")])
+    progress.close()
+
+    resumed = RunProgress(out, WORKFLOW, total=3, resume=True)
+    assert resumed.is_done(0, {"6.text": "a"})
+    assert resumed.is_done(1, {"6.text": "b"})
+    assert not resumed.is_done(2, {"6.text": "c"})
+    # Same index with different inputs is a different row
+    assert not resumed.is_done(0, {"6.text": "changed"})
+    resumed.close()
+
+
+def test_resume_reruns_rows_whose_outputs_are_gone(tmp_path):
+    out = str(tmp_path)
+    progress = RunProgress(out, WORKFLOW, total=1)
+    progress.add(0, {"6.text": "a"}, [write_output(out, "a.png")])
+    progress.close()
+    os.remove(os.path.join(out, "a.png"))
+
+    resumed = RunProgress(out, WORKFLOW, total=1, resume=True)
+    assert not resumed.is_done(0, {"6.text": "a"})
+    resumed.close()
+
+
+def test_changed_workflow_starts_over(tmp_path):
+    out = str(tmp_path)
+    progress = RunProgress(out, WORKFLOW, total=1)
+    progress.add(0, {"6.text": "a"}, [write_output(out, "a.png")])
+    progress.close()
+
+    changed = {"3": {"class_type": "KSampler", "inputs": {"seed": 2}}}
+    resumed = RunProgress(out, changed, total=1, resume=True)
+    assert not resumed.is_done(0, {"6.text": "a"})
+    resumed.close()
+    with open(os.path.join(out, PROGRESS_FILE), encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+
+
+def test_resume_drops_a_partial_last_line(tmp_path):
+    out = str(tmp_path)
+    progress = RunProgress(out, WORKFLOW, total=2)
+    progress.add(0, {"6.text": "a"}, [write_output(out, "a.png")])
+    progress.close()
+    with open(os.path.join(out, PROGRESS_FILE), "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "key": "cut off')
+
+    resumed = RunProgress(out, WORKFLOW, total=2, resume=True)
+    assert resumed.is_done(0, {"6.text": "a"})
+    assert 1 not in resumed.done
+    resumed.add(1, {"6.text": "b"}, [write_output(out, "b.png")])
+    resumed.close()
+    with open(os.path.join(out, PROGRESS_FILE), encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert [e.get("index") for e in entries[1:]] == [0, 1]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = OutputIndex(str(tmp_path))
+    for i in range(5):
+        index.upsert({
+            "job_id": f"batch_{i}",
+            "created": 100 + i,
+            "workflow_name": "portrait" if i % 2 else "landscape",
+            "completed": i,
+            "file_count": i,
+        })
+    index.upsert({"job_id": "legacy", "created": 50, "workflow_name": None, "completed": None, "file_count": 0})
+    return index
+
+
+def test_query_pages_newest_first(index):
+    total, page = index.query(limit=2)
+    assert total == 6
+    assert [j["job_id"] for j in page] == ["batch_4", "batch_3"]
+    total, page = index.query(offset=2, limit=2)
+    assert [j["job_id"] for j in page] == ["batch_2", "batch_1"]
+    total, page = index.query(offset=4, limit=10)
+    assert [j["job_id"] for j in page] == ["batch_0", "legacy"]
+    assert index.query(offset=10)[1] == []
+
+
+def test_query_filters_and_sorts(index):
+    total, page = index.query(workflow="portrait", sort="completed", order="asc")
+    assert total == 2
+    assert [j["job_id"] for j in page] == ["batch_1", "batch_3"]
+    # Entries without a value sort before all others
+    total, page = index.query(sort="completed", order="asc", limit=1)
+    assert page[0]["job_id"] == "legacy"
+
+
+def test_query_rejects_unknown_sort_keys(index):
+    with pytest.raises(ValueError):
+        index.query(sort="inputs")
+
+
+def test_index_survives_a_reload(index, tmp_path):
+    index.remove("batch_0")
+    reloaded = OutputIndex(str(tmp_path))
+    assert reloaded.query()[0] == 5
+    assert reloaded.get("batch_4")["workflow_name"] == "landscape"
+
+
+def test_changes_on_the_event_loop_are_written_in_the_background(tmp_path):
+    async def main():
+        index = OutputIndex(str(tmp_path))
+        for i in range(3):
+            index.upsert({"job_id": f"batch_{i}", "created": i})
+        index.remove("batch_0")
+        await index.flush()
+
+    asyncio.run(main())
+    reloaded = OutputIndex(str(tmp_path))
+    assert [j["job_id"] for j in reloaded.query()[1]] == ["batch_2", "batch_1"]
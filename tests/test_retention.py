@@ -0,0 +1,38 @@
+import os
+
+from comfyuiclient.retention import RemoteUploads
+
+
+def ledger_names(uploads):
+    return sorted(entry["name"] for entry in uploads._load())
+
+
+def test_unreferenced_uploads_are_deleted_from_the_input_dir(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ("a.png", "b.png"):
+        (input_dir / name).write_bytes(b"image")
+    uploads = RemoteUploads(str(tmp_path / "ledger.jsonl"), str(input_dir))
+    uploads.acquire("srv", "a.png")
+    uploads.acquire("srv", "b.png")
+    uploads.release("srv", ["a.png"])
+
+    result = uploads.sweep(now=1e12, grace=0)
+    assert result == {"deleted": 1, "unreferenced": []}
+    assert sorted(os.listdir(input_dir)) == ["b.png"]
+    assert ledger_names(uploads) == ["b.png"]
+
+
+def test_unreachable_uploads_are_reported_once(tmp_path):
+    uploads = RemoteUploads(str(tmp_path / "ledger.jsonl"))
+    uploads.acquire("srv", "a.png")
+    uploads.acquire("srv", "b.png")
+    uploads.release("srv", ["a.png"])
+
+    # Still within the grace period
+    assert uploads.sweep(now=0, grace=3600)["unreferenced"] == []
+    result = uploads.sweep(now=1e12, grace=0)
+    assert [entry["name"] for entry in result["unreferenced"]] == ["a.png"]
+    # Dropped from the ledger, so it doesn't grow with every upload
+    assert ledger_names(uploads) == ["b.png"]
+    assert uploads.sweep(now=1e12, grace=0)["unreferenced"] == []
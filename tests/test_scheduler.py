@@ -0,0 +1,313 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from comfyuiclient.connection import connections
+from comfyuiclient.scheduler import BatchScheduler, SubmissionController
+from fake_comfy import PROMPT, FakeComfyUI
+
+
+def timeline(execution_time, queue_wait):
+    return SimpleNamespace(execution_time=execution_time, queue_wait=queue_wait)
+
+
+def status_event(queue_remaining):
+    return {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": queue_remaining}}}}
+
+
+# ==================== SubmissionController ====================
+
+def test_window_grows_while_prompts_start_at_once():
+    async def main():
+        controller = SubmissionController(max_pending=4, initial_pending=2)
+        for _ in range(5):
+            await controller.acquire()
+            controller.release(timeline(1.0, 0.0))
+        return controller.target
+
+    assert asyncio.run(main()) == 4
+
+
+def test_window_halves_once_per_execution_time_when_prompts_wait():
+    async def main():
+        controller = SubmissionController(max_pending=8, initial_pending=8)
+        for _ in range(2):
+            await controller.acquire()
+            controller.release(timeline(1.0, 5.0))
+        return controller.target
+
+    # The second slow prompt comes within one execution time of the first decrease
+    assert asyncio.run(main()) == 4
+
+
+def test_deep_server_queue_shrinks_the_window_and_blocks_submission():
+    async def main():
+        controller = SubmissionController(max_pending=4, initial_pending=4)
+        await controller.acquire()
+        controller.on_event(status_event(6))
+        assert controller.target == 2
+        assert not controller._can_submit()
+
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        controller.on_event(status_event(1))
+        await asyncio.wait_for(waiter, 1)
+        assert controller.in_flight == 2
+
+        controller.release()
+        controller.release()
+        # Nobody listens to the backend any more, so its last report is dropped
+        assert controller.queue_remaining is None
+
+    asyncio.run(main())
+
+
+def test_window_never_drops_below_min_pending():
+    async def main():
+        controller = SubmissionController(min_pending=1, max_pending=4, initial_pending=1)
+        controller.on_event(status_event(10))
+        return controller.target
+
+    assert asyncio.run(main()) == 1
+
+
+# ==================== BatchScheduler ====================
+
+class FakeClient:
+    """Stands in for ComfyUIClientAsync; rows are simulated by each test's run_row"""
+
+    cancelled = []  # prompt IDs passed to cancel_prompts(), across all instances
+
+    def __init__(self, server):
+        self.SERVER_ADDRESS = server
+        self.pending_prompts = set()
+        self.last_timeline = None
+        self.cancelling = False
+        self.closed = False
+
+    def add_event_listener(self, listener):
+        pass
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    async def cancel_prompts(self, prompt_ids):
+        FakeClient.cancelled.extend(sorted(prompt_ids))
+        return {"deleted": sorted(prompt_ids), "interrupted": None}
+
+
+@pytest.fixture(autouse=True)
+def reset_fake_client():
+    FakeClient.cancelled = []
+
+
+def run_batch(run_row, rows, backends=("a",), **kwargs):
+    """Run one batch to completion; returns (results, errors) keyed by row index"""
+    results, errors = {}, {}
+
+    async def main():
+        scheduler = BatchScheduler(max_pending=2, client_factory=FakeClient)
+        try:
+            batch = scheduler.submit(
+                "batch", list(enumerate(rows)), run_row, backends=list(backends),
+                on_result=lambda i, row, result, attempts: results.__setitem__(i, (result, attempts)),
+                on_error=lambda i, row, error, attempts: errors.__setitem__(i, (error, attempts)),
+                **kwargs
+            )
+            await asyncio.wait_for(batch.wait(), 5)
+        finally:
+            await scheduler.close()
+
+    asyncio.run(main())
+    return results, errors
+
+
+def test_every_row_runs_once():
+    async def run_row(client, index, row):
+        await asyncio.sleep(0.01)
+        return row * 2
+
+    results, errors = run_batch(run_row, list(range(10)), backends=("a", "b"))
+    assert results == {i: (i * 2, 1) for i in range(10)}
+    assert errors == {}
+
+
+def test_failed_row_is_retried_with_backoff():
+    attempts = {}
+
+    async def run_row(client, index, row):
+        attempts.setdefault(index, []).append(time.time())
+        if len(attempts[index]) < 3:
+            raise RuntimeError("flaky backend")
+        return "ok"
+
+    results, errors = run_batch(run_row, ["row"], max_retries=2, retry_backoff=0.05)
+    assert results == {0: ("ok", 3)}
+    first, second, third = attempts[0]
+    assert second - first >= 0.04
+    assert third - second >= 0.09
+
+
+def test_retries_run_on_another_backend():
+    servers = {}
+
+    async def run_row(client, index, row):
+        servers.setdefault(index, []).append(client.SERVER_ADDRESS)
+        if client.SERVER_ADDRESS == "a":
+            raise ConnectionError("backend down")
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    results, errors = run_batch(run_row, list(range(6)), backends=("a", "b"),
+                                max_retries=1, retry_backoff=0.01)
+    assert errors == {}
+    assert len(results) == 6
+    assert any(ran == ["a", "b"] for ran in servers.values())
+    for index, ran in servers.items():
+        assert ran in (["b"], ["a", "b"])
+        assert results[index] == ("ok", len(ran))
+
+
+def test_non_retryable_and_exhausted_rows_are_reported():
+    async def run_row(client, index, row):
+        if row == "bad input":
+            raise ValueError(row)
+        raise RuntimeError("always fails")
+
+    results, errors = run_batch(run_row, ["bad input", "flaky"], max_retries=1, retry_backoff=0.01)
+    assert results == {}
+    assert isinstance(errors[0][0], ValueError) and errors[0][1] == 1
+    assert isinstance(errors[1][0], RuntimeError) and errors[1][1] == 2
+
+
+def test_row_timeout_fails_the_attempt():
+    async def run_row(client, index, row):
+        await asyncio.sleep(1)
+
+    results, errors = run_batch(run_row, ["slow"], row_timeout=0.05)
+    assert isinstance(errors[0][0], TimeoutError)
+
+
+def test_timed_out_rows_leave_no_prompts_behind():
+    async def main():
+        async with FakeComfyUI() as comfy:
+            comfy.go.clear()
+            scheduler = BatchScheduler(max_pending=1)
+            errors = []
+            try:
+                batch = scheduler.submit(
+                    "batch", [(0, {})], lambda client, index, row: client.get_images(PROMPT),
+                    backends=[comfy.address], max_retries=1, retry_backoff=0.01, row_timeout=0.1,
+                    on_error=lambda index, row, error, attempts: errors.append(attempts),
+                )
+                await asyncio.wait_for(batch.wait(), 5)
+            finally:
+                await scheduler.close()
+                await connections.close_all()
+            return comfy, errors
+
+    comfy, errors = asyncio.run(main())
+    assert errors == [2]
+    # Each attempt's prompt was removed before the retry queued a new one
+    assert len(comfy.queued) == 2
+    assert comfy.deleted == comfy.queued
+    assert comfy.pending == []
+
+
+def test_cancel_only_touches_the_cancelled_batch():
+    async def main():
+        scheduler = BatchScheduler(max_pending=2, initial_pending=2, client_factory=FakeClient)
+        release = asyncio.Event()
+        done = {"keep": [], "cancel": []}
+
+        def make_run_row(batch_id):
+            async def run_row(client, index, row):
+                client.pending_prompts.add(f"{batch_id}-{index}")
+                try:
+                    await release.wait()
+                finally:
+                    client.pending_prompts.discard(f"{batch_id}-{index}")
+                done[batch_id].append(index)
+            return run_row
+
+        try:
+            keep = scheduler.submit("keep", enumerate(range(3)), make_run_row("keep"), backends=["a"])
+            cancel = scheduler.submit("cancel", enumerate(range(3)), make_run_row("cancel"), backends=["a"])
+            await asyncio.sleep(0.05)
+            # One row of each batch holds a slot on the backend
+            assert keep.in_flight == 1 and cancel.in_flight == 1
+
+            result = await scheduler.cancel(cancel)
+            assert result == {"a": {"deleted": ["cancel-0"], "interrupted": None}}
+            assert FakeClient.cancelled == ["cancel-0"]
+
+            release.set()
+            await asyncio.wait_for(asyncio.gather(keep.wait(), cancel.wait()), 5)
+        finally:
+            await scheduler.close()
+        return done, keep.cancelled, cancel.cancelled
+
+    done, keep_cancelled, cancel_cancelled = asyncio.run(main())
+    assert sorted(done["keep"]) == [0, 1, 2]
+    # The cancelled batch's running row finishes, the rest never start
+    assert done["cancel"] == [0]
+    assert (keep_cancelled, cancel_cancelled) == (False, True)
+
+
+def test_failing_on_result_does_not_rerun_the_row():
+    runs = []
+    recorded = []
+
+    async def main():
+        scheduler = BatchScheduler(max_pending=1, initial_pending=1, client_factory=FakeClient)
+
+        async def run_row(client, index, row):
+            runs.append(index)
+
+        def on_result(index, row, result, attempts):
+            recorded.append(index)
+            if len(recorded) == 1:
+                raise OSError("disk full")
+
+        try:
+            batch = scheduler.submit("batch", enumerate(range(2)), run_row, backends=["a"],
+                                     on_result=on_result, max_retries=2)
+            await asyncio.wait_for(batch.wait(), 5)
+        finally:
+            await scheduler.close()
+        return batch
+
+    batch = asyncio.run(main())
+    assert runs == [0, 1]
+    assert recorded == [0, 1]
+    assert (batch.completed, batch.failed) == (2, 0)
+
+
+def test_a_batch_submitted_later_is_interleaved():
+    order = []
+
+    async def main():
+        scheduler = BatchScheduler(max_pending=1, initial_pending=1, client_factory=FakeClient)
+
+        async def run_row(client, index, row):
+            order.append(row)
+            await asyncio.sleep(0.01)
+
+        try:
+            big = scheduler.submit("big", enumerate(["big"] * 6), run_row, backends=["a"])
+            await asyncio.sleep(0.015)
+            small = scheduler.submit("small", enumerate(["small"] * 2), run_row, backends=["a"])
+            await asyncio.wait_for(asyncio.gather(big.wait(), small.wait()), 5)
+        finally:
+            await scheduler.close()
+
+    asyncio.run(main())
+    # The small batch doesn't wait for the big one to finish
+    assert order.index("small") < 4
+    assert order.count("small") == 2 and order.count("big") == 6
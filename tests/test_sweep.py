@@ -0,0 +1,82 @@
+import itertools
+
+import pytest
+
+from comfyuiclient.sweep import count_sweep, expand_sweep, iter_batch_rows
+
+
+SPECS = [
+    {"3.cfg": [4, 6, 8], "3.steps": {"range": [10, 50, 10]}},
+    {"3.denoise": {"range": [0.1, 0.4, 0.1]}},
+    {"zip": {"6.text": ["a cat", "a dog", "a fox"], "7.image": ["cat.png", "dog.png"]}},
+    {"3.seed": {"random": 5, "seed": 1234}},
+    [{"zip": {"6.text": ["a", "b"], "7.image": ["a.png", "b.png"]}}, {"3.seed": [1, 2, 3]}],
+    {"product": [{"3.cfg": [4, 6]}, {"3.steps": 20}]},
+    {"3.steps": {"values": []}},
+]
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_count_matches_expansion(spec):
+    assert count_sweep(spec) == len(list(expand_sweep(spec)))
+
+
+def test_grid_is_cartesian_product():
+    rows = list(expand_sweep({"3.cfg": [4, 6], "3.steps": {"range": [10, 30, 10]}}))
+    assert rows == [
+        {"3.cfg": 4, "3.steps": 10},
+        {"3.cfg": 4, "3.steps": 20},
+        {"3.cfg": 6, "3.steps": 10},
+        {"3.cfg": 6, "3.steps": 20},
+    ]
+
+
+def test_float_range_is_rounded():
+    assert list(expand_sweep({"3.denoise": {"range": [0.1, 0.4, 0.1]}})) == [
+        {"3.denoise": 0.1}, {"3.denoise": 0.2}, {"3.denoise": 0.3},
+    ]
+
+
+def test_zip_stops_at_shortest_axis():
+    rows = list(expand_sweep({"zip": {"6.text": ["a", "b", "c"], "7.image": ["a.png", "b.png"]}}))
+    assert rows == [{"6.text": "a", "7.image": "a.png"}, {"6.text": "b", "7.image": "b.png"}]
+
+
+def test_random_axis_is_reproducible():
+    spec = {"3.seed": {"random": 4, "seed": 7}}
+    first = [row["3.seed"] for row in expand_sweep(spec)]
+    assert first == [row["3.seed"] for row in expand_sweep(spec)]
+    assert first != [row["3.seed"] for row in expand_sweep({"3.seed": {"random": 4, "seed": 8}})]
+
+
+def test_huge_grid_is_counted_and_expanded_lazily():
+    axis = {"range": [0, 1000]}
+    spec = {"a": axis, "b": axis, "c": axis, "d": axis}
+    assert count_sweep(spec) == 1000 ** 4
+    rows = list(itertools.islice(expand_sweep(spec), 3))
+    assert rows[-1] == {"a": 0, "b": 0, "c": 0, "d": 2}
+
+    batch = iter_batch_rows([{"6.text": "x"}], spec)
+    assert next(batch) == (0, {"6.text": "x", "a": 0, "b": 0, "c": 0, "d": 0})
+
+
+def test_batch_rows_repeat_for_every_combination():
+    rows = list(iter_batch_rows([{"6.text": "a", "3.cfg": 1}, {"6.text": "b"}], {"3.cfg": [4, 6]}))
+    assert rows == [
+        (0, {"6.text": "a", "3.cfg": 4}),
+        (1, {"6.text": "a", "3.cfg": 6}),
+        (2, {"6.text": "b", "3.cfg": 4}),
+        (3, {"6.text": "b", "3.cfg": 6}),
+    ]
+    assert list(iter_batch_rows([])) == [(0, {})]
+
+
+@pytest.mark.parametrize("spec", [
+    "3.cfg",
+    {"3.cfg": {"range": [1, 2, 3, 4]}},
+    {"3.cfg": {"range": [0.0, 1.0, 0]}},
+    {"3.cfg": {"unknown": 1}},
+])
+def test_invalid_specs_raise_value_error(spec):
+    with pytest.raises(ValueError):
+        count_sweep(spec)
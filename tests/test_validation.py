@@ -0,0 +1,31 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from comfyuiclient import validation
+from comfyuiclient.validation import SchemaCache
+
+
+def test_hung_object_info_is_a_connection_error(monkeypatch):
+    monkeypatch.setattr(validation, "OBJECT_INFO_TIMEOUT", aiohttp.ClientTimeout(total=0.1))
+
+    async def object_info(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/object_info", object_info)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        try:
+            with pytest.raises(ConnectionError, match="timed out"):
+                await SchemaCache().get(f"127.0.0.1:{runner.addresses[0][1]}")
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())